@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Micro-benchmark for the CSRF token methods.
+
+Measures the CPU time needed to issue a token (as done for every marshalled response)
+and to check it (as done for every unmarshalled request), for each of the methods
+that can be selected with the `CSRF_TOKEN_METHOD` setting.
+
+Usage: python benchmarks/csrf_tokens.py [rounds]
+"""
+import sys
+import time
+
+from edusign_webapp import run
+from edusign_webapp.marshal import CSRF_TOKEN_METHODS, ResponseSchema
+
+
+def bench(method: str, rounds: int) -> float:
+    """
+    :return: mean CPU seconds to issue and check one token
+    """
+    run.app.config['CSRF_TOKEN_METHOD'] = method
+    _, check_token = CSRF_TOKEN_METHODS[method]
+    secret = run.app.config['SECRET_KEY']
+    with run.app.test_request_context():
+        start = time.process_time()
+        for _ in range(rounds):
+            sess: dict = {}
+            token = ResponseSchema().get_csrf_token({}, sess=sess)['csrf_token']
+            assert check_token(token, sess['user_key'], secret)
+        return (time.process_time() - start) / rounds
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for method in CSRF_TOKEN_METHODS:
+        mean = bench(method, rounds)
+        print(f"{method:>15}: {mean * 1000:10.3f} ms CPU per request/response pair ({rounds} rounds)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Benchmark for filling in PDF forms.
+
+Fills in every field of each form in a corpus, as done in the `update-form` view, and reports the time it takes.
+The corpus holds the sample forms used in the tests, a synthetic form with the given number of pages
+and of fields per page (text fields and check boxes), and any PDF found in the given directory.
+
+Usage: python benchmarks/forms.py [rounds] [pages] [fields_per_page] [corpus_dir]
+"""
+import os
+import statistics
+import sys
+import time
+from base64 import b64decode
+
+import fitz
+
+from edusign_webapp.forms import update_pdf_form
+from edusign_webapp.tests.sample_pdfs import pdf_form_1, pdf_form_2
+
+
+def make_form(num_pages: int, fields_per_page: int) -> bytes:
+    """
+    :return: the raw contents of a PDF with a form with the given numbers of pages and fields per page
+    """
+    doc = fitz.open()
+    for page_num in range(num_pages):
+        page = doc.new_page()
+        for field_num in range(fields_per_page):
+            widget = fitz.Widget()
+            if field_num % 4 == 3:
+                widget.field_type = fitz.PDF_WIDGET_TYPE_CHECKBOX
+            else:
+                widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+            widget.field_name = f"field-{page_num}-{field_num}"
+            top = 20 + (field_num % 38) * 20
+            left = 20 + (field_num // 38) * 60
+            widget.rect = fitz.Rect(left, top, left + 50, top + 15)
+            page.add_widget(widget)
+    return doc.tobytes()
+
+
+def get_fields(pdf: bytes) -> list:
+    """
+    :return: values for all the fields in the form, as sent from the front side app
+    """
+    fields = []
+    for page in fitz.open(stream=pdf, filetype='application/pdf'):
+        for widget in page.widgets():
+            value = 'on' if widget.field_type == fitz.PDF_WIDGET_TYPE_CHECKBOX else 'some value'
+            fields.append({'name': widget.field_name, 'value': value})
+    return fields
+
+
+def get_corpus(num_pages: int, fields_per_page: int, corpus_dir: str = '') -> dict:
+    corpus = {
+        'sample form 1': b64decode(pdf_form_1),
+        'sample form 2': b64decode(pdf_form_2),
+        f'synthetic {num_pages}x{fields_per_page}': make_form(num_pages, fields_per_page),
+    }
+    if corpus_dir:
+        for fname in sorted(os.listdir(corpus_dir)):
+            if fname.lower().endswith('.pdf'):
+                with open(os.path.join(corpus_dir, fname), 'rb') as f:
+                    corpus[fname] = f.read()
+    return corpus
+
+
+def bench(pdf: bytes, rounds: int) -> dict:
+    """
+    :return: dict with the number of fields, and the median and max seconds to fill them in
+    """
+    fields = get_fields(pdf)
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        update_pdf_form(pdf, fields)
+        timings.append(time.perf_counter() - start)
+    return {'fields': len(fields), 'median': statistics.median(timings), 'max': max(timings)}
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    num_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    fields_per_page = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    corpus_dir = sys.argv[4] if len(sys.argv) > 4 else ''
+
+    for name, pdf in get_corpus(num_pages, fields_per_page, corpus_dir).items():
+        result = bench(pdf, rounds)
+        print(
+            f"{name:>30}: {result['fields']:5d} fields, "
+            f"{result['median'] * 1000:10.1f} ms median, {result['max'] * 1000:10.1f} ms max ({rounds} rounds)"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Contention benchmark for the document locks.
+
+Several threads repeatedly try to lock the same few documents, each thread as a different user,
+and, when they get a lock, check it and release it, as is done when signing a document.
+Reports the lock operations per second, and checks that no two users ever hold the lock of a document at the same time.
+
+The SQLite backend uses a temporary db. The Redis backend uses the server at REDIS_URL,
+or an in-process fake server with `fakeredis`.
+
+Usage: python benchmarks/locks.py [sqlite|redis|fakeredis] [threads] [rounds] [documents]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from edusign_webapp.run import edusign_init_app
+
+BACKENDS = {
+    'sqlite': 'edusign_webapp.document.metadata.sqlite.SqliteMD',
+    'redis': 'edusign_webapp.document.metadata.redis_client.RedisMD',
+    'fakeredis': 'edusign_webapp.document.metadata.redis_client.RedisMD',
+}
+
+
+def _add_documents(app, md, num_documents: int) -> list:
+    document = {'name': 'test.pdf', 'size': 1000, 'type': 'application/pdf', 'prev_signatures': ''}
+    owner = {'name': 'owner', 'email': 'owner@example.org', 'eppn': 'owner@example.org', 'lang': 'en'}
+    invites = [{'name': 'invite', 'email': 'invite@example.org', 'lang': 'en'}]
+    doc_ids = []
+    with app.app_context():
+        for _ in range(num_documents):
+            key = uuid.uuid4()
+            md.add(key, document, owner, invites, True, 'none', False, False, '')
+            doc_ids.append(md.get_document(key)['doc_id'])
+    return doc_ids
+
+
+def bench(backend: str, num_threads: int, rounds: int, num_documents: int) -> dict:
+    """
+    :return: dict with the number of lock operations, the time they took, and the number of locks acquired
+    """
+    tempdir = tempfile.TemporaryDirectory()
+    app = edusign_init_app(
+        'bench',
+        {
+            'DOC_METADATA_CLASS_PATH': BACKENDS[backend],
+            'SQLITE_MD_DB_PATH': os.path.join(tempdir.name, 'bench.db'),
+            'TESTING': backend == 'fakeredis',
+        },
+    )
+    md = app.extensions['doc_store'].metadata
+    doc_ids = _add_documents(app, md, num_documents)
+
+    holders = {doc_id: 0 for doc_id in doc_ids}
+    holders_lock = threading.Lock()
+    violations = []
+
+    def _contend(user: int) -> tuple:
+        email = f"user{user}@example.org"
+        ops, acquired = 0, 0
+        with app.app_context():
+            for i in range(rounds):
+                doc_id = doc_ids[i % len(doc_ids)]
+                ops += 1
+                if not md.add_lock(doc_id, email):
+                    continue
+                acquired += 1
+                with holders_lock:
+                    holders[doc_id] += 1
+                    if holders[doc_id] > 1:
+                        violations.append(doc_id)
+                assert md.check_lock(doc_id, [email])
+                with holders_lock:
+                    holders[doc_id] -= 1
+                assert md.rm_lock(doc_id, [email])
+                ops += 2
+        return ops, acquired
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        results = list(executor.map(_contend, range(num_threads)))
+    elapsed = time.monotonic() - start
+
+    return {
+        'ops': sum(ops for ops, _ in results),
+        'acquired': sum(acquired for _, acquired in results),
+        'elapsed': elapsed,
+        'violations': len(violations),
+    }
+
+
+def main():
+    backend = sys.argv[1] if len(sys.argv) > 1 else 'sqlite'
+    num_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    num_documents = int(sys.argv[4]) if len(sys.argv) > 4 else 2
+    result = bench(backend, num_threads, rounds, num_documents)
+    print(
+        f"{backend}: {result['ops']} lock operations by {num_threads} threads on {num_documents} documents "
+        f"in {result['elapsed']:.2f}s, {result['ops'] / result['elapsed']:.0f} ops/s, "
+        f"{result['acquired']} locks acquired, {result['violations']} mutual exclusion violations"
+    )
+
+
+if __name__ == '__main__':
+    main()
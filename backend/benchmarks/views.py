@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Benchmark for the views most used by the front side app, on synthetic document stores.
+
+The doc store is populated with the given numbers of users, of documents owned by each user, of invitations
+to other users for each document, and with documents of the given size. The eduSign API is replaced by
+canned responses, so what is measured is the time spent in the app and in its storage and metadata backends.
+
+The requests are made as the first user. `/poll`, `/config`, `/add-doc` and `/recreate-sign-request`
+are measured on the populated store, and `/get-signed` on a couple of new invitations for each request.
+`/cleanup` is measured last, each request purging as many documents as each user owns, added just before it.
+After the timed requests, some more requests are made for each view with `tracemalloc` on,
+to measure the memory allocated.
+
+Reports latency percentiles and allocations for each view, and writes them as JSON to the given file,
+so that they can be compared between releases. If a baseline JSON file is given, the latencies are compared
+with those in it, and the exit status is 1 if any view has regressed.
+
+The SQLite backend uses a temporary db. The Redis backend uses an in-process fake server with `fakeredis`.
+
+Usage: python benchmarks/views.py [-h] [--backend {sqlite,fakeredis}] [--rounds N] [--users N] [--documents N]
+                                  [--invites N] [--size KB] [--output FILE] [--baseline FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from base64 import b64decode, b64encode
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+
+import fitz
+
+from edusign_webapp.run import edusign_init_app
+
+BACKENDS = {
+    'sqlite': 'edusign_webapp.document.metadata.sqlite.SqliteMD',
+    'fakeredis': 'edusign_webapp.document.metadata.redis_client.RedisMD',
+}
+
+# Views whose median or 90th percentile latency grow by more than this ratio
+# with respect to the baseline are reported as regressions.
+REGRESSION_THRESHOLD = 1.2
+
+# Number of requests made for each view with tracemalloc on, at most.
+ALLOC_ROUNDS = 10
+
+HEADERS = {
+    'X-Requested-With': 'XMLHttpRequest',
+    'Origin': 'https://test.localhost',
+    'X-Forwarded-Host': 'test.localhost',
+}
+
+PREPARE_RESPONSE = {
+    'policy': 'edusign-test',
+    'updatedPdfDocumentReference': 'ba26478f-f8e0-43db-991c-08af7c65ed58',
+    'visiblePdfSignatureRequirement': {
+        'fieldValues': {'idp': 'https://login.idp.eduid.se/idp.xml'},
+        'page': 2,
+        'scale': -74,
+        'signerName': {
+            'formatting': None,
+            'signerAttributes': [
+                {'name': 'urn:oid:2.5.4.42'},
+                {'name': 'urn:oid:2.5.4.4'},
+                {'name': 'urn:oid:0.9.2342.19200300.100.1.3'},
+            ],
+        },
+        'templateImageRef': 'eduSign-image',
+        'xposition': 37,
+        'yposition': 165,
+    },
+}
+
+CREATE_RESPONSE = {
+    'binding': 'POST/XML/1.0',
+    'destinationUrl': 'https://sig.idsec.se/sigservice-dev/request',
+    'relayState': '31dc573b-ab7d-496c-845e-cae8792ba063',
+    'signRequest': 'DUMMY SIGN REQUEST',
+    'state': {'id': '31dc573b-ab7d-496c-845e-cae8792ba063'},
+}
+
+
+def make_pdf(size: int) -> bytes:
+    """
+    :return: the raw contents of a one page PDF, padded with an attachment to about `size` bytes
+    """
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((72, 72), "eduSign benchmark document")
+    doc.embfile_add('padding.bin', os.urandom(max(size - len(doc.tobytes()), 0)))
+    return doc.tobytes(garbage=3)
+
+
+def _user(num: int) -> dict:
+    email = f"user{num}@example.org"
+    return {'name': f"User {num}", 'email': email, 'eppn': email, 'lang': 'en'}
+
+
+def _environ(user: dict) -> dict:
+    def _attr(value: str) -> str:
+        return b64encode(f'<Attribute>{value}</Attribute>'.encode('utf8')).decode('ascii')
+
+    return {
+        "HTTP_MD_ORGANIZATIONNAME": 'Test Org',
+        "HTTP_MD_REGISTRATIONAUTHORITY": 'http://www.swamid.se/',
+        "HTTP_EDUPERSONPRINCIPALNAME_20": user['eppn'],
+        "HTTP_DISPLAYNAME_20": _attr(user['name']),
+        "HTTP_MAIL_20": _attr(user['email']),
+        "HTTP_SHIB_IDENTITY_PROVIDER": 'https://idp',
+        "HTTP_SHIB_AUTHENTICATION_METHOD": 'dummy',
+        "HTTP_SHIB_AUTHNCONTEXT_CLASS": 'dummy',
+        "HTTP_EDUPERSONASSURANCE_20": b';'.join(
+            [
+                b64encode(b'<AttributeValue>http://www.swamid.se/policy/assurance/al1</AttributeValue>'),
+                b64encode(b'<AttributeValue>https://refeds.org/assurance/IAP/low</AttributeValue>'),
+            ]
+        ).decode('ascii'),
+    }
+
+
+def _add_documents(app, owner: dict, invitees: list, num_documents: int, content: bytes) -> list:
+    """
+    :return: the documents added, with their keys and the invitations made for them
+    """
+    doc_store = app.extensions['doc_store']
+    invites = [{'name': user['name'], 'email': user['email'], 'lang': user['lang']} for user in invitees]
+    documents = []
+    with app.app_context():
+        for num in range(num_documents):
+            document = {
+                'key': str(uuid.uuid4()),
+                'name': f"{owner['eppn']}-{num}.pdf",
+                'type': 'application/pdf',
+                'size': len(content),
+                'blob': content,
+                'prev_signatures': '',
+            }
+            document['invites'] = doc_store.add_document(document, owner, invites, False, 'low', False, False, '')
+            documents.append(document)
+    return documents
+
+
+def populate(app, num_users: int, num_documents: int, num_invites: int, content: bytes) -> dict:
+    """
+    Add `num_documents` documents owned by each of `num_users` users, each inviting the `num_invites` next users.
+
+    :return: dict with the documents owned by the first user, and those to which the first user has been invited,
+             with the key of the invitation.
+    """
+    users = [_user(num) for num in range(num_users)]
+    owned: list = []
+    invited: list = []
+    for num, owner in enumerate(users):
+        invitees = [users[(num + i) % num_users] for i in range(1, min(num_invites, num_users - 1) + 1)]
+        documents = _add_documents(app, owner, invitees, num_documents, content)
+        if num == 0:
+            owned.extend(documents)
+        for document in documents:
+            for invite in document['invites']:
+                if invite['email'] == users[0]['email']:
+                    invited.append(dict(document, invite_key=str(invite['key'])))
+    return {'user': users[0], 'owned': owned, 'invited': invited}
+
+
+def fake_api(app, signed: list):
+    """
+    Replace the calls to the eduSign API with canned responses.
+    The `process` endpoint returns the documents in `signed`, as if they had just been signed.
+    """
+    api_client = app.extensions['api_client']
+
+    def _post(url, request_data, query_params={}, endpoint=''):
+        if endpoint == 'prepare':
+            return PREPARE_RESPONSE
+        if endpoint == 'create':
+            return CREATE_RESPONSE
+        return {
+            'signedDocuments': [
+                {
+                    'id': document['key'],
+                    'mimeType': document['type'],
+                    'signedContent': b64encode(document['blob']).decode('ascii'),
+                }
+                for document in signed
+            ]
+        }
+
+    def validate_signatures(to_validate):
+        for doc in to_validate:
+            doc['validated'] = True
+            if 'blob' in doc['doc']:
+                doc['doc']['signedContent'] = doc['doc']['blob']
+            else:
+                doc['doc']['signedContent'] = b64decode(doc['doc']['signedContent'])
+        return to_validate
+
+    api_client._post = _post
+    api_client.validate_signatures = validate_signatures
+
+
+class Session:
+    """
+    Test client logged in as some user, keeping the CSRF token from the last response.
+    """
+
+    def __init__(self, app, user: dict):
+        self.client = app.test_client()
+        self.client.environ_base.update(_environ(user))
+        self.csrf_token = ''
+        assert self.client.get('/sign/').status_code == 200
+
+    def _check(self, response) -> bool:
+        if response.status_code != 200:
+            return False
+        if response.mimetype != 'application/json':
+            return True
+        data = response.get_json()
+        self.csrf_token = data.get('csrf_token', self.csrf_token)
+        return not data.get('error', False)
+
+    def get(self, path: str) -> bool:
+        return self._check(self.client.get(path))
+
+    def post(self, path: str, payload=None, csrf: bool = True) -> bool:
+        data = {'csrf_token': self.csrf_token, 'payload': payload} if csrf else {'payload': payload}
+        return self._check(self.client.post(path, headers=HEADERS, json=data))
+
+
+def _measure(request, setup, rounds: int, trace: bool) -> dict:
+    latencies = []
+    peaks = []
+    nets = []
+    errors = 0
+    for _ in range(rounds):
+        if setup is not None:
+            setup()
+        if trace:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        ok = request()
+        latencies.append(time.perf_counter() - start)
+        if trace:
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            nets.append(current - before)
+        errors += 0 if ok else 1
+    return {'latencies': latencies, 'peaks': peaks, 'nets': nets, 'errors': errors}
+
+
+def _summary(timed: dict, traced: dict) -> dict:
+    latencies = [t * 1000 for t in timed['latencies']]
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'rounds': len(latencies),
+        'errors': timed['errors'] + traced['errors'],
+        'mean_ms': statistics.mean(latencies),
+        'p50_ms': percentiles[49],
+        'p90_ms': percentiles[89],
+        'p99_ms': percentiles[98],
+        'max_ms': max(latencies),
+        'alloc_peak_kb': statistics.mean(traced['peaks']) / 1024 if traced['peaks'] else 0.0,
+        'alloc_net_kb': statistics.mean(traced['nets']) / 1024 if traced['nets'] else 0.0,
+    }
+
+
+def bench(backend: str, rounds: int, num_users: int, num_documents: int, num_invites: int, size: int) -> dict:
+    """
+    :return: dict with the latency percentiles (in ms) and mean allocations (in KB) of each view
+    """
+    tempdir = tempfile.TemporaryDirectory()
+    app = edusign_init_app(
+        'bench',
+        {
+            'DOC_METADATA_CLASS_PATH': BACKENDS[backend],
+            'STORAGE_CLASS_PATH': 'edusign_webapp.document.storage.local.LocalStorage',
+            'LOCAL_STORAGE_BASE_DIR': tempdir.name,
+            'SQLITE_MD_DB_PATH': os.path.join(tempdir.name, 'bench.db'),
+            'TESTING': backend == 'fakeredis',
+            'ENVIRONMENT': 'production',
+            'SCOPE_WHITELIST': 'example.org',
+            'MAIL_BACKEND': 'dummy',
+            'BABEL_DEFAULT_LOCALE': 'en',
+            'SESSION_COOKIE_SECURE': False,
+            'SESSION_COOKIE_DOMAIN': 'test.localhost',
+            'SERVER_NAME': 'test.localhost',
+        },
+    )
+    content = make_pdf(size)
+    store = populate(app, num_users, num_documents, num_invites, content)
+    signed: list = []
+    fake_api(app, signed)
+
+    session = Session(app, store['user'])
+    blob = b64encode(content).decode('ascii')
+    new_doc = {'name': 'new.pdf', 'size': len(content), 'type': 'application/pdf', 'blob': blob}
+    to_restart = {
+        'documents': {
+            'local': [dict(new_doc, key=str(uuid.uuid4()))],
+            'owned': [
+                {'name': doc['name'], 'size': doc['size'], 'type': doc['type'], 'key': doc['key']}
+                for doc in store['owned'][:2]
+            ],
+            'invited': [
+                {
+                    'name': doc['name'],
+                    'size': doc['size'],
+                    'type': doc['type'],
+                    'key': doc['key'],
+                    'invite_key': doc['invite_key'],
+                }
+                for doc in store['invited'][:2]
+            ],
+        }
+    }
+    sign_data = {'sign_response': 'DUMMY SIGN RESPONSE', 'relay_state': CREATE_RESPONSE['relayState']}
+    admin = app.test_client()
+
+    def _add_invited_documents():
+        # Each invitation can only be signed once
+        signed[:] = _add_documents(app, _user(1), [store['user'], _user(2)], 2, content)
+
+    def _prepare_cleanup():
+        # Consider old all documents added before each request, and purge the populated store
+        app.config['MAX_DOCUMENT_AGE'] = 0
+        admin.post('/admin/cleanup')
+
+    def _add_old_documents():
+        _add_documents(app, _user(num_users), [], num_documents, content)
+
+    views = {
+        'poll': (lambda: session.get('/sign/poll'), None, None),
+        'config': (lambda: session.get('/sign/config'), None, None),
+        'add-doc': (lambda: session.post('/sign/add-doc', new_doc, csrf=False), None, None),
+        'recreate-sign-request': (lambda: session.post('/sign/recreate-sign-request', to_restart), None, None),
+        'get-signed': (lambda: session.post('/sign/get-signed', sign_data), _add_invited_documents, None),
+        'cleanup': (lambda: admin.post('/admin/cleanup').status_code == 200, _add_old_documents, _prepare_cleanup),
+    }
+
+    results = {}
+    for name, (request, setup, prepare) in views.items():
+        if prepare is not None:
+            prepare()
+        # warm up
+        _measure(request, setup, 1, False)
+        timed = _measure(request, setup, rounds, False)
+        tracemalloc.start()
+        try:
+            traced = _measure(request, setup, min(rounds, ALLOC_ROUNDS), True)
+        finally:
+            tracemalloc.stop()
+        results[name] = _summary(timed, traced)
+
+    tempdir.cleanup()
+    return results
+
+
+def compare(results: dict, baseline: dict) -> list:
+    """
+    :return: the names of the views whose latency has regressed with respect to the baseline
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('views', {}).get(name)
+        if not base:
+            continue
+        ratios = [result[p] / base[p] for p in ('p50_ms', 'p90_ms') if base[p] > 0]
+        change = ', '.join(f"{(ratio - 1) * 100:+.0f}%" for ratio in ratios)
+        regressed = any(ratio > REGRESSION_THRESHOLD for ratio in ratios)
+        print(
+            f"{name:>22}: p50, p90 {change} with respect to {baseline['version']}{' REGRESSION' if regressed else ''}"
+        )
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the views most used by the front side app.")
+    parser.add_argument('--backend', choices=list(BACKENDS), default='sqlite', help="metadata backend")
+    parser.add_argument('--rounds', type=int, default=50, help="number of timed requests for each view")
+    parser.add_argument('--users', type=int, default=20, help="number of users owning documents")
+    parser.add_argument('--documents', type=int, default=10, help="number of documents owned by each user")
+    parser.add_argument('--invites', type=int, default=3, help="number of invitations for each document")
+    parser.add_argument('--size', type=int, default=100, help="size of the documents, in KB")
+    parser.add_argument('--output', default='', help="JSON file to write the results to")
+    parser.add_argument('--baseline', default='', help="JSON file with results to compare with")
+    args = parser.parse_args()
+
+    try:
+        app_version = version('edusign-webapp')
+    except PackageNotFoundError:
+        app_version = 'unknown'
+
+    params = {
+        'backend': args.backend,
+        'rounds': args.rounds,
+        'users': args.users,
+        'documents': args.documents,
+        'invites': args.invites,
+        'size_kb': args.size,
+    }
+    results = bench(args.backend, args.rounds, args.users, args.documents, args.invites, args.size * 1024)
+
+    for name, result in results.items():
+        print(
+            f"{name:>22}: {result['p50_ms']:8.2f} ms p50, {result['p90_ms']:8.2f} ms p90, "
+            f"{result['p99_ms']:8.2f} ms p99, {result['alloc_peak_kb']:10.1f} KB peak alloc, "
+            f"{result['errors']} errors ({result['rounds']} rounds)"
+        )
+
+    report = {
+        'version': app_version,
+        'python': platform.python_version(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'params': params,
+        'views': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print(f"Warning: the baseline was run with different parameters: {baseline.get('params')}")
+        if compare(results, baseline):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -35,6 +35,26 @@ if [ -f "/opt/edusign/edusign-webapp/setup.py" ]; then
     extra_args="--reload"
 fi
 
+# With MAIL_OUTBOX, notification emails are queued in an outbox by the app,
+# and sent by the outbox worker running alongside it, restarted whenever it exits.
+mail_outbox=${MAIL_OUTBOX-false}
+case "${mail_outbox}" in
+    t|true|T|True|Yes|yes)
+        echo "$0: Starting ${edusign_name} outbox worker"
+        outbox_log="${log_dir}/${edusign_name}-outbox.log"
+        (
+            while true; do
+                start-stop-daemon --start -c edusign:edusign \
+                     --pidfile "${state_dir}/${edusign_name}-outbox.pid" --make-pidfile \
+                     --exec /opt/edusign/bin/python -- -m edusign_webapp.outbox >> "${outbox_log}" 2>&1 \
+                     || true
+                echo "$(date -Iseconds) $0: ${edusign_name} outbox worker exited, restarting it in 5s" >> "${outbox_log}"
+                sleep 5
+            done
+        ) &
+        ;;
+esac
+
 echo ""
 echo "$0: Starting ${edusign_name}"
 
@@ -38,5 +38,9 @@ setup(name='edusign-webapp',
       install_requires=requires,
       tests_require=test_requires,
       entry_points="""
+      [console_scripts]
+      edusign-outbox-worker = edusign_webapp.outbox:main
+      edusign-purge = edusign_webapp.purge:main
+      edusign-migrate = edusign_webapp.migrate:main
       """,
       )
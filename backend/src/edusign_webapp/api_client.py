@@ -62,18 +62,20 @@ There are 4 basic steps to complete a signature procedure:
 
 1.- https://github.com/idsec-solutions/signservice-integration-rest/blob/master/docs/sample-flow.md
 """
-import asyncio
 import json
+import threading
 import uuid
-from base64 import b64decode, b64encode
+from base64 import b64decode
 from pprint import pformat
 from urllib.parse import urljoin, urlencode, urlparse
 
 import requests
 from flask import current_app, request, session, url_for
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 
-from edusign_webapp.utils import get_authn_context, get_required_assurance
+from edusign_webapp.utils import get_authn_context, get_required_assurance, run_concurrently
 
 
 def pretty_print_req(req: requests.PreparedRequest) -> str:
@@ -91,6 +93,73 @@ def pretty_print_req(req: requests.PreparedRequest) -> str:
     )
 
 
+class HTTPSessionPool(object):
+    """
+    Thread safe registry of keep-alive `requests` sessions, one per base URL,
+    each of them with its own pool of connections, and retrying failed connections,
+    and failed idempotent requests, with exponential backoff.
+    """
+
+    def __init__(self, pool_size: int, retries: int, backoff_factor: float):
+        """
+        :param pool_size: Max number of connections kept open to each host.
+        :param retries: Max number of retries for each request.
+        :param backoff_factor: Backoff factor for the sleep between retries.
+        """
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._sessions: dict = {}
+        self._adapters: dict = {}
+        self._lock = threading.Lock()
+
+    def session(self, base_url: str) -> requests.Session:
+        """
+        Get the session to use to send requests to the given base URL.
+
+        :param base_url: The base URL of some API
+        :return: The session for the base URL
+        """
+        with self._lock:
+            if base_url not in self._sessions:
+                retry = Retry(
+                    total=self.retries,
+                    backoff_factor=self.backoff_factor,
+                    status_forcelist=(502, 503, 504),
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount(base_url, adapter)
+                self._sessions[base_url] = session
+                self._adapters[base_url] = adapter
+
+            return self._sessions[base_url]
+
+    def stats(self) -> dict:
+        """
+        Connection reuse statistics.
+
+        :return: A dict keyed by base URL, with dicts with the number of requests sent,
+                 and the number of new connections opened to send them.
+        """
+        stats = {}
+        with self._lock:
+            adapters = list(self._adapters.items())
+
+        for base_url, adapter in adapters:
+            num_requests, num_connections = 0, 0
+            for pool_key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[pool_key]
+                if pool is None:
+                    continue
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+            stats[base_url] = {'requests': num_requests, 'connections': num_connections}
+
+        return stats
+
+
 class APIClient(object):
     """
     Class holding methods to communicate with the Signature Service Integration REST-Service.
@@ -124,6 +193,9 @@ class APIClient(object):
         :param config: Dict containing the configuration parameters provided to Flask.
         """
         self.config = config
+        self.http_sessions = HTTPSessionPool(
+            config['HTTP_POOL_SIZE'], config['HTTP_RETRIES'], config['HTTP_RETRIES_BACKOFF']
+        )
 
     def initialize_credentials(self):
         """
@@ -141,16 +213,19 @@ class APIClient(object):
             self.config[f'EDUSIGN_API_USERNAME_{attr_schema}'], self.config[f'EDUSIGN_API_PASSWORD_{attr_schema}']
         )
 
-    def _post(self, url: str, request_data: dict, query_params: dict = {}) -> dict:
+    def _post(self, url: str, request_data: dict, query_params: dict = {}, endpoint: str = '') -> dict:
         """
         Method to POST to the eduSign API, used by all methods of the class
         that POST to it.
 
         :param url: URL to send the POST to
         :param request_data: Dict holding the data to POST.
+        :param query_params: Dict holding query parameters to add to the URL.
+        :param endpoint: Name of the endpoint of the API, to pick a timeout from the `EDUSIGN_API_TIMEOUTS` setting.
         :return: Flask representation of the HTTP response from the API.
         """
-        requests_session = requests.Session()
+        requests_session = self.http_sessions.session(self.config['EDUSIGN_API_BASE_URL'])
+        timeout = self.config['EDUSIGN_API_TIMEOUTS'].get(endpoint, self.config['EDUSIGN_API_TIMEOUT'])
 
         if query_params:
             params = urlencode(query_params)
@@ -165,7 +240,7 @@ class APIClient(object):
         current_app.logger.debug(f"Request sent to the API's {url} method: {pretty_print_req(prepped)}")
 
         settings = requests_session.merge_environment_settings(prepped.url, {}, None, None, None)
-        response = requests_session.send(prepped, **settings)
+        response = requests_session.send(prepped, timeout=timeout, **settings)
         current_app.logger.debug(f"Response from the API's {url} method: {response.json()}")
         return response.json()
 
@@ -241,7 +316,7 @@ class APIClient(object):
         api_url = urljoin(self.api_base_url, f'prepare/{self.profile}')
         query_params = {"returnDocReference": True}
 
-        response = self._post(api_url, request_data, query_params)
+        response = self._post(api_url, request_data, query_params, endpoint='prepare')
 
         if current_app.logger.level == 'DEBUG':
             tolog = response.copy()
@@ -416,7 +491,7 @@ class APIClient(object):
             request_data['tbsDocuments'].append(data)
         api_url = urljoin(self.api_base_url, f'create/{self.profile}')
 
-        return self._post(api_url, request_data), documents_with_id
+        return self._post(api_url, request_data, endpoint='create'), documents_with_id
 
     def create_sign_request(self, documents: list, add_blob=False) -> tuple:
         """
@@ -476,7 +551,7 @@ class APIClient(object):
         `signedDocuments`, where each document includes:
 
         + id: the id of the document, sent to the `create` endpoint as tbsDocuments.N.id;
-        + signedContent: The signed document encoded as base64;
+        + signedContent: The signed document, encoded as base64 by the API, and decoded here to raw bytes;
         + mimeType: "application/pdf"
 
         Send request to the `process` endpoint of the API.
@@ -491,7 +566,7 @@ class APIClient(object):
         request_data = {"signResponse": sign_response, "relayState": relay_state, "state": {"id": relay_state}}
         api_url = urljoin(self.api_base_url, 'process')
 
-        response = self._post(api_url, request_data)
+        response = self._post(api_url, request_data, endpoint='process')
 
         if current_app.logger.level == 'DEBUG':
             tolog = response.copy()
@@ -499,6 +574,10 @@ class APIClient(object):
                 doc['signedContent'] = doc['signedContent'][:20] + '...'
             current_app.logger.debug(f"Data returned from the API's process endpoint: {pformat(tolog)}")
 
+        # From here on, the signed documents are handled as raw bytes
+        for doc in response.get('signedDocuments', []):
+            doc['signedContent'] = b64decode(doc['signedContent'])
+
         return response
 
     def validate_signatures(self, to_validate: list) -> list:
@@ -509,40 +588,53 @@ class APIClient(object):
         :param to_validate: list in which each entry is a dict that corresponds to a signed document to validate, with keys:
             * key: key for the document
             * owner: owner of document
-            * doc: document contents
+            * doc: document data, with either the raw contents of the document under the `blob` key,
+                   as kept in the doc store, or under the `signedContent` key,
+                   as returned from `process_sign_request`.
             * sendsigned: sendsigned flag
 
-        :return: a list like the to_validate param, in which the document contents may have been substituted
-            by the one with validation proof, and with an additional boolean key validated indicating whether the contents
-            have been substituted with a validated signature.
+        :return: a list like the to_validate param, in which the raw document contents are under the `signedContent` key
+            of `doc`, possibly substituted by the one with validation proof, and with an additional boolean key
+            validated indicating whether the contents have been substituted with a validated signature.
         """
         url = current_app.config['VALIDATOR_API_BASE_URL'] + 'issue-svt'
+        timeout = current_app.config['VALIDATOR_TIMEOUT']
+        validator_session = self.http_sessions.session(current_app.config['VALIDATOR_API_BASE_URL'])
+
+        def _content(doc):
+            if 'blob' in doc['doc']:
+                return doc['doc']['blob']
+            return doc['doc']['signedContent']
+
+        def _not_validated(doc, content):
+            doc['doc']['signedContent'] = content
+            doc['validated'] = False
+            return doc
 
         def _validate(doc):
+            content = _content(doc)
             try:
-                content = b64decode(doc['doc']['blob'])
-            except KeyError:
-                content = b64decode(doc['doc']['signedContent'])
-            resp = requests.post(url, data=content, headers={'Content-Type': doc['doc']['type']})
+                resp = validator_session.post(
+                    url, data=content, headers={'Content-Type': doc['doc']['type']}, timeout=timeout
+                )
+            except requests.RequestException as e:
+                current_app.logger.error(f"Problem validating signature of {doc['key']}: {e}")
+                return _not_validated(doc, content)
+
             if resp.status_code == 200:
-                vpdf = resp.content
-                doc['doc']['signedContent'] = b64encode(vpdf).decode('utf8')
+                doc['doc']['signedContent'] = resp.content
                 doc['validated'] = True
             else:
-                if 'signedContent' not in doc['doc']:
-                    doc['doc']['signedContent'] = doc['doc']['blob']
-                doc['validated'] = False
+                _not_validated(doc, content)
 
             return doc
 
-        async def validate(doc):
-            return _validate(doc)
+        def _on_timeout(doc):
+            current_app.logger.error(f"Timeout validating signature of {doc['key']}")
+            # The validation may still finish and update the original doc, so hand over a copy
+            result = dict(doc, doc=dict(doc['doc']))
+            return _not_validated(result, _content(result))
 
-        loop = asyncio.new_event_loop()
-        tasks = [loop.create_task(validate(doc)) for doc in to_validate]
-
-        if len(tasks) > 0:
-            loop.run_until_complete(asyncio.wait(tasks))
-        loop.close()
-
-        return [task.result() for task in tasks]
+        return run_concurrently(
+            _validate, to_validate, current_app.config['VALIDATOR_MAX_WORKERS'], timeout, _on_timeout
+        )
@@ -74,6 +74,14 @@ SERVER_NAME = os.environ.get('SP_HOSTNAME', default='edusign.sunet.se')
 
 PREFERRED_URL_SCHEME = os.environ.get('PREFERRED_URL_SCHEME', default='https')
 
+# Method to produce CSRF tokens, either 'hmac' or 'password-hash'.
+# With 'password-hash', the tokens are hashed with HASH_METHOD and SALT_LENGTH.
+CSRF_TOKEN_METHOD = os.environ.get('CSRF_TOKEN_METHOD', default='hmac')
+# Whether to accept, with the 'hmac' method, tokens produced with the 'password-hash' method.
+# Checking them is expensive, so this is only meant to be enabled for the first deploy after switching to 'hmac',
+# for the users who got their tokens before the switch.
+RAW_CSRF_ACCEPT_PASSWORD_HASH_TOKENS = os.environ.get('CSRF_ACCEPT_PASSWORD_HASH_TOKENS', default=False)
+CSRF_ACCEPT_PASSWORD_HASH_TOKENS = get_boolean(RAW_CSRF_ACCEPT_PASSWORD_HASH_TOKENS)
 HASH_METHOD = 'scrypt'
 SALT_LENGTH = 8
 
@@ -92,10 +100,42 @@ EDUSIGN_API_PROFILE_11 = os.environ.get('EDUSIGN_API_PROFILE_11', default='edusi
 EDUSIGN_API_USERNAME_11 = os.environ.get('EDUSIGN_API_USERNAME_11', default='dummy')
 EDUSIGN_API_PASSWORD_11 = os.environ.get('EDUSIGN_API_PASSWORD_11', default='dummy')
 
+# Timeouts in seconds for the calls to the API, by endpoint,
+# as a list of endpoint:timeout pairs, e.g. "prepare:30,process:90"
+EDUSIGN_API_TIMEOUT = int(os.environ.get('EDUSIGN_API_TIMEOUT', default=60))
+RAW_EDUSIGN_API_TIMEOUTS = os.environ.get('EDUSIGN_API_TIMEOUTS', default='')
+EDUSIGN_API_TIMEOUTS = {
+    pair.split(':')[0].strip(): int(pair.split(':')[1]) for pair in RAW_EDUSIGN_API_TIMEOUTS.split(',') if ':' in pair
+}
+
+# Connections kept open to each of the eduSign and validator APIs,
+# and retries (with exponential backoff) for failed connections and idempotent requests
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', default=10))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', default=3))
+HTTP_RETRIES_BACKOFF = float(os.environ.get('HTTP_RETRIES_BACKOFF', default=0.3))
+
 SIGN_REQUESTER_ID = os.environ.get('SIGN_REQUESTER_ID', default="https://sig.idsec.se/edusign-test")
 
 VALIDATOR_API_BASE_URL = os.environ.get('VALIDATOR_API_BASE_URL', default='https://sig.idsec.se/sigval/')
 
+# Max number of documents sent concurrently to the validator,
+# and time in seconds to wait for the validation of each document
+VALIDATOR_MAX_WORKERS = int(os.environ.get('VALIDATOR_MAX_WORKERS', default=5))
+VALIDATOR_TIMEOUT = int(os.environ.get('VALIDATOR_TIMEOUT', default=30))
+
+# Max number of documents sent concurrently to the API to be prepared,
+# and time in seconds to wait for the preparation of each document
+PREPARE_MAX_WORKERS = int(os.environ.get('PREPARE_MAX_WORKERS', default=5))
+PREPARE_TIMEOUT = int(os.environ.get('PREPARE_TIMEOUT', default=60))
+
+# CPU bound transformations of documents (filling in PDF forms and converting them to PDF/A)
+# are run in a pool of PDF_WORKERS processes (0 to run them within the request),
+# with at most PDF_WORKERS_MAX_QUEUED more waiting for a free worker, beyond which they are rejected,
+# and each allowed PDF_WORKERS_TIMEOUT seconds, counting the wait.
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', default=2))
+PDF_WORKERS_MAX_QUEUED = int(os.environ.get('PDF_WORKERS_MAX_QUEUED', default=4))
+PDF_WORKERS_TIMEOUT = int(os.environ.get('PDF_WORKERS_TIMEOUT', default=60))
+
 MULTISIGN_BUTTONS = os.environ.get('MULTISIGN_BUTTONS', default="yes")
 
 RAW_SIGNER_ATTRIBUTES_11 = os.environ.get(
@@ -141,6 +181,9 @@ USER_WHITELIST = [eppn.lower().strip() for eppn in RAW_USER_WHITELIST.split(',')
 STORAGE_CLASS_PATH = os.environ.get('STORAGE_CLASS_PATH', default='edusign_webapp.document.storage.local.LocalStorage')
 LOCAL_STORAGE_BASE_DIR = os.environ.get('LOCAL_STORAGE_BASE_DIR', default='/tmp')
 
+# Size in bytes of the chunks in which the contents of documents are read from and written to the storage
+STORAGE_CHUNK_SIZE = int(os.environ.get('STORAGE_CHUNK_SIZE', default=256 * 1024))
+
 # Do not set AWS_ENDPOINT_URL if you use AWS
 AWS_ENDPOINT_URL = os.environ.get('AWS_ENDPOINT_URL', default=None)
 if AWS_ENDPOINT_URL == 'none':
@@ -149,14 +192,34 @@ AWS_ACCESS_KEY = os.environ.get('AWS_ACCESS_KEY', default='dummy')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', default='dummy')
 AWS_REGION_NAME = os.environ.get('AWS_REGION_NAME', default='eu-north-1')
 AWS_BUCKET_NAME = os.environ.get('AWS_BUCKET_NAME', default='edusign-storage')
+# Documents larger than the threshold are uploaded to S3 in parts of the given size
+AWS_MULTIPART_THRESHOLD = int(os.environ.get('AWS_MULTIPART_THRESHOLD', default=8 * 1024 * 1024))
+AWS_MULTIPART_CHUNKSIZE = int(os.environ.get('AWS_MULTIPART_CHUNKSIZE', default=8 * 1024 * 1024))
 
 DOC_METADATA_CLASS_PATH = os.environ.get(
     'DOC_METADATA_CLASS_PATH', default='edusign_webapp.document.metadata.sqlite.SqliteMD'
 )
 SQLITE_MD_DB_PATH = os.environ.get('SQLITE_MD_DB_PATH', default='/tmp/test.db')
+# Each process keeps a pool of up to SQLITE_MD_POOL_SIZE idle connections to the (WAL journaled) sqlite db,
+# each with a page cache of SQLITE_MD_CACHE_SIZE KiB and a cache of SQLITE_MD_CACHED_STATEMENTS prepared statements.
+SQLITE_MD_POOL_SIZE = int(os.environ.get('SQLITE_MD_POOL_SIZE', default=8))
+SQLITE_MD_CACHE_SIZE = int(os.environ.get('SQLITE_MD_CACHE_SIZE', default=16384))
+SQLITE_MD_CACHED_STATEMENTS = int(os.environ.get('SQLITE_MD_CACHED_STATEMENTS', default=256))
+SQLITE_MD_SYNCHRONOUS = os.environ.get('SQLITE_MD_SYNCHRONOUS', default='NORMAL')
+# Seconds to wait for a lock on the db held by some other connection
+SQLITE_MD_BUSY_TIMEOUT = int(os.environ.get('SQLITE_MD_BUSY_TIMEOUT', default=5))
 
 REDIS_URL = os.environ.get('REDIS_URL', default='redis://localhost:6379/0')
 
+# Migration from SQLite & the local fs to Redis & S3: documents are migrated in batches of MIGRATION_BATCH_SIZE,
+# copying the contents of up to MIGRATION_CONCURRENCY documents at the same time,
+# and the progress is recorded in MIGRATION_CHECKPOINT_PATH, so that the migration can be resumed.
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', default=200))
+MIGRATION_CONCURRENCY = int(os.environ.get('MIGRATION_CONCURRENCY', default=8))
+MIGRATION_CHECKPOINT_PATH = os.environ.get(
+    'MIGRATION_CHECKPOINT_PATH', default=os.path.join(os.path.dirname(SQLITE_MD_DB_PATH), 'migration.json')
+)
+
 DOC_LOCK_TIMEOUT_RAW = os.environ.get('DOC_LOCK_TIMEOUT', default='300')
 
 DOC_LOCK_TIMEOUT = datetime.timedelta(seconds=int(DOC_LOCK_TIMEOUT_RAW))
@@ -166,6 +229,22 @@ MAX_DOCUMENT_AGE_RAW = os.environ.get('MAX_DOCUMENT_AGE', default='30')
 
 MAX_DOCUMENT_AGE = int(MAX_DOCUMENT_AGE_RAW)
 
+# Old documents are purged in batches of CLEANUP_BATCH_SIZE documents,
+# with up to CLEANUP_CONCURRENCY batches being removed at the same time.
+# With S3, each batch of up to 1000 documents is removed with a single DeleteObjects request.
+CLEANUP_BATCH_SIZE = int(os.environ.get('CLEANUP_BATCH_SIZE', default=500))
+CLEANUP_CONCURRENCY = int(os.environ.get('CLEANUP_CONCURRENCY', default=4))
+
+# The keys of old documents are read from the metadata backend in batches of this size,
+# so that listing them takes constant memory.
+OLD_DOCUMENTS_BATCH_SIZE = int(os.environ.get('OLD_DOCUMENTS_BATCH_SIZE', default=1000))
+
+# The /metrics endpoint reports the number of documents older than each of these numbers of days,
+# besides those older than MAX_DOCUMENT_AGE, that are to be purged.
+RAW_METRICS_AGE_DAYS = os.environ.get('METRICS_AGE_DAYS', default='1, 7')
+
+METRICS_AGE_DAYS = [int(days.strip()) for days in RAW_METRICS_AGE_DAYS.split(',') if days.strip()]
+
 TO_TEAR_DOWN_WITH_APP_CONTEXT = os.environ.get(
     'TO_TEAR_DOWN_WITH_APP_CONTEXT', default='edusign_webapp.document.metadata.sqlite.close_connection'
 ).split(',')
@@ -184,6 +263,35 @@ MAIL_MAX_EMAILS = os.environ.get('MAIL_MAX_EMAILS', default=None)
 # the nginx default of 60 for proxy_connect_timeout
 MAIL_TIMEOUT = os.environ.get('MAIL_TIMEOUT', default=55)
 
+# Emails sent in bulk are delivered concurrently over a pool of SMTP connections.
+# MAIL_SEND_TIMEOUT is the timeout in seconds for each SMTP command on the pooled connections,
+# and messages that fail with transient errors are retried MAIL_SEND_RETRIES times,
+# waiting MAIL_RETRY_BACKOFF seconds times the number of the attempt between retries.
+MAIL_POOL_SIZE = int(os.environ.get('MAIL_POOL_SIZE', default=5))
+MAIL_SEND_TIMEOUT = int(os.environ.get('MAIL_SEND_TIMEOUT', default=20))
+MAIL_SEND_RETRIES = int(os.environ.get('MAIL_SEND_RETRIES', default=2))
+MAIL_RETRY_BACKOFF = float(os.environ.get('MAIL_RETRY_BACKOFF', default=0.5))
+
+# With MAIL_OUTBOX (off by default), the views queue notification emails in an outbox kept in the metadata backend,
+# and they are sent by the outbox worker (`python -m edusign_webapp.outbox`), started by scripts/start.sh.
+# The worker claims up to MAIL_OUTBOX_BATCH_SIZE messages at a time, for MAIL_OUTBOX_LEASE seconds,
+# and polls the outbox every MAIL_OUTBOX_POLL_INTERVAL seconds when it is empty.
+# Messages that fail with transient errors are attempted again after MAIL_OUTBOX_RETRY_DELAY seconds,
+# doubled on each attempt, and dead lettered after MAIL_OUTBOX_MAX_ATTEMPTS attempts.
+RAW_MAIL_OUTBOX = os.environ.get('MAIL_OUTBOX', default=False)
+MAIL_OUTBOX = get_boolean(RAW_MAIL_OUTBOX)
+MAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('MAIL_OUTBOX_BATCH_SIZE', default=50))
+MAIL_OUTBOX_LEASE = int(os.environ.get('MAIL_OUTBOX_LEASE', default=300))
+MAIL_OUTBOX_POLL_INTERVAL = float(os.environ.get('MAIL_OUTBOX_POLL_INTERVAL', default=2))
+MAIL_OUTBOX_RETRY_DELAY = int(os.environ.get('MAIL_OUTBOX_RETRY_DELAY', default=60))
+MAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('MAIL_OUTBOX_MAX_ATTEMPTS', default=5))
+
+# Final signed documents larger than MAIL_ATTACHMENT_MAX_SIZE bytes are not attached to the emails
+# sent to all signers; instead, the emails carry a link to download them,
+# valid for MAIL_DOWNLOAD_LINK_TTL seconds.
+MAIL_ATTACHMENT_MAX_SIZE = int(os.environ.get('MAIL_ATTACHMENT_MAX_SIZE', default=10 * 1024 * 1024))
+MAIL_DOWNLOAD_LINK_TTL = int(os.environ.get('MAIL_DOWNLOAD_LINK_TTL', default=7 * 24 * 3600))
+
 RAW_MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS', default=False)
 MAIL_USE_TLS = get_boolean(RAW_MAIL_USE_TLS)
 
@@ -31,12 +31,14 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import abc
+import io
 import logging
 import uuid
+from datetime import datetime, timedelta
 from importlib import import_module
-from typing import Any, Dict, List, Optional
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Union
 
-from flask import Flask
+from flask import Flask, g, has_app_context
 
 
 class ABCStorage(metaclass=abc.ABCMeta):
@@ -48,6 +50,8 @@ class ABCStorage(metaclass=abc.ABCMeta):
     have been fulfilled or declined.
     """
 
+    logger: logging.Logger
+
     @abc.abstractmethod
     def __init__(self, config: dict, logger: logging.Logger):
         """
@@ -56,31 +60,30 @@ class ABCStorage(metaclass=abc.ABCMeta):
         """
 
     @abc.abstractmethod
-    def add(self, key: uuid.UUID, content: str):
+    def add(self, key: uuid.UUID, content: bytes):
         """
         Store a new document.
 
         :param key: UUID key identifying the document
-        :param content: Contents of the document, as a base64 string.
+        :param content: Raw contents of the document.
         """
 
     @abc.abstractmethod
-    def get_content(self, key: uuid.UUID) -> Optional[str]:
+    def get_content(self, key: uuid.UUID) -> Optional[bytes]:
         """
-        Get the content of some document identified by the `key`,
-        as a base64 string.
+        Get the raw content of some document identified by the `key`.
 
         :param key: The key identifying the document.
-        :return: base64 string with the contents of the document.
+        :return: the contents of the document, or None if there is no such document.
         """
 
     @abc.abstractmethod
-    def update(self, key: uuid.UUID, content: str):
+    def update(self, key: uuid.UUID, content: bytes):
         """
         Update the contents of a document, usually because a new signature has been added.
 
         :param key: The key identifying the document.
-        :param content: base64 string with the contents of the new version of the document.
+        :param content: Raw contents of the new version of the document.
         """
 
     @abc.abstractmethod
@@ -91,6 +94,70 @@ class ABCStorage(metaclass=abc.ABCMeta):
         :param key: The key identifying the document.
         """
 
+    def read_stream(self, key: uuid.UUID) -> Optional[BinaryIO]:
+        """
+        Get the raw contents of some document identified by the `key`,
+        as a binary file like object that the caller has to close.
+
+        Backends that can read documents in chunks should override this,
+        the default implementation loads the whole document in memory.
+
+        :param key: The key identifying the document.
+        :return: file like object with the contents of the document, or None if there is no such document.
+        """
+        content = self.get_content(key)
+        if content is None:
+            return None
+        return io.BytesIO(content)
+
+    def write_stream(self, key: uuid.UUID, stream: BinaryIO):
+        """
+        Store the raw contents of a document, reading them from a binary file like object.
+        The document is created if it does not exist, and replaced if it does.
+
+        Backends that can write documents in chunks should override this,
+        the default implementation loads the whole document in memory.
+
+        :param key: The key identifying the document.
+        :param stream: file like object with the contents of the document.
+        """
+        self.update(key, stream.read())
+
+    def get_size(self, key: uuid.UUID) -> Optional[int]:
+        """
+        Get the size in bytes of the contents of the document identified by the `key`.
+
+        Backends that can get the size without reading the document should override this,
+        the default implementation reads the whole document.
+
+        :param key: The key identifying the document.
+        :return: the size of the document, or None if there is no such document.
+        """
+        content = self.get_content(key)
+        if content is None:
+            return None
+        return len(content)
+
+    def remove_many(self, keys: List[uuid.UUID]) -> List[uuid.UUID]:
+        """
+        Remove a batch of documents from the store.
+
+        Backends that can remove several documents in a single call should override this,
+        the default implementation removes them one by one.
+
+        :param keys: The keys identifying the documents.
+        :return: The keys of the documents that have been removed.
+        """
+        removed = []
+        for key in keys:
+            try:
+                self.remove(key)
+                removed.append(key)
+            except Exception as e:
+                self.logger.error(f"Problem removing document contents with key {key}: {e}")
+
+        return removed
+
 
 class ABCMetadata(metaclass=abc.ABCMeta):
     """
@@ -184,13 +251,55 @@ class ABCMetadata(metaclass=abc.ABCMeta):
         :return:
         """
 
+    def add_documents_raw(self, documents: List[Dict[str, Any]]) -> List[uuid.UUID]:
+        """
+        Store metadata for a batch of documents, together with their invitations,
+        skipping the documents that are already in the store, so that it is safe to add the same batch again.
+
+        Backends that can add several documents in a single round trip should override this,
+        the default implementation adds them one by one.
+
+        :param documents: Dictionaries with the same keys as the documents passed to `add_document_raw`,
+                          plus the key `invites`, with a list of invitations with the same keys as
+                          the invitations passed to `add_invite_raw`, except for `doc_id`.
+        :return: The keys of the documents that have been added.
+        """
+        added = []
+        for document in documents:
+            key = uuid.UUID(str(document['key']))
+            if self.get_document(key):
+                continue
+            doc_id = self.add_document_raw(document)
+            for invite in document['invites']:
+                self.add_invite_raw(dict(invite, doc_id=doc_id))
+            added.append(key)
+
+        return added
+
     @abc.abstractmethod
-    def get_old(self, days: int) -> List[uuid.UUID]:
+    def get_old(self, days: int) -> Iterator[uuid.UUID]:
         """
         Get the keys identifying stored documents that are older than the provided number of days.
+        The keys should be read lazily, in batches, so that the memory used does not grow with the number of documents,
+        and the documents can be removed while iterating.
 
         :param days: max number of days a document is kept in the db.
-        :return: A list of UUIDs identifying the documents
+        :return: An iterator over the UUIDs identifying the documents
+        """
+
+    @abc.abstractmethod
+    def get_document_stats(self) -> List[Dict[str, Any]]:
+        """
+        Get the number and total size of the stored documents, aggregated by content type and age,
+        without reading the metadata of each document.
+        The age is the number of whole days since the date the document was created,
+        so that the documents with an age of `days` or more are those returned by `get_old(days)`.
+
+        :return: A list of dictionaries with keys:
+                 + type: Content type of the docs
+                 + age: Age of the docs in days
+                 + count: Number of docs
+                 + size: Total size of the docs in bytes
         """
 
     @abc.abstractmethod
@@ -324,6 +433,16 @@ class ABCMetadata(metaclass=abc.ABCMeta):
         :return: whether the document has been removed
         """
 
+    @abc.abstractmethod
+    def remove_many(self, keys: List[uuid.UUID]) -> List[uuid.UUID]:
+        """
+        Remove from the store the metadata corresponding to a batch of documents,
+        together with their invitations, whether or not there are pending signatures.
+
+        :param keys: The keys identifying the documents.
+        :return: The keys of the documents that have been removed.
+        """
+
     @abc.abstractmethod
     def get_invitation(self, key: uuid.UUID) -> Dict[str, Any]:
         """
@@ -499,11 +618,146 @@ class ABCMetadata(metaclass=abc.ABCMeta):
         :return: The custom text to send in the invitation email
         """
 
+    @abc.abstractmethod
+    def get_preview(self, key: uuid.UUID, digest: str) -> Optional[str]:
+        """
+        Get the cached HTML preview for a version of the document
+
+        :param key: The key identifying the document
+        :param digest: Digest of the contents of the document the preview was rendered from
+        :return: The base64 encoded preview, or None if there is no preview cached for this version of the document
+        """
+
+    @abc.abstractmethod
+    def add_preview(self, key: uuid.UUID, digest: str, preview: str):
+        """
+        Cache the HTML preview for a version of the document
+
+        :param key: The key identifying the document
+        :param digest: Digest of the contents of the document the preview was rendered from
+        :param preview: The base64 encoded preview
+        """
+
+    @abc.abstractmethod
+    def rm_preview(self, key: uuid.UUID):
+        """
+        Remove any cached preview for the document
+
+        :param key: The key identifying the document
+        """
+
+    @abc.abstractmethod
+    def add_download(self, key: uuid.UUID, name: str, size: int, expires: datetime):
+        """
+        Store metadata for a signed document kept to be downloaded through a link sent by email
+
+        :param key: The key identifying the download in the storage
+        :param name: The file name of the document
+        :param size: Size of the document
+        :param expires: When the download link expires
+        """
+
+    @abc.abstractmethod
+    def get_download(self, key: uuid.UUID) -> Dict[str, Any]:
+        """
+        Get metadata for a signed document kept to be downloaded
+
+        :param key: The key identifying the download in the storage
+        :return: A dictionary with keys name, size and expires, or an empty dictionary if there is no such download
+        """
+
+    @abc.abstractmethod
+    def get_expired_downloads(self) -> List[uuid.UUID]:
+        """
+        Get the keys of the downloads whose links have expired
+
+        :return: A list of keys identifying the downloads in the storage
+        """
+
+    @abc.abstractmethod
+    def rm_download(self, key: uuid.UUID):
+        """
+        Remove metadata for a signed document kept to be downloaded
+
+        :param key: The key identifying the download in the storage
+        """
+
+    @abc.abstractmethod
+    def enqueue_emails(self, messages: List[str]):
+        """
+        Add email messages to the outbox, to be sent by the outbox worker
+
+        :param messages: The serialized messages
+        """
+
+    @abc.abstractmethod
+    def claim_emails(self, limit: int, lease: int) -> List[Dict[str, Any]]:
+        """
+        Claim a batch of messages from the outbox that are due to be sent.
+        Claimed messages will not be handed out again until the lease expires,
+        so that messages claimed by a worker that dies are eventually sent by some other worker.
+
+        :param limit: Maximum number of messages to claim
+        :param lease: Number of seconds the messages are claimed for
+        :return: A list of dictionaries with keys:
+                 + msg_id: pk of the message in the outbox
+                 + message: The serialized message
+                 + attempts: Number of previous failed attempts to send the message
+        """
+
+    @abc.abstractmethod
+    def ack_emails(self, msg_ids: List[int]):
+        """
+        Remove messages that have been sent from the outbox
+
+        :param msg_ids: pks of the messages in the outbox
+        """
+
+    @abc.abstractmethod
+    def retry_email(self, msg_id: int, delay: int, error: str):
+        """
+        Schedule a message that could not be sent for a new attempt
+
+        :param msg_id: pk of the message in the outbox
+        :param delay: Number of seconds to wait before the new attempt
+        :param error: The error that prevented sending the message
+        """
+
+    @abc.abstractmethod
+    def dead_letter_email(self, msg_id: int, error: str):
+        """
+        Set aside a message that cannot be sent, so that it is not attempted again
+
+        :param msg_id: pk of the message in the outbox
+        :param error: The error that prevented sending the message
+        """
+
+    @abc.abstractmethod
+    def get_outbox_stats(self) -> Dict[str, int]:
+        """
+        Get the depth of the outbox and the counters of messages processed through it
+
+        :return: A dictionary with keys:
+                 + pending: Number of messages waiting to be sent
+                 + dead: Number of dead lettered messages
+                 + enqueued: Total number of messages added to the outbox
+                 + sent: Total number of messages sent
+                 + retried: Total number of failed attempts scheduled for retry
+        """
+
+
+# The fields of the metadata of documents as returned by `ABCMetadata.get_document`
+DOCUMENT_FIELDS = ('doc_id', 'key', 'name', 'size', 'type', 'owner_email', 'owner_name', 'owner_lang')
+
 
 class DocStore(object):
     """
     Interface to deal with the storage of both content and metadata for documents
     that have invitations to sign.
+
+    Within an app context (i.e., within a request) the metadata of each document, and its invitations,
+    are loaded from the metadata backend only once, into a snapshot kept in `g`,
+    from which all accessors are served. Writes through the doc store drop the snapshots they affect.
     """
 
     class DocumentLocked(Exception):
@@ -537,6 +791,59 @@ class DocStore(object):
         store.metadata = metadata
         return store
 
+    def _get_snapshots(self) -> Dict[str, Dict[str, Any]]:
+        """
+        The snapshots of documents loaded by this doc store in the current app context, keyed by document key.
+        Outside of an app context, nothing is kept.
+        """
+        if not has_app_context():
+            return {}
+        return g.setdefault('_doc_snapshots', {}).setdefault(id(self), {})
+
+    def _get_snapshot(self, key: uuid.UUID) -> Dict[str, Any]:
+        """
+        Get the snapshot of the document identified by `key`, loading its metadata if not yet loaded.
+
+        :param key: the key identifying the document
+        :return: A dict with a `document` key, pointing to the full metadata of the document
+                 as returned by `ABCMetadata.get_full_document` (empty if the document does not exist),
+                 and, once loaded, an `invites` key pointing to its invitations.
+        """
+        snapshots = self._get_snapshots()
+        snapshot = snapshots.get(str(key))
+        if snapshot is None:
+            snapshot = snapshots[str(key)] = {'document': self.metadata.get_full_document(key)}
+        return snapshot
+
+    def _get_snapshot_document(self, key: uuid.UUID) -> Dict[str, Any]:
+        """
+        :param key: the key identifying the document
+        :return: The full metadata of the document, not to be modified.
+        """
+        return self._get_snapshot(key)['document']
+
+    def _get_snapshot_invites(self, key: uuid.UUID) -> List[Dict[str, Any]]:
+        """
+        :param key: the key identifying the document
+        :return: The invitations to sign the document, as returned by `ABCMetadata.get_invited`, not to be modified.
+        """
+        snapshot = self._get_snapshot(key)
+        if 'invites' not in snapshot:
+            snapshot['invites'] = self.metadata.get_invited(key) if snapshot['document'] else []
+        return snapshot['invites']
+
+    def _forget(self, *keys: Union[str, uuid.UUID]):
+        """
+        Drop the snapshots of the documents identified by `keys`, or all of them if no key is given.
+
+        :param keys: the keys identifying the documents
+        """
+        snapshots = self._get_snapshots()
+        if not keys:
+            snapshots.clear()
+        for key in keys:
+            snapshots.pop(str(key), None)
+
     def add_document(
         self,
         document: Dict[str, str],
@@ -556,7 +863,7 @@ class DocStore(object):
                          + name: The name of the document
                          + type: Content type of the doc
                          + size: Size of the doc
-                         + blob: Contents of the document, as a base64 string.
+                         + blob: Raw contents of the document.
                          + prev_signatures: previous signatures
         :param owner: Email address and name and language and eppn of the user that has uploaded the document.
         :param invites: List of names and email addresses and languages of the users that should sign the document.
@@ -566,13 +873,14 @@ class DocStore(object):
         :return: The list of invitations as dicts with 3 keys: name, email, and generated key (UUID)
         """
         key = uuid.UUID(document['key'])
+        self._forget(key)
         self.storage.add(key, document['blob'])
         return self.metadata.add(key, document, owner, invites, sendsigned, loa, skipfinal, ordered, invitation_text)
 
     def add_document_raw(
         self,
         document: Dict[str, str],
-        content: str,
+        content: bytes,
     ) -> int:
         """
         Store metadata for a new document.
@@ -593,22 +901,65 @@ class DocStore(object):
                  + created: creation timestamp
                  + ordered: send invitations in order
                  + invitation_text: The custom text to send in the invitation email
-        :param content: base64 string with the contents of the document, with a newly added signature.
+        :param content: Raw contents of the document.
         :return: new document id
         """
+        self._forget(document['key'])
         doc_id = self.metadata.add_document_raw(document)
         self.storage.add(document['key'], content)
         return doc_id
 
-    def get_old_documents(self, days: int) -> List[uuid.UUID]:
+    def add_documents_raw(self, documents: List[Dict[str, Any]]) -> List[uuid.UUID]:
+        """
+        Store metadata for a batch of documents, together with their invitations,
+        skipping those that are already in the store.
+        The contents of the documents are not added, see `add_document_stream`.
+
+        :param documents: Dictionaries with the metadata of the documents, as passed to `add_document_raw`,
+                          plus the key `invites`, with a list of invitations as passed to `add_invite_raw`.
+        :return: The keys of the documents that have been added.
+        """
+        self._forget(*[document['key'] for document in documents])
+        return self.metadata.add_documents_raw(documents)
+
+    def add_document_stream(self, key: uuid.UUID, stream: BinaryIO):
+        """
+        Store the contents of a document without metadata, reading them from a binary file like object,
+        replacing them if they already exist.
+
+        :param key: The key identifying the document in the `storage`.
+        :param stream: file like object with the contents of the document.
+        """
+        self.storage.write_stream(key, stream)
+
+    def get_document_content_size(self, key: uuid.UUID) -> Optional[int]:
+        """
+        Get the size in bytes of the stored contents of the document identified by the provided key,
+        which may differ from the size in its metadata, since signatures are added to the contents.
+
+        :param key: the key identifying the document
+        :return: the size of the contents, or None if there are no contents for the key
+        """
+        return self.storage.get_size(key)
+
+    def get_old_documents(self, days: int) -> Iterator[uuid.UUID]:
         """
         Get the keys identifying stored documents that are older than the provided number of days.
+        The keys are read lazily, so this must be consumed within the app context.
 
         :param days: max number of days a document is kept in the db.
-        :return: A list of UUIDs identifying the documents
+        :return: An iterator over the UUIDs identifying the documents
         """
         return self.metadata.get_old(days)
 
+    def get_document_stats(self) -> List[Dict[str, Any]]:
+        """
+        Get the number and total size of the stored documents, aggregated by content type and age in days.
+
+        :return: A list of dictionaries with keys type, age, count, and size
+        """
+        return self.metadata.get_document_stats()
+
     def get_pending_documents(self, emails: List[str]) -> List[Dict[str, Any]]:
         """
         Given the email address of some user, return information about the documents
@@ -632,10 +983,10 @@ class DocStore(object):
         """
         return self.metadata.get_pending(emails)
 
-    def get_document_content(self, key: uuid.UUID) -> Optional[str]:
+    def get_document_content(self, key: uuid.UUID) -> Optional[bytes]:
         """
-        Get the content of some document identified by the `key`,
-        as a base64 string, to add a signature to it.
+        Get the raw content of some document identified by the `key`,
+        to add a signature to it.
 
         NOTE XXX: This should set a lock on the document,
                   to avoid 2 users signing the document concurrently,
@@ -645,20 +996,100 @@ class DocStore(object):
                   only sending one when the previous invited user has already signed.
 
         :param key: The key identifying the document in the `storage`.
-        :return: base64 string with the contents of the document.
+        :return: the contents of the document.
         """
         return self.storage.get_content(key)
 
-    def update_document(self, key: uuid.UUID, content: str, emails: List[str]):
+    def get_document_stream(self, key: uuid.UUID) -> Optional[BinaryIO]:
+        """
+        Get the raw contents of some document identified by the `key`,
+        as a binary file like object, so that they can be consumed in chunks.
+        The caller is responsible for closing it.
+
+        :param key: The key identifying the document in the `storage`.
+        :return: file like object with the contents of the document, or None if there is no such document.
+        """
+        return self.storage.read_stream(key)
+
+    def update_document(self, key: uuid.UUID, content: bytes, emails: List[str]):
         """
         Update a document to which a new signature has been added.
 
         :param key: The key identifying the document in the `storage`.
-        :param content: base64 string with the contents of the document, with a newly added signature.
+        :param content: Raw contents of the document, with a newly added signature.
         :param emails: email addresses of the user that has just signed the document.
         """
+        self._forget(key)
         self.storage.update(key, content)
         self.metadata.update(key, emails)
+        self.metadata.rm_preview(key)
+
+    def get_document_preview(self, key: uuid.UUID, digest: str) -> Optional[str]:
+        """
+        Get the cached HTML preview for a version of the document.
+
+        :param key: The key identifying the document in the `storage`.
+        :param digest: Digest of the contents of the document the preview was rendered from.
+        :return: The base64 encoded preview, or None if there is no preview cached for this version of the document.
+        """
+        return self.metadata.get_preview(key, digest)
+
+    def add_document_preview(self, key: uuid.UUID, digest: str, preview: str):
+        """
+        Cache the HTML preview for a version of the document.
+
+        :param key: The key identifying the document in the `storage`.
+        :param digest: Digest of the contents of the document the preview was rendered from.
+        :param preview: The base64 encoded preview.
+        """
+        self.metadata.add_preview(key, digest, preview)
+
+    def add_download(self, name: str, content: bytes, ttl: int) -> uuid.UUID:
+        """
+        Keep a signed document, to be downloaded through a time limited link sent by email.
+
+        :param name: The file name of the document.
+        :param content: Raw contents of the document.
+        :param ttl: Number of seconds the document can be downloaded for.
+        :return: The key identifying the download in the `storage`.
+        """
+        key = uuid.uuid4()
+        self.storage.add(key, content)
+        self.metadata.add_download(key, name, len(content), datetime.now() + timedelta(seconds=ttl))
+        return key
+
+    def get_download(self, key: uuid.UUID) -> Dict[str, Any]:
+        """
+        Get a signed document kept to be downloaded, if its link has not expired.
+
+        :param key: The key identifying the download in the `storage`.
+        :return: A dictionary with the name, size and expiration of the download, and a stream with its contents,
+                 that the caller has to close, or an empty dictionary if there is no such download or it has expired.
+        """
+        download = self.metadata.get_download(key)
+        if not download or download['expires'] < datetime.now():
+            return {}
+
+        stream = self.storage.read_stream(key)
+        if stream is None:
+            return {}
+
+        download['stream'] = stream
+        return download
+
+    def remove_expired_downloads(self) -> int:
+        """
+        Remove the signed documents kept to be downloaded whose links have expired.
+
+        :return: The number of downloads removed.
+        """
+        removed = 0
+        for key in self.metadata.get_expired_downloads():
+            self.storage.remove(key)
+            self.metadata.rm_download(key)
+            removed += 1
+
+        return removed
 
     def decline_document(self, key: uuid.UUID, emails: List[str]):
         """
@@ -667,6 +1098,7 @@ class DocStore(object):
         :param key: The key identifying the document in the `storage`.
         :param emails: email addresses of the user that has just signed the document.
         """
+        self._forget(key)
         self.metadata.decline(key, emails)
 
     def get_owned_documents(self, eppn: str, emails: List[str]) -> List[Dict[str, Any]]:
@@ -710,12 +1142,30 @@ class DocStore(object):
         :param force: If True, remove document even if there are pending signatures.
         :return: whether the document has been removed.
         """
+        self._forget(key)
         removed = self.metadata.remove(key, force=force)
         if removed:
             self.storage.remove(key)
 
         return removed
 
+    def remove_documents(self, keys: List[uuid.UUID]) -> List[uuid.UUID]:
+        """
+        Remove a batch of documents from the store, whether or not there are pending signatures,
+        typically because they are too old.
+        The contents are removed first, and the metadata only for the documents whose contents have been removed,
+        so that documents that cannot be removed are still found and removed on a later attempt.
+
+        :param keys: The keys identifying the documents in the `storage`.
+        :return: The keys of the documents whose metadata has been removed.
+        """
+        self._forget(*keys)
+        removed = self.storage.remove_many(keys)
+        if not removed:
+            return []
+
+        return self.metadata.remove_many(removed)
+
     def add_invite_raw(self, invite: Dict[str, Any]):
         """
         Add invitation.
@@ -730,6 +1180,7 @@ class DocStore(object):
                  + doc_id: the id of the document.
         :return:
         """
+        self._forget()
         return self.metadata.add_invite_raw(invite)
 
     def add_invitation(self, document_key: uuid.UUID, name: str, email: str, lang: str) -> Dict[str, Any]:
@@ -743,6 +1194,7 @@ class DocStore(object):
         :param lang: Language of newly invited person
         :return: A dict with data on the user and the document
         """
+        self._forget(document_key)
         return self.metadata.add_invitation(document_key, name, email, lang)
 
     def get_invitation(self, key: uuid.UUID) -> Dict[str, Any]:
@@ -772,6 +1224,7 @@ class DocStore(object):
         :param document_key: The key identifying the document
         :return: success / failure
         """
+        self._forget(document_key)
         return self.metadata.rm_invitation(invite_key, document_key)
 
     def update_invitations(
@@ -787,6 +1240,7 @@ class DocStore(object):
         """
         changed: Dict[str, List[Dict[str, str]]] = {'added': [], 'removed': []}
         ordered = self.get_ordered(document_key)
+        self._forget(document_key)
         order = min([invite['order'] for invite in orig_pending])
 
         for old in orig_pending:
@@ -832,6 +1286,7 @@ class DocStore(object):
         if not invitation:
             return False
 
+        self._forget(document_key)
         created = self.metadata.add_invitation(document_key, name, email, lang)
 
         if created:
@@ -848,7 +1303,7 @@ class DocStore(object):
         :param unlocked_by: Emails of the user locking the document
         :return: Whether the document is locked
         """
-        doc = self.metadata.get_document(key)
+        doc = self._get_snapshot_document(key)
         if not doc:
             return False
 
@@ -862,7 +1317,7 @@ class DocStore(object):
         :param unlocked_by: Emails of the user unlocking the document
         :return: Whether the document is unlocked
         """
-        doc = self.metadata.get_document(key)
+        doc = self._get_snapshot_document(key)
         if not doc:
             return False
 
@@ -876,14 +1331,14 @@ class DocStore(object):
         :param locked_by: Emails of the user locking the document
         :return: Whether the document is unlocked
         """
-        doc = self.metadata.get_document(key)
+        doc = self._get_snapshot_document(key)
         if not doc:
             return False
         self.logger.debug(f"Checked doc {doc['name']} for {locked_by}")
 
         return self.metadata.check_lock(doc['doc_id'], locked_by)
 
-    def get_full_document(self, key: uuid.UUID) -> List[Dict[str, Any]]:
+    def get_full_document(self, key: uuid.UUID) -> Dict[str, Any]:
         """
         Get document with key `key`
 
@@ -905,10 +1360,9 @@ class DocStore(object):
                  + ordered_invitations: send invitations in order
                  + invitation_text: The custom text to send in the invitation email
         """
-        doc = self.metadata.get_full_document(key)
-        return doc
+        return dict(self._get_snapshot_document(key))
 
-    def get_signed_document(self, key: uuid.UUID) -> List[Dict[str, Any]]:
+    def get_signed_document(self, key: uuid.UUID) -> Dict[str, Any]:
         """
         Get document - called once all invitees have signed
 
@@ -919,12 +1373,13 @@ class DocStore(object):
                  + name: The name of the document
                  + type: Content type of the doc
                  + size: Size of the doc
-                 + blob: Contents of the document, as a base64 string.
+                 + blob: Raw contents of the document.
                  + owner_email: Email of owner
                  + owner_name: Display name of owner
                  + owner_lang: Language of owner
         """
-        doc = self.metadata.get_document(key)
+        full_doc = self._get_snapshot_document(key)
+        doc = {field: full_doc[field] for field in DOCUMENT_FIELDS if field in full_doc}
         doc['blob'] = self.storage.get_content(key)
         return doc
 
@@ -935,7 +1390,7 @@ class DocStore(object):
         :param key: the key identifying the document
         :return: the document name
         """
-        doc = self.metadata.get_document(key)
+        doc = self._get_snapshot_document(key)
         return doc.get('name', '')
 
     def get_document_email(self, key: uuid.UUID) -> str:
@@ -945,7 +1400,7 @@ class DocStore(object):
         :param key: the key identifying the document
         :return: the owner's email
         """
-        doc = self.metadata.get_document(key)
+        doc = self._get_snapshot_document(key)
         return doc['owner_email']
 
     def get_document_size(self, key: uuid.UUID) -> int:
@@ -955,7 +1410,7 @@ class DocStore(object):
         :param key: the key identifying the document
         :return: the document name
         """
-        doc = self.metadata.get_document(key)
+        doc = self._get_snapshot_document(key)
         return int(doc['size'])
 
     def get_document_type(self, key: uuid.UUID) -> str:
@@ -965,7 +1420,7 @@ class DocStore(object):
         :param key: the key identifying the document
         :return: the document mime type
         """
-        doc = self.metadata.get_document(key)
+        doc = self._get_snapshot_document(key)
         return doc['type']
 
     def get_owner_data(self, key: uuid.UUID) -> Dict[str, Any]:
@@ -979,7 +1434,7 @@ class DocStore(object):
                  + lang: The language of the owner
                  + docname: The name of the document
         """
-        doc = self.metadata.get_document(key)
+        doc = self._get_snapshot_document(key)
         if not doc:
             return {}
 
@@ -1005,8 +1460,8 @@ class DocStore(object):
                  + doc_id: the id of the invited document
                  + order: the order of the invitation
         """
-        invites = self.metadata.get_full_invites(key)
-        return invites
+        doc = self._get_snapshot_document(key)
+        return [dict(invite, doc_id=doc['doc_id']) for invite in self._get_snapshot_invites(key)]
 
     def get_pending_invites(self, key: uuid.UUID, exclude: List[str] = []) -> List[Dict[str, Any]]:
         """
@@ -1022,7 +1477,7 @@ class DocStore(object):
                  + declined: Whether the user has declined signing the document
                  + key: the key identifying the invite
         """
-        invites = self.metadata.get_invited(key)
+        invites = [dict(invite) for invite in self._get_snapshot_invites(key)]
         if exclude:
             invites = [i for i in invites if i['email'] not in exclude]
         invites.sort(key=lambda invite: invite['order'])
@@ -1035,7 +1490,10 @@ class DocStore(object):
         :param key: The key identifying the document
         :return: whether to send emails
         """
-        return self.metadata.get_sendsigned(key)
+        doc = self._get_snapshot_document(key)
+        if not doc:
+            return True
+        return bool(doc['sendsigned'])
 
     def set_sendsigned(self, key: uuid.UUID, value: bool):
         """
@@ -1044,6 +1502,7 @@ class DocStore(object):
         :param key: The key identifying the document
         :param value: whether to send emails
         """
+        self._forget(key)
         self.metadata.set_sendsigned(key, value)
 
     def get_skipfinal(self, key: uuid.UUID) -> bool:
@@ -1053,7 +1512,10 @@ class DocStore(object):
         :param key: The key identifying the document
         :return: whether it should be signed by the owner
         """
-        return self.metadata.get_skipfinal(key)
+        doc = self._get_snapshot_document(key)
+        if not doc:
+            return True
+        return bool(doc['skipfinal'])
 
     def set_skipfinal(self, key: uuid.UUID, value: bool):
         """
@@ -1062,6 +1524,7 @@ class DocStore(object):
         :param key: The key identifying the document
         :param value: whether it should be signed by the owner
         """
+        self._forget(key)
         self.metadata.set_skipfinal(key, value)
 
     def get_loa(self, key: uuid.UUID) -> str:
@@ -1071,7 +1534,10 @@ class DocStore(object):
         :param key: The key identifying the document
         :return: LoA
         """
-        return self.metadata.get_loa(key)
+        doc = self._get_snapshot_document(key)
+        if not doc:
+            return "low"
+        return str(doc['loa'])
 
     def get_ordered(self, key: uuid.UUID) -> bool:
         """
@@ -1080,7 +1546,10 @@ class DocStore(object):
         :param key: The key identifying the document
         :return: whether the invitations for signing the document are ordered
         """
-        return self.metadata.get_ordered(key)
+        doc = self._get_snapshot_document(key)
+        if not doc:
+            return False
+        return bool(doc['ordered_invitations'])
 
     def get_invitation_text(self, key: uuid.UUID) -> str:
         """
@@ -1089,4 +1558,61 @@ class DocStore(object):
         :param key: The key identifying the document
         :return: The custom text to send in the invitation email
         """
-        return self.metadata.get_invitation_text(key)
+        doc = self._get_snapshot_document(key)
+        if not doc:
+            return ''
+        return str(doc['invitation_text'])
+
+    def enqueue_emails(self, messages: List[str]):
+        """
+        Add email messages to the outbox, to be sent by the outbox worker.
+
+        :param messages: The serialized messages.
+        """
+        self.metadata.enqueue_emails(messages)
+
+    def claim_emails(self, limit: int, lease: int) -> List[Dict[str, Any]]:
+        """
+        Claim a batch of messages from the outbox that are due to be sent.
+
+        :param limit: Maximum number of messages to claim.
+        :param lease: Number of seconds the messages are claimed for.
+        :return: A list of dictionaries with the pk, the serialized message, and the number of previous attempts.
+        """
+        return self.metadata.claim_emails(limit, lease)
+
+    def ack_emails(self, msg_ids: List[int]):
+        """
+        Remove messages that have been sent from the outbox.
+
+        :param msg_ids: pks of the messages in the outbox.
+        """
+        self.metadata.ack_emails(msg_ids)
+
+    def retry_email(self, msg_id: int, delay: int, error: str):
+        """
+        Schedule a message that could not be sent for a new attempt.
+
+        :param msg_id: pk of the message in the outbox.
+        :param delay: Number of seconds to wait before the new attempt.
+        :param error: The error that prevented sending the message.
+        """
+        self.metadata.retry_email(msg_id, delay, error)
+
+    def dead_letter_email(self, msg_id: int, error: str):
+        """
+        Set aside a message that cannot be sent.
+
+        :param msg_id: pk of the message in the outbox.
+        :param error: The error that prevented sending the message.
+        """
+        self.metadata.dead_letter_email(msg_id, error)
+
+    def get_outbox_stats(self) -> Dict[str, int]:
+        """
+        Get the depth of the outbox and the counters of messages processed through it.
+
+        :return: A dictionary with the number of pending and dead messages,
+                 and the total number of enqueued, sent, and retried messages.
+        """
+        return self.metadata.get_outbox_stats()
@@ -30,21 +30,54 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import time
 import uuid
-from datetime import datetime, timedelta
-from typing import Any, Dict, List
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
 
 from flask import Flask, current_app
 from flask_redis import FlaskRedis
-from redis.exceptions import ResponseError
+from redis.exceptions import WatchError
 
 from edusign_webapp.doc_store import ABCMetadata
 
+# Take the lock of a document for the user in ARGV[1], for ARGV[2] milliseconds,
+# unless it is held by a different user. Taking a lock already held by the same user extends it.
+LOCK_ACQUIRE_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+else
+    redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+
+# Release the lock of a document if it is held by any of the users in ARGV, or if it is not held at all.
+LOCK_RELEASE_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if not holder then
+    return 1
+end
+for i = 1, #ARGV do
+    if holder == ARGV[i] then
+        redis.call('DEL', KEYS[1])
+        return 1
+    end
+end
+return 0
+"""
+
 
 class RedisStorageBackend:
     def __init__(self, redis_client):
         self.redis = redis_client
         self._transaction = None
+        self._lock_acquire = redis_client.register_script(LOCK_ACQUIRE_SCRIPT)
+        self._lock_release = redis_client.register_script(LOCK_RELEASE_SCRIPT)
 
     def pipeline(self):
         self._transaction = self.redis.pipeline()
@@ -104,6 +137,7 @@ class RedisStorageBackend:
         self.transaction.hset(f"doc:{doc_id}", mapping=mapping)
         self.transaction.set(f"doc:key:{key}", doc_id)
         self.transaction.zadd("doc:created", {key: now})
+        self._count_document(self.transaction, now, type, size, 1)
         self.transaction.sadd(f"doc:email:{owner_email}", doc_id)
         self.transaction.sadd(f"doc:eppn:{owner_eppn}", doc_id)
         current_app.logger.debug(f"Added new document {name} with key{key}")
@@ -127,6 +161,7 @@ class RedisStorageBackend:
         skipfinal,
         ordered,
         invitation_text,
+        doc_id=None,
     ):
         mapping = dict(
             key=key,
@@ -146,23 +181,32 @@ class RedisStorageBackend:
             ordered_invitations=int(ordered),
             invitation_text=invitation_text,
         )
-        doc_id = self.redis.incr('doc-counter')
+        if doc_id is None:
+            doc_id = self.redis.incr('doc-counter')
         self.transaction.hset(f"doc:{doc_id}", mapping=mapping)
         self.transaction.set(f"doc:key:{key}", doc_id)
         self.transaction.zadd("doc:created", {key: created})
+        self._count_document(self.transaction, created, type, size, 1)
         self.transaction.sadd(f"doc:email:{owner_email}", doc_id)
         self.transaction.sadd(f"doc:eppn:{owner_eppn}", doc_id)
         current_app.logger.debug(f"Added raw document {name} with key{key}")
         return int(doc_id)
 
-    def add_document_lock(self, doc_id, locked, locking_email):
-        self.transaction.hset(f"doc:{doc_id}", mapping=dict(locked=locked, locking_email=locking_email))
-        current_app.logger.debug(f"Added lock to document with id {doc_id} for {locking_email}")
+    def acquire_document_lock(self, doc_id, locking_email, timeout_ms):
+        acquired = bool(self._lock_acquire(keys=[f"doc:lock:{doc_id}"], args=[locking_email, timeout_ms]))
+        current_app.logger.debug(f"Lock on document with id {doc_id} for {locking_email}: {acquired}")
+        return acquired
 
-    def rm_document_lock(self, doc_id):
-        self.transaction.hdel(f"doc:{doc_id}", 'locked')
-        self.transaction.hdel(f"doc:{doc_id}", 'locking_email')
-        current_app.logger.debug(f"Removed lock from document with id {doc_id}")
+    def release_document_lock(self, doc_id, unlocking_emails):
+        released = bool(self._lock_release(keys=[f"doc:lock:{doc_id}"], args=unlocking_emails))
+        current_app.logger.debug(f"Released lock on document with id {doc_id} for {unlocking_emails}: {released}")
+        return released
+
+    def query_document_lock(self, doc_id):
+        b_holder = self.redis.get(f"doc:lock:{doc_id}")
+        if b_holder is None:
+            return None
+        return b_holder.decode('utf8')
 
     def delete_document(self, key):
         doc_id = int(self.redis.get(f"doc:key:{key}"))
@@ -170,12 +214,64 @@ class RedisStorageBackend:
         email = document['owner_email']
         eppn = document['owner_eppn']
         self.transaction.delete(f"doc:{doc_id}")
+        self.transaction.delete(f"doc:lock:{doc_id}")
         self.transaction.delete(f"doc:key:{key}")
         self.transaction.zrem("doc:created", key)
+        self._count_document(self.transaction, document['created'].timestamp(), document['type'], document['size'], -1)
         self.transaction.srem(f"doc:email:{email}", doc_id)
         self.transaction.srem(f"doc:eppn:{eppn}", doc_id)
+        self.transaction.delete(f"preview:{key}")
         current_app.logger.debug(f"Removed document {document}")
 
+    def delete_documents_many(self, keys):
+        b_doc_ids = self.redis.mget([f"doc:key:{key}" for key in keys])
+        found = [(key, int(b_doc_id)) for key, b_doc_id in zip(keys, b_doc_ids) if b_doc_id is not None]
+        if not found:
+            return []
+
+        b_docs = self._hgetall_many([f"doc:{doc_id}" for _, doc_id in found])
+
+        pipe = self.redis.pipeline(transaction=False)
+        for _, doc_id in found:
+            pipe.sunion(
+                f"invites:unsigned:document:{doc_id}",
+                f"invites:signed:document:{doc_id}",
+                f"invites:declined:document:{doc_id}",
+            )
+        invite_ids = [int(b_invite_id) for b_invite_ids in pipe.execute() for b_invite_id in b_invite_ids]
+        b_invites = self._hgetall_many([f"invite:{invite_id}" for invite_id in invite_ids])
+
+        transaction = self.redis.pipeline()
+        for (key, doc_id), b_doc in zip(found, b_docs):
+            transaction.delete(
+                f"doc:{doc_id}",
+                f"doc:lock:{doc_id}",
+                f"doc:key:{key}",
+                f"preview:{key}",
+                f"invites:unsigned:document:{doc_id}",
+                f"invites:signed:document:{doc_id}",
+                f"invites:declined:document:{doc_id}",
+            )
+            transaction.zrem("doc:created", key)
+            if b_doc:
+                self._count_document(
+                    transaction, float(b_doc[b'created']), b_doc[b'type'].decode('utf8'), int(b_doc[b'size']), -1
+                )
+                transaction.srem(f"doc:email:{b_doc[b'owner_email'].decode('utf8')}", doc_id)
+                transaction.srem(f"doc:eppn:{b_doc[b'owner_eppn'].decode('utf8')}", doc_id)
+        for invite_id, b_invite in zip(invite_ids, b_invites):
+            transaction.delete(f"invite:{invite_id}")
+            if b_invite:
+                email = b_invite[b'user_email'].decode('utf8')
+                transaction.delete(f"invite:key:{b_invite[b'key'].decode('utf8')}")
+                transaction.srem(f"invites:unsigned:email:{email}", invite_id)
+                transaction.srem(f"invites:signed:email:{email}", invite_id)
+                transaction.srem(f"invites:declined:email:{email}", invite_id)
+        transaction.execute()
+
+        current_app.logger.debug(f"Removed {len(found)} documents with {len(invite_ids)} invites")
+        return [key for key, _ in found]
+
     def update_document(self, key, updated):
         doc_id = int(self.redis.get(f"doc:key:{key}"))
         self.transaction.hset(f"doc:{doc_id}", mapping=dict(updated=updated))
@@ -188,6 +284,8 @@ class RedisStorageBackend:
 
     def query_document_full(self, key):
         doc_id = self.query_document_id(key)
+        if doc_id is None:
+            return
         b_doc = self.redis.hgetall(f"doc:{doc_id}")
         created = datetime.fromtimestamp(float(b_doc[b'created']))
         updated = datetime.fromtimestamp(float(b_doc[b'updated']))
@@ -204,12 +302,12 @@ class RedisStorageBackend:
             owner_eppn=b_doc[b'owner_eppn'].decode('utf8'),
             prev_signatures=b_doc[b'prev_signatures'].decode('utf8'),
             sendsigned=bool(b_doc[b'sendsigned']),
-            loa=b_doc[b'loa'].decode('utf8'),
+            loa=b_doc.get(b'loa', b'low').decode('utf8'),
             updated=updated,
             created=created,
             skipfinal=bool(b_doc[b'skipfinal']),
             ordered_invitations=bool(b_doc[b'ordered_invitations']),
-            invitation_text=b_doc[b'invitation_text'].decode('utf8'),
+            invitation_text=b_doc.get(b'invitation_text', b'').decode('utf8'),
         )
         return doc
 
@@ -230,25 +328,19 @@ class RedisStorageBackend:
         )
         return doc
 
-    def query_document_lock(self, doc_id):
-        b_doc = self.redis.hgetall(f"doc:{doc_id}")
-        doc = dict(
-            locked=(
-                None
-                if b'locked' not in b_doc or b_doc[b'locked'] is None
-                else datetime.fromtimestamp(float(b_doc[b'locked']))
-            ),
-            locking_email=(
-                None
-                if b'locking_email' not in b_doc or b_doc[b'locking_email'] is None
-                else b_doc[b'locking_email'].decode('utf8')
-            ),
-        )
-        return doc
+    def _hgetall_many(self, names):
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.hgetall(name)
+        return pipe.execute()
 
-    def query_document(self, doc_id):
-        b_doc = self.redis.hgetall(f"doc:{doc_id}")
+    def _smembers_many(self, names):
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.smembers(name)
+        return pipe.execute()
 
+    def _document_from_hash(self, b_doc):
         created = datetime.fromtimestamp(float(b_doc[b'created']))
 
         doc = dict(
@@ -267,49 +359,130 @@ class RedisStorageBackend:
         )
         return doc
 
-    def query_documents_old(self, days):
-        now = datetime.now()
-        delta = timedelta(days=days)
-        then = now - delta
-        ts = then.timestamp()
-        try:
-            keys = self.redis.zrange("doc:created", 0, ts)
-            return [uuid.UUID(b_doc[b'key'].decode('utf8')) for b_doc in keys]
-        except ResponseError:
-            return []
+    def query_document(self, doc_id):
+        b_doc = self.redis.hgetall(f"doc:{doc_id}")
+        return self._document_from_hash(b_doc)
 
-    def query_documents_from_owner(self, eppn):
-        docs = []
-        doc_ids = self.redis.smembers(f'doc:eppn:{eppn}')
-        for b_doc_id in doc_ids:
-            doc_id = int(b_doc_id)
-            b_doc = self.redis.hgetall(f"doc:{doc_id}")
+    def query_documents(self, doc_ids):
+        """
+        Get the documents with the given ids in a single round trip,
+        as a dict of documents keyed by id. Missing documents are left out.
+        """
+        doc_ids = list(doc_ids)
+        b_docs = self._hgetall_many([f"doc:{doc_id}" for doc_id in doc_ids])
+        return {doc_id: self._document_from_hash(b_doc) for doc_id, b_doc in zip(doc_ids, b_docs) if b_doc}
 
-            created = datetime.fromtimestamp(float(b_doc[b'created']))
+    def _count_document(self, transaction, created, type, size, sign):
+        """
+        Add (or, with a negative `sign`, subtract) a document to the counters in the `doc:stats` hash,
+        which keeps the number and total size of the documents by creation day and content type.
+        """
+        day = datetime.fromtimestamp(float(created)).date().toordinal()
+        transaction.hincrby("doc:stats", f"count:{day}:{type}", sign)
+        transaction.hincrby("doc:stats", f"size:{day}:{type}", sign * int(size))
 
-            doc = dict(
-                doc_id=doc_id,
-                key=uuid.UUID(b_doc[b'key'].decode('utf8')),
-                name=b_doc[b'name'].decode('utf8'),
-                size=int(b_doc[b'size']),
-                type=b_doc[b'type'].decode('utf8'),
-                prev_signatures=b_doc[b'prev_signatures'].decode('utf8'),
-                loa=b_doc[b'loa'].decode('utf8'),
-                created=created,
-                skipfinal=bool(b_doc[b'skipfinal']),
-                ordered=bool(b_doc[b'ordered_invitations']),
-                sendsigned=bool(b_doc[b'sendsigned']),
+    def _rebuild_document_stats(self):
+        """
+        Build the document counters from the stored documents, if they have not been built yet,
+        e.g. for documents added before the counters were introduced.
+        This reads every document once, and is retried if documents are added or removed meanwhile.
+        """
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch("doc:created", "doc:stats:ready")
+                    if pipe.exists("doc:stats:ready"):
+                        return
+
+                    keys = [b_key.decode('utf8') for b_key in pipe.zrange("doc:created", 0, -1)]
+                    b_doc_ids = pipe.mget([f"doc:key:{key}" for key in keys]) if keys else []
+                    b_docs = self._hgetall_many([f"doc:{int(b_doc_id)}" for b_doc_id in b_doc_ids if b_doc_id])
+
+                    counters: Dict[str, int] = {}
+                    for b_doc in b_docs:
+                        if not b_doc:
+                            continue
+                        day = datetime.fromtimestamp(float(b_doc[b'created'])).date().toordinal()
+                        type = b_doc[b'type'].decode('utf8')
+                        counters[f"count:{day}:{type}"] = counters.get(f"count:{day}:{type}", 0) + 1
+                        counters[f"size:{day}:{type}"] = counters.get(f"size:{day}:{type}", 0) + int(b_doc[b'size'])
+
+                    pipe.multi()
+                    pipe.delete("doc:stats")
+                    if counters:
+                        pipe.hset("doc:stats", mapping=counters)
+                    pipe.set("doc:stats:ready", 1)
+                    pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+    def query_document_stats(self):
+        """
+        Get the number and total size of the documents by content type and age in days, from the counters.
+        Counters that have dropped to zero, for days whose documents have all been removed,
+        are removed unless they are modified meanwhile.
+        """
+        self._rebuild_document_stats()
+        today = date.today().toordinal()
+        stats: Dict[tuple, Dict[str, Any]] = {}
+        with self.redis.pipeline() as pipe:
+            pipe.watch("doc:stats")
+            b_counters = pipe.hgetall("doc:stats")
+            empty = []
+            for b_field, b_value in b_counters.items():
+                field = b_field.decode('utf8')
+                kind, day, type = field.split(':', 2)
+                if int(b_value) == 0:
+                    empty.append(field)
+                    continue
+                age = max(today - int(day), 0)
+                entry = stats.setdefault((type, age), dict(type=type, age=age, count=0, size=0))
+                entry[kind] += int(b_value)
+
+            try:
+                if empty:
+                    pipe.multi()
+                    pipe.hdel("doc:stats", *empty)
+                    pipe.execute()
+            except WatchError:
+                pass
+
+        return [entry for entry in stats.values() if entry['count'] > 0]
+
+    def query_documents_old(self, days, batch_size):
+        """
+        Iterate over the keys of the documents created on a date at least `days` days before today,
+        the same as in the SQLite backend.
+
+        The `doc:created` sorted set is scanned by score with ZRANGEBYSCORE, in pages of `batch_size` members,
+        each page starting at the score of the last member of the previous one, so that documents removed
+        while iterating, e.g. when purging them, do not make the scan skip any others.
+        """
+        then = datetime.combine(date.today() - timedelta(days=days - 1), datetime.min.time())
+        max_score = f"({then.timestamp()}"
+        min_score: Any = '-inf'
+        seen: set = set()
+        while True:
+            page = self.redis.zrangebyscore(
+                "doc:created", min_score, max_score, start=0, num=batch_size + len(seen), withscores=True
             )
-            docs.append(doc)
-        return docs
+            for b_key, _ in page:
+                if b_key not in seen:
+                    yield uuid.UUID(b_key.decode('utf8'))
 
-    def query_documents_from_owner_by_email(self, email):
-        docs = []
-        doc_ids = self.redis.smembers(f'doc:email:{email}')
-        for b_doc_id in doc_ids:
-            doc_id = int(b_doc_id)
-            b_doc = self.redis.hgetall(f"doc:{doc_id}")
+            if len(page) < batch_size + len(seen):
+                return
 
+            # Members with the same score as the last one may be returned again in the next page
+            min_score = page[-1][1]
+            seen = {b_key for b_key, score in page if score == min_score}
+
+    def _query_owned_documents(self, index):
+        doc_ids = [int(b_doc_id) for b_doc_id in self.redis.smembers(index)]
+        b_docs = self._hgetall_many([f"doc:{doc_id}" for doc_id in doc_ids])
+        docs = []
+        for doc_id, b_doc in zip(doc_ids, b_docs):
             created = datetime.fromtimestamp(float(b_doc[b'created']))
 
             doc = dict(
@@ -328,6 +501,12 @@ class RedisStorageBackend:
             docs.append(doc)
         return docs
 
+    def query_documents_from_owner(self, eppn):
+        return self._query_owned_documents(f'doc:eppn:{eppn}')
+
+    def query_documents_from_owner_by_email(self, email):
+        return self._query_owned_documents(f'doc:email:{email}')
+
     def query_sendsigned(self, key):
         doc_id = self.query_document_id(str(key))
         if doc_id is None:
@@ -375,6 +554,105 @@ class RedisStorageBackend:
         text = b_doc.get(b"invitation_text", b"")
         return text.decode('utf8')
 
+    def query_preview(self, key, digest):
+        b_preview = self.redis.hgetall(f"preview:{key}")
+        if b_preview.get(b'digest', b'').decode('utf8') != digest:
+            return None
+        return b_preview[b'preview'].decode('utf8')
+
+    def insert_preview(self, key, digest, preview):
+        self.transaction.delete(f"preview:{key}")
+        self.transaction.hset(f"preview:{key}", mapping=dict(digest=digest, preview=preview))
+        current_app.logger.debug(f"Cached preview for document with key {key}")
+
+    def delete_preview(self, key):
+        self.transaction.delete(f"preview:{key}")
+        current_app.logger.debug(f"Removed cached preview for document with key {key}")
+
+    def insert_download(self, key, name, size, expires):
+        self.transaction.hset(f"download:{key}", mapping=dict(name=name, size=size, expires=expires))
+        self.transaction.zadd("download:expires", {key: expires})
+        current_app.logger.debug(f"Added download with key {key}")
+
+    def query_download(self, key):
+        b_download = self.redis.hgetall(f"download:{key}")
+        if not b_download:
+            return {}
+        return {
+            'name': b_download[b'name'].decode('utf8'),
+            'size': int(b_download[b'size']),
+            'expires': datetime.fromtimestamp(float(b_download[b'expires'])),
+        }
+
+    def query_expired_downloads(self, now):
+        return [b_key.decode('utf8') for b_key in self.redis.zrangebyscore("download:expires", "-inf", f"({now}")]
+
+    def delete_download(self, key):
+        self.transaction.delete(f"download:{key}")
+        self.transaction.zrem("download:expires", key)
+        current_app.logger.debug(f"Removed download with key {key}")
+
+    def insert_outbox_message(self, message, now):
+        msg_id = self.redis.incr('outbox-counter')
+        self.transaction.hset(f"outbox:msg:{msg_id}", mapping=dict(message=message, attempts=0))
+        self.transaction.zadd("outbox:queue", {msg_id: now})
+        self.transaction.hincrby("outbox:stats", "enqueued", 1)
+        return msg_id
+
+    def claim_outbox_messages(self, limit, now, lease):
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch("outbox:queue")
+                    msg_ids = pipe.zrangebyscore("outbox:queue", "-inf", now, start=0, num=limit)
+                    if not msg_ids:
+                        pipe.unwatch()
+                        return []
+                    pipe.multi()
+                    pipe.zadd("outbox:queue", {msg_id: now + lease for msg_id in msg_ids})
+                    for msg_id in msg_ids:
+                        pipe.hgetall(f"outbox:msg:{int(msg_id)}")
+                    results = pipe.execute()
+                    break
+                except WatchError:
+                    current_app.logger.debug("Outbox claimed concurrently by some other worker, retrying")
+
+        return [
+            {
+                'msg_id': int(msg_id),
+                'message': b_msg[b'message'].decode('utf8'),
+                'attempts': int(b_msg.get(b'attempts', 0)),
+            }
+            for msg_id, b_msg in zip(msg_ids, results[1:])
+        ]
+
+    def delete_outbox_message(self, msg_id):
+        self.transaction.zrem("outbox:queue", msg_id)
+        self.transaction.delete(f"outbox:msg:{msg_id}")
+        self.transaction.hincrby("outbox:stats", "sent", 1)
+
+    def reschedule_outbox_message(self, msg_id, available, error):
+        self.transaction.zadd("outbox:queue", {msg_id: available})
+        self.transaction.hincrby(f"outbox:msg:{msg_id}", "attempts", 1)
+        self.transaction.hset(f"outbox:msg:{msg_id}", "error", error)
+        self.transaction.hincrby("outbox:stats", "retried", 1)
+
+    def bury_outbox_message(self, msg_id, now, error):
+        self.transaction.zrem("outbox:queue", msg_id)
+        self.transaction.zadd("outbox:dead", {msg_id: now})
+        self.transaction.hincrby(f"outbox:msg:{msg_id}", "attempts", 1)
+        self.transaction.hset(f"outbox:msg:{msg_id}", "error", error)
+
+    def query_outbox_stats(self):
+        pipe = self.redis.pipeline()
+        pipe.zcard("outbox:queue")
+        pipe.zcard("outbox:dead")
+        pipe.hgetall("outbox:stats")
+        pending, dead, b_counters = pipe.execute()
+        stats = {'pending': pending, 'dead': dead, 'enqueued': 0, 'sent': 0, 'retried': 0}
+        stats.update({name.decode('utf8'): int(value) for name, value in b_counters.items()})
+        return stats
+
     def insert_invite(self, key, doc_id, user_email, user_name, user_lang, order):
         invite_id = self.redis.incr('invite-counter')
         mapping = dict(
@@ -394,8 +672,9 @@ class RedisStorageBackend:
         current_app.logger.debug(f"Added invite for document with id {doc_id} for {user_name} <{user_email}>")
         return invite_id
 
-    def insert_invite_raw(self, key, doc_id, user_email, user_name, user_lang, signed, declined, order):
-        invite_id = self.redis.incr('invite-counter')
+    def insert_invite_raw(self, key, doc_id, user_email, user_name, user_lang, signed, declined, order, invite_id=None):
+        if invite_id is None:
+            invite_id = self.redis.incr('invite-counter')
         mapping = dict(
             key=key,
             doc_id=doc_id,
@@ -487,39 +766,71 @@ class RedisStorageBackend:
         current_app.logger.debug(f"Declined invite for document with id {doc_id} for {actual_email}")
 
     def query_invites_from_email(self, email):
-        invites = []
-        invite_ids = self.redis.smembers(f'invites:unsigned:email:{email}')
-        for invite_id in invite_ids:
-            b_invite = self.redis.hgetall(f"invite:{int(invite_id)}")
-            invites.append(
-                {
-                    'doc_id': int(b_invite[b'doc_id']),
-                    'key': b_invite[b'key'].decode('utf8'),
-                }
-            )
+        return self.query_invites_from_emails([email])[email]
+
+    def query_invites_from_emails(self, emails):
+        """
+        Get the unsigned invites for all the given emails in two round trips,
+        as a dict of lists of invites keyed by email.
+        """
+        emails = list(emails)
+        id_sets = self._smembers_many([f'invites:unsigned:email:{email}' for email in emails])
+        invite_ids = [[int(invite_id) for invite_id in id_set] for id_set in id_sets]
+        b_invites = self._hgetall_many([f"invite:{invite_id}" for ids in invite_ids for invite_id in ids])
+        b_invites_iter = iter(b_invites)
+        invites = {}
+        for email, ids in zip(emails, invite_ids):
+            invites[email] = []
+            for _ in ids:
+                b_invite = next(b_invites_iter)
+                if not b_invite:
+                    continue
+                invites[email].append(
+                    {
+                        'doc_id': int(b_invite[b'doc_id']),
+                        'key': b_invite[b'key'].decode('utf8'),
+                    }
+                )
         return invites
 
+    def _invite_from_hash(self, b_invite):
+        return {
+            'key': b_invite[b'key'].decode('utf8'),
+            'signed': int(b_invite[b'signed']),
+            'declined': int(b_invite[b'declined']),
+            'user_name': b_invite[b'user_name'].decode('utf8'),
+            'user_email': b_invite[b'user_email'].decode('utf8'),
+            'user_lang': b_invite[b'user_lang'].decode('utf8'),
+            'order': int(b_invite[b'order_invitation']),
+        }
+
     def query_invites_from_doc(self, doc_id):
         """"""
-        invite_ids = self.redis.sunion(
-            f'invites:unsigned:document:{doc_id}',
-            f'invites:signed:document:{doc_id}',
-            f'invites:declined:document:{doc_id}',
-        )
-        invites = []
-        for invite_id in invite_ids:
-            b_invite = self.redis.hgetall(f"invite:{int(invite_id)}")
-            invites.append(
-                {
-                    'key': b_invite[b'key'].decode('utf8'),
-                    'signed': int(b_invite[b'signed']),
-                    'declined': int(b_invite[b'declined']),
-                    'user_name': b_invite[b'user_name'].decode('utf8'),
-                    'user_email': b_invite[b'user_email'].decode('utf8'),
-                    'user_lang': b_invite[b'user_lang'].decode('utf8'),
-                    'order': int(b_invite[b'order_invitation']),
-                }
+        return self.query_invites_from_docs([doc_id])[doc_id]
+
+    def query_invites_from_docs(self, doc_ids):
+        """
+        Get all the invites for all the given documents in two round trips,
+        as a dict of lists of invites keyed by document id.
+        """
+        doc_ids = list(doc_ids)
+        pipe = self.redis.pipeline(transaction=False)
+        for doc_id in doc_ids:
+            pipe.sunion(
+                f'invites:unsigned:document:{doc_id}',
+                f'invites:signed:document:{doc_id}',
+                f'invites:declined:document:{doc_id}',
             )
+        invite_ids = [[int(invite_id) for invite_id in id_set] for id_set in pipe.execute()]
+        b_invites = self._hgetall_many([f"invite:{invite_id}" for ids in invite_ids for invite_id in ids])
+        b_invites_iter = iter(b_invites)
+        invites = {}
+        for doc_id, ids in zip(doc_ids, invite_ids):
+            invites[doc_id] = []
+            for _ in ids:
+                b_invite = next(b_invites_iter)
+                if b_invite:
+                    invites[doc_id].append(self._invite_from_hash(b_invite))
         return invites
 
     def query_unsigned_invites_from_doc(self, doc_id):
@@ -717,14 +1028,88 @@ class RedisMD(ABCMetadata):
         )
         self.client.commit()
 
-    def get_old(self, days: int) -> List[uuid.UUID]:
+    def add_documents_raw(self, documents: List[Dict[str, Any]]) -> List[uuid.UUID]:
+        """
+        Store metadata for a batch of documents, together with their invitations,
+        skipping the documents that are already in the store.
+
+        Which documents already exist is checked with a single MGET, the ids for the new documents
+        and invitations are reserved with one INCRBY for each, and everything is written in a single transaction.
+
+        :param documents: Dictionaries with the same keys as the documents passed to `add_document_raw`,
+                          plus the key `invites`, with a list of invitations with the same keys as
+                          the invitations passed to `add_invite_raw`, except for `doc_id`.
+        :return: The keys of the documents that have been added.
+        """
+        if not documents:
+            return []
+
+        b_doc_ids = self.client.redis.mget([f"doc:key:{document['key']}" for document in documents])
+        new_documents = [document for document, b_doc_id in zip(documents, b_doc_ids) if b_doc_id is None]
+        if not new_documents:
+            return []
+
+        num_invites = sum(len(document['invites']) for document in new_documents)
+        doc_id = self.client.redis.incrby('doc-counter', len(new_documents)) - len(new_documents)
+        invite_id = self.client.redis.incrby('invite-counter', num_invites) - num_invites if num_invites else 0
+
+        self.client.pipeline()
+        for document in new_documents:
+            doc_id += 1
+            self.client.insert_document_raw(
+                str(document['key']),
+                document['name'],
+                document['size'],
+                document['type'],
+                float(datetime.fromisoformat(document['created']).timestamp()),
+                float(datetime.fromisoformat(document['updated']).timestamp()),
+                document['owner_email'],
+                document['owner_name'],
+                document['owner_lang'],
+                document['owner_eppn'],
+                document['prev_signatures'],
+                int(document['sendsigned']),
+                document['loa'],
+                int(document['skipfinal']),
+                int(document['ordered_invitations']),
+                document['invitation_text'],
+                doc_id=doc_id,
+            )
+            for invite in document['invites']:
+                invite_id += 1
+                self.client.insert_invite_raw(
+                    invite['key'],
+                    doc_id,
+                    invite['email'],
+                    invite['name'],
+                    invite['lang'],
+                    int(invite['signed']),
+                    int(invite['declined']),
+                    int(invite['order_invitation']),
+                    invite_id=invite_id,
+                )
+        self.client.commit()
+
+        return [uuid.UUID(str(document['key'])) for document in new_documents]
+
+    def get_old(self, days: int) -> Iterator[uuid.UUID]:
         """
         Get the keys identifying stored documents that are older than the provided number of days.
+        The keys are read lazily, in batches of OLD_DOCUMENTS_BATCH_SIZE.
 
         :param days: max number of days a document is kept in the db.
-        :return: A list of UUIDs identifying the documents
+        :return: An iterator over the UUIDs identifying the documents
+        """
+        return self.client.query_documents_old(days, self.config['OLD_DOCUMENTS_BATCH_SIZE'])
+
+    def get_document_stats(self) -> List[Dict[str, Any]]:
         """
-        return self.client.query_documents_old(days)
+        Get the number and total size of the stored documents, aggregated by content type and age in days,
+        from counters that are kept up to date as documents are added and removed.
+
+        :return: A list of dictionaries with keys type, age, count, and size
+        """
+        return self.client.query_document_stats()
 
     def get_pending(self, emails: List[str]) -> List[Dict[str, Any]]:
         """
@@ -748,17 +1133,18 @@ class RedisMD(ABCMetadata):
                  + created: creation timestamp for the invitation
                  + ordered: Whether to send invitations in order.
         """
+        invites_by_email = self.client.query_invites_from_emails(emails)
+        all_doc_ids = list({invite['doc_id'] for invites in invites_by_email.values() for invite in invites})
+        documents = self.client.query_documents(all_doc_ids)
+        subinvites_by_doc = self.client.query_invites_from_docs(documents.keys())
+
         pending = []
         doc_ids = []
         for email in emails:
-            invites = self.client.query_invites_from_email(email)
-            if invites is None or isinstance(invites, dict):
-                return []
-
-            for invite in invites:
+            for invite in invites_by_email[email]:
                 doc_id = invite['doc_id']
-                document = self.client.query_document(doc_id)
-                if document is None or isinstance(document, list):
+                document = documents.get(doc_id)
+                if document is None:
                     self.logger.error(
                         f"Db seems corrupted, an invite for {email}"
                         f" references a non existing document with id {doc_id}"
@@ -783,34 +1169,33 @@ class RedisMD(ABCMetadata):
                 document['declined'] = []
                 document['state'] = "unconfirmed"
 
-                subinvites = self.client.query_invites_from_doc(doc_id)
-
-                if subinvites is not None and not isinstance(subinvites, dict):
-                    if document["ordered"]:
-                        subinvites.sort(key=lambda i: i["order"])
-                        is_next = False
-                        for subinvite in subinvites:
-                            if not subinvite['signed'] and not subinvite['declined']:
-                                if subinvite['user_email'] == email:
-                                    is_next = True
-                                break
-                        if not is_next:
-                            continue
+                subinvites = list(subinvites_by_doc[doc_id])
+
+                if document["ordered"]:
+                    subinvites.sort(key=lambda i: i["order"])
+                    is_next = False
                     for subinvite in subinvites:
-                        subemail_result = {
-                            'email': subinvite['user_email'],
-                            'name': subinvite['user_name'],
-                            'lang': subinvite['user_lang'],
-                            'order': subinvite['order'],
-                        }
-                        if subemail_result['email'] == email:
-                            continue
-                        if subinvite['signed'] == 1:
-                            document['signed'].append(subemail_result)
-                        elif subinvite['declined'] == 1:
-                            document['declined'].append(subemail_result)
-                        else:
-                            document['pending'].append(subemail_result)
+                        if not subinvite['signed'] and not subinvite['declined']:
+                            if subinvite['user_email'] == email:
+                                is_next = True
+                            break
+                    if not is_next:
+                        continue
+                for subinvite in subinvites:
+                    subemail_result = {
+                        'email': subinvite['user_email'],
+                        'name': subinvite['user_name'],
+                        'lang': subinvite['user_lang'],
+                        'order': subinvite['order'],
+                    }
+                    if subemail_result['email'] == email:
+                        continue
+                    if subinvite['signed'] == 1:
+                        document['signed'].append(subemail_result)
+                    elif subinvite['declined'] == 1:
+                        document['declined'].append(subemail_result)
+                    else:
+                        document['pending'].append(subemail_result)
 
                 pending.append(document)
 
@@ -913,6 +1298,7 @@ class RedisMD(ABCMetadata):
         return self._get_owned(documents)
 
     def _get_owned(self, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        invites_by_doc = self.client.query_invites_from_docs([document['doc_id'] for document in documents])
         for document in documents:
             document['key'] = document['key']
             document['pending'] = []
@@ -920,11 +1306,8 @@ class RedisMD(ABCMetadata):
             document['declined'] = []
             state = 'loaded'
             document_id = document['doc_id']
-            invites = self.client.query_invites_from_doc(document_id)
+            invites = invites_by_doc[document_id]
             del document['doc_id']
-            if invites is None or isinstance(invites, dict):
-                document['state'] = state
-                continue
             for invite in invites:
                 email_result = {'email': invite['user_email'], 'name': invite['user_name'], 'lang': invite['user_lang']}
                 if invite['signed'] == 1:
@@ -1049,6 +1432,21 @@ class RedisMD(ABCMetadata):
         self.client.commit()
         return True
 
+    def remove_many(self, keys: List[uuid.UUID]) -> List[uuid.UUID]:
+        """
+        Remove from the store the metadata corresponding to a batch of documents,
+        together with their invitations, whether or not there are pending signatures.
+        The data to remove is read in pipelines, and removed in a single transaction.
+
+        :param keys: The keys identifying the documents.
+        :return: The keys of the documents that have been removed.
+        """
+        if not keys:
+            return []
+
+        removed = self.client.delete_documents_many([str(key) for key in keys])
+        return [uuid.UUID(key) for key in removed]
+
     def get_invitation(self, key: uuid.UUID) -> Dict[str, Any]:
         """
         Get the invited user's name and email and the data on the document she's been invited to sign
@@ -1175,102 +1573,44 @@ class RedisMD(ABCMetadata):
     def add_lock(self, doc_id: int, locking_email: str) -> bool:
         """
         Lock document to avoid it being signed by more than one invitee in parallel.
-        This will first check that the doc is not already locked.
+        The lock is taken unless it is already held by some other user, atomically, in a single round trip.
+        The lock is kept in its own key, that expires after DOC_LOCK_TIMEOUT.
 
         :param doc_id: the pk for the document in the documents table
         :param locking_email: Email of the user locking the document
         :return: Whether the document has been locked.
         """
-        self.client.pipeline()
-        lock_info = self.client.query_document_lock(doc_id)
-        self.logger.debug(f"Checking lock for {locking_email} in document with id {doc_id}: {lock_info}")
-        if lock_info is None:
-            self.logger.error(f"Trying to lock a non-existing document with id {doc_id}")
-            self.client.abort()
-            return False
-
-        now = datetime.now()
-
-        locked = lock_info['locked']
-
-        now_ts = now.timestamp()
-
-        if (
-            locked is None
-            or (now - locked) > current_app.config['DOC_LOCK_TIMEOUT']
-            or lock_info['locking_email'] == locking_email
-        ):
-            self.logger.debug(f"Adding lock for {locking_email} in document with id {doc_id}: {lock_info}")
-            self.client.add_document_lock(doc_id, now_ts, locking_email)
-            self.client.commit()
-            return True
-
-        self.client.abort()
-        return False
+        timeout_ms = int(current_app.config['DOC_LOCK_TIMEOUT'].total_seconds() * 1000)
+        return self.client.acquire_document_lock(doc_id, locking_email, timeout_ms)
 
     def rm_lock(self, doc_id: int, unlocking_email: List[str]) -> bool:
         """
         Remove lock from document. If the document is not locked, do nothing.
         The user unlocking must be that same user that locked it.
+        The lock is checked and removed atomically, in a single round trip.
 
         :param doc_id: the pk for the document in the documents table
         :param unlocking_email: Emails of the user unlocking the document
         :return: Whether the document has been unlocked.
         """
-        self.client.pipeline()
-        lock_info = self.client.query_document_lock(doc_id)
-        if lock_info is None or isinstance(lock_info, list):
-            self.logger.error(f"Trying to unlock a non-existing document with id {doc_id}")
-            self.client.abort()
-            return False
-
-        if lock_info['locked'] is None:
-            self.client.abort()
-            return True
-
-        now = datetime.now()
-
-        locked = lock_info['locked']
-
-        if (now - locked) < current_app.config['DOC_LOCK_TIMEOUT'] and lock_info['locking_email'] in unlocking_email:
-            self.client.rm_document_lock(doc_id)
-            self.client.commit()
-            return True
-
-        self.client.abort()
-        return False
+        if isinstance(unlocking_email, str):
+            unlocking_email = [unlocking_email]
+        return self.client.release_document_lock(doc_id, unlocking_email)
 
     def check_lock(self, doc_id: int, locking_email: List[str]) -> bool:
         """
         Check whether the document identified by doc_id is locked.
-        This will remove stale locks (older than the configured timeout).
+        Stale locks (older than the configured timeout) have already expired.
 
         :param doc_id: the pk for the document in the documents table
         :param locking_email: Email of the user locking the document
         :return: Whether the document is locked by the user with `locking_email` emails
         """
-        lock_info = self.client.query_document_lock(doc_id)
-        if lock_info is None or isinstance(lock_info, list):
-            self.logger.error(f"Trying to check a non-existing document with id {doc_id}")
-            return False
-
-        if lock_info['locked'] is None:
-            self.logger.debug(f"Check a non-locked document with id {doc_id}")
-            return False
-
-        locked = lock_info['locked']
-
-        now = datetime.now()
-
-        if (now - locked) > current_app.config['DOC_LOCK_TIMEOUT']:
-            self.logger.debug(f"Lock for document with id {doc_id} has expired")
-            self.client.pipeline()
-            self.client.rm_document_lock(doc_id)
-            self.client.commit()
-            return False
-
-        self.logger.debug(f"Checking lock for {doc_id} by {lock_info['locking_email']} for {locking_email}")
-        return lock_info['locking_email'] in locking_email
+        if isinstance(locking_email, str):
+            locking_email = [locking_email]
+        holder = self.client.query_document_lock(doc_id)
+        self.logger.debug(f"Checking lock for {doc_id} by {holder} for {locking_email}")
+        return holder is not None and holder in locking_email
 
     def get_sendsigned(self, key: uuid.UUID) -> bool:
         """
@@ -1346,3 +1686,143 @@ class RedisMD(ABCMetadata):
         :return: The invitation text
         """
         return self.client.query_invitation_text(key)
+
+    def get_preview(self, key: uuid.UUID, digest: str) -> Optional[str]:
+        """
+        Get the cached HTML preview for a version of the document
+
+        :param key: The key identifying the document
+        :param digest: Digest of the contents of the document the preview was rendered from
+        :return: The base64 encoded preview, or None if there is no preview cached for this version of the document
+        """
+        return self.client.query_preview(str(key), digest)
+
+    def add_preview(self, key: uuid.UUID, digest: str, preview: str):
+        """
+        Cache the HTML preview for a version of the document
+
+        :param key: The key identifying the document
+        :param digest: Digest of the contents of the document the preview was rendered from
+        :param preview: The base64 encoded preview
+        """
+        self.client.pipeline()
+        self.client.insert_preview(str(key), digest, preview)
+        self.client.commit()
+
+    def rm_preview(self, key: uuid.UUID):
+        """
+        Remove any cached preview for the document
+
+        :param key: The key identifying the document
+        """
+        self.client.pipeline()
+        self.client.delete_preview(str(key))
+        self.client.commit()
+
+    def add_download(self, key: uuid.UUID, name: str, size: int, expires: datetime):
+        """
+        Store metadata for a signed document kept to be downloaded through a link sent by email
+
+        :param key: The key identifying the download in the storage
+        :param name: The file name of the document
+        :param size: Size of the document
+        :param expires: When the download link expires
+        """
+        self.client.pipeline()
+        self.client.insert_download(str(key), name, size, expires.timestamp())
+        self.client.commit()
+
+    def get_download(self, key: uuid.UUID) -> Dict[str, Any]:
+        """
+        Get metadata for a signed document kept to be downloaded
+
+        :param key: The key identifying the download in the storage
+        :return: A dictionary with keys name, size and expires, or an empty dictionary if there is no such download
+        """
+        return self.client.query_download(str(key))
+
+    def get_expired_downloads(self) -> List[uuid.UUID]:
+        """
+        Get the keys of the downloads whose links have expired
+
+        :return: A list of keys identifying the downloads in the storage
+        """
+        return [uuid.UUID(key) for key in self.client.query_expired_downloads(time.time())]
+
+    def rm_download(self, key: uuid.UUID):
+        """
+        Remove metadata for a signed document kept to be downloaded
+
+        :param key: The key identifying the download in the storage
+        """
+        self.client.pipeline()
+        self.client.delete_download(str(key))
+        self.client.commit()
+
+    def enqueue_emails(self, messages: List[str]):
+        """
+        Add email messages to the outbox, to be sent by the outbox worker
+
+        :param messages: The serialized messages
+        """
+        now = time.time()
+        self.client.pipeline()
+        for message in messages:
+            self.client.insert_outbox_message(message, now)
+        self.client.commit()
+
+    def claim_emails(self, limit: int, lease: int) -> List[Dict[str, Any]]:
+        """
+        Claim a batch of messages from the outbox that are due to be sent.
+        The claim is done in a transaction watching the queue,
+        so that concurrent workers never get hold of the same messages.
+
+        :param limit: Maximum number of messages to claim
+        :param lease: Number of seconds the messages are claimed for
+        :return: A list of dictionaries with keys msg_id, message, and attempts
+        """
+        return self.client.claim_outbox_messages(limit, time.time(), lease)
+
+    def ack_emails(self, msg_ids: List[int]):
+        """
+        Remove messages that have been sent from the outbox
+
+        :param msg_ids: pks of the messages in the outbox
+        """
+        if not msg_ids:
+            return
+        self.client.pipeline()
+        for msg_id in msg_ids:
+            self.client.delete_outbox_message(msg_id)
+        self.client.commit()
+
+    def retry_email(self, msg_id: int, delay: int, error: str):
+        """
+        Schedule a message that could not be sent for a new attempt
+
+        :param msg_id: pk of the message in the outbox
+        :param delay: Number of seconds to wait before the new attempt
+        :param error: The error that prevented sending the message
+        """
+        self.client.pipeline()
+        self.client.reschedule_outbox_message(msg_id, time.time() + delay, error)
+        self.client.commit()
+
+    def dead_letter_email(self, msg_id: int, error: str):
+        """
+        Set aside a message that cannot be sent, so that it is not attempted again
+
+        :param msg_id: pk of the message in the outbox
+        :param error: The error that prevented sending the message
+        """
+        self.client.pipeline()
+        self.client.bury_outbox_message(msg_id, time.time(), error)
+        self.client.commit()
+
+    def get_outbox_stats(self) -> Dict[str, int]:
+        """
+        Get the depth of the outbox and the counters of messages processed through it
+
+        :return: A dictionary with keys pending, dead, enqueued, sent, and retried
+        """
+        return self.client.query_outbox_stats()
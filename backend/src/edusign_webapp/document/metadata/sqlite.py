@@ -31,10 +31,13 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import os
+import queue
 import sqlite3
+import threading
+import time
 import uuid
 from datetime import datetime, date
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, Iterator, List, Optional, Union
 
 from flask import Flask, current_app, g
 
@@ -81,7 +84,32 @@ CREATE INDEX IF NOT EXISTS [OwnerEppnIX] ON [Documents] ([owner_eppn]);
 CREATE INDEX IF NOT EXISTS [CreatedIX] ON [Documents] ([created]);
 CREATE INDEX IF NOT EXISTS [InviteeEmailIX] ON [Invites] ([user_email]);
 CREATE INDEX IF NOT EXISTS [InvitedIX] ON [Invites] ([doc_id]);
-PRAGMA user_version = 9;
+CREATE TABLE [Previews]
+(      [key] VARCHAR(255) PRIMARY KEY,
+       [digest] VARCHAR(255) NOT NULL,
+       [preview] TEXT NOT NULL
+);
+CREATE TABLE [Outbox]
+(      [msg_id] INTEGER PRIMARY KEY AUTOINCREMENT,
+       [message] TEXT NOT NULL,
+       [attempts] INTEGER DEFAULT 0,
+       [available] REAL NOT NULL,
+       [dead] INTEGER DEFAULT 0,
+       [error] TEXT DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS [OutboxAvailableIX] ON [Outbox] ([dead], [available]);
+CREATE TABLE [OutboxCounters]
+(      [name] VARCHAR(50) PRIMARY KEY,
+       [value] INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE [Downloads]
+(      [key] VARCHAR(255) PRIMARY KEY,
+       [name] VARCHAR(255) NOT NULL,
+       [size] INTEGER NOT NULL,
+       [expires] REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS [DownloadExpiresIX] ON [Downloads] ([expires]);
+PRAGMA user_version = 12;
 """
 
 
@@ -91,10 +119,11 @@ DOCUMENT_QUERY_ID = "SELECT doc_id FROM Documents WHERE key = ?;"
 DOCUMENT_QUERY_ALL = (
     "SELECT key, name, size, type, doc_id, owner_email, owner_name, owner_lang FROM Documents WHERE key = ?;"
 )
-DOCUMENT_QUERY_LOCK = "SELECT locked, locking_email FROM Documents WHERE doc_id = ?;"
+DOCUMENT_QUERY_LOCK = "SELECT doc_id FROM Documents WHERE doc_id = ? AND locked > ? AND locking_email IN (%s);"
 DOCUMENT_QUERY = "SELECT key, name, size, type, owner_email, owner_name, owner_lang, owner_eppn, prev_signatures, loa, created, ordered_invitations FROM Documents WHERE doc_id = ?;"
+DOCUMENT_QUERY_FULL_BATCH = "SELECT doc_id, key, name, size, type, owner_email, owner_name, owner_lang, owner_eppn, prev_signatures, sendsigned, loa, skipfinal, updated, created, ordered_invitations, invitation_text FROM Documents WHERE doc_id > ? ORDER BY doc_id LIMIT ?;"
 DOCUMENT_QUERY_FULL = "SELECT doc_id, key, name, size, type, owner_email, owner_name, owner_lang, owner_eppn, prev_signatures, sendsigned, loa, skipfinal, updated, created, ordered_invitations, invitation_text FROM Documents WHERE key = ?;"
-DOCUMENT_QUERY_OLD = "SELECT key FROM Documents WHERE date(created) <= date('now', '-%d days');"
+DOCUMENT_QUERY_OLD = "SELECT doc_id, key FROM Documents WHERE date(created) <= date('now', '-%d days') AND doc_id > ? ORDER BY doc_id LIMIT ?;"
 DOCUMENT_QUERY_FROM_OWNER = "SELECT doc_id, key, name, size, type, prev_signatures, loa, created, skipfinal, ordered_invitations, sendsigned FROM Documents WHERE owner_eppn = ?;"
 DOCUMENT_QUERY_FROM_OWNER_BY_EMAIL = "SELECT doc_id, key, name, size, type, prev_signatures, loa, created, skipfinal, ordered_invitations, sendsigned FROM Documents WHERE owner_email = ?;"
 DOCUMENT_QUERY_SENDSIGNED = "SELECT sendsigned FROM Documents WHERE key = ?;"
@@ -105,16 +134,32 @@ DOCUMENT_QUERY_ORDERED = "SELECT ordered_invitations FROM Documents WHERE key =
 DOCUMENT_QUERY_INVITATION_TEXT = "SELECT invitation_text FROM Documents WHERE key = ?;"
 DOCUMENT_QUERY_LOA = "SELECT loa FROM Documents WHERE key = ?;"
 DOCUMENT_UPDATE = "UPDATE Documents SET updated = ? WHERE key = ?;"
-DOCUMENT_RM_LOCK = "UPDATE Documents SET locked = NULL, locking_email = '' WHERE doc_id = ?;"
-DOCUMENT_ADD_LOCK = "UPDATE Documents SET locked = ?, locking_email = ? WHERE doc_id = ?;"
+DOCUMENT_RM_LOCK = "UPDATE Documents SET locked = NULL, locking_email = '' WHERE doc_id = ? AND (locked IS NULL OR (locked > ? AND locking_email IN (%s)));"
+DOCUMENT_ADD_LOCK = "UPDATE Documents SET locked = ?, locking_email = ? WHERE doc_id = ? AND (locked IS NULL OR locked <= ? OR locking_email = ?);"
 DOCUMENT_DELETE = "DELETE FROM Documents WHERE key = ?;"
+DOCUMENT_QUERY_STATS = (
+    "SELECT type, CAST(julianday(date('now')) - julianday(date(created)) AS INTEGER) AS age,"
+    " COUNT(*) AS count, SUM(size) AS size FROM Documents GROUP BY type, age;"
+)
+DOCUMENT_QUERY_KEYS = "SELECT key FROM Documents WHERE key IN (%s);"
+DOCUMENT_DELETE_MANY = "DELETE FROM Documents WHERE key IN (%s);"
 INVITE_INSERT = (
     "INSERT INTO Invites (key, doc_id, user_email, user_name, user_lang, order_invitation) VALUES (?, ?, ?, ?, ?, ?)"
 )
 INVITE_INSERT_RAW = "INSERT INTO Invites (key, doc_id, user_email, user_name, user_lang, signed, declined, order_invitation) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
-INVITE_QUERY_FROM_EMAIL = (
-    "SELECT doc_id, key FROM Invites WHERE user_email = ? AND signed = 0 AND declined = 0 ORDER BY order_invitation;"
+INVITE_QUERY_PENDING_FROM_EMAILS = (
+    "SELECT i.user_email AS invitee_email, i.key AS invite_key, i.doc_id AS doc_id,"
+    " d.key AS key, d.name AS name, d.size AS size, d.type AS type, d.owner_email AS owner_email,"
+    " d.owner_name AS owner_name, d.owner_lang AS owner_lang, d.owner_eppn AS owner_eppn,"
+    " d.prev_signatures AS prev_signatures, d.loa AS loa, d.created AS created,"
+    " d.ordered_invitations AS ordered_invitations,"
+    " s.user_email AS user_email, s.user_name AS user_name, s.user_lang AS user_lang,"
+    " s.signed AS signed, s.declined AS declined, s.order_invitation AS order_invitation"
+    " FROM Invites AS i LEFT JOIN Documents AS d ON d.doc_id = i.doc_id JOIN Invites AS s ON s.doc_id = i.doc_id"
+    " WHERE i.user_email IN (%s) AND i.signed = 0 AND i.declined = 0"
+    " ORDER BY i.order_invitation, i.inviteID, s.order_invitation, s.inviteID;"
 )
+INVITE_QUERY_FROM_DOCS = "SELECT doc_id, user_email, user_name, user_lang, signed, declined, key, order_invitation FROM Invites WHERE doc_id IN (%s) ORDER BY order_invitation;"
 INVITE_QUERY_FROM_DOC = "SELECT user_email, user_name, user_lang, signed, declined, key, order_invitation FROM Invites WHERE doc_id = ? ORDER BY order_invitation;"
 INVITE_QUERY_UNSIGNED_FROM_DOC = (
     "SELECT inviteID FROM Invites WHERE doc_id = ? AND signed = 0 AND declined = 0 ORDER BY order_invitation;"
@@ -125,6 +170,26 @@ INVITE_DECLINE = "UPDATE Invites SET declined = 1 WHERE user_email IN (%s) and d
 INVITE_DELETE = "DELETE FROM Invites WHERE user_id = ? and doc_id = ?;"
 INVITE_DELETE_FROM_KEY = "DELETE FROM Invites WHERE key = ?;"
 INVITE_DELETE_ALL = "DELETE FROM Invites WHERE doc_id = ?;"
+INVITE_DELETE_ALL_MANY = "DELETE FROM Invites WHERE doc_id IN (SELECT doc_id FROM Documents WHERE key IN (%s));"
+PREVIEW_QUERY = "SELECT preview FROM Previews WHERE key = ? AND digest = ?;"
+PREVIEW_INSERT = "INSERT OR REPLACE INTO Previews (key, digest, preview) VALUES (?, ?, ?);"
+PREVIEW_DELETE = "DELETE FROM Previews WHERE key = ?;"
+PREVIEW_DELETE_MANY = "DELETE FROM Previews WHERE key IN (%s);"
+DOWNLOAD_INSERT = "INSERT INTO Downloads (key, name, size, expires) VALUES (?, ?, ?, ?);"
+DOWNLOAD_QUERY = "SELECT name, size, expires FROM Downloads WHERE key = ?;"
+DOWNLOAD_QUERY_EXPIRED = "SELECT key FROM Downloads WHERE expires < ?;"
+DOWNLOAD_DELETE = "DELETE FROM Downloads WHERE key = ?;"
+OUTBOX_INSERT = "INSERT INTO Outbox (message, available) VALUES (?, ?);"
+OUTBOX_QUERY_DUE = (
+    "SELECT msg_id, message, attempts FROM Outbox WHERE dead = 0 AND available <= ? ORDER BY msg_id LIMIT ?;"
+)
+OUTBOX_CLAIM = "UPDATE Outbox SET available = ? WHERE msg_id IN (%s);"
+OUTBOX_DELETE = "DELETE FROM Outbox WHERE msg_id IN (%s);"
+OUTBOX_RETRY = "UPDATE Outbox SET attempts = attempts + 1, available = ?, error = ? WHERE msg_id = ?;"
+OUTBOX_DEAD = "UPDATE Outbox SET attempts = attempts + 1, dead = 1, error = ? WHERE msg_id = ?;"
+OUTBOX_QUERY_DEPTH = "SELECT dead, COUNT(*) AS count FROM Outbox GROUP BY dead;"
+OUTBOX_COUNTER_INCR = "INSERT INTO OutboxCounters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;"
+OUTBOX_COUNTERS_QUERY = "SELECT name, value FROM OutboxCounters;"
 
 
 def convert_date(val):
@@ -147,26 +212,144 @@ sqlite3.register_converter("datetime", convert_datetime)
 sqlite3.register_converter("timestamp", convert_timestamp)
 
 
-def make_dicts(cursor, row):
+class ConnectionPool(object):
     """
-    See https://flask.palletsprojects.com/en/1.1.x/patterns/sqlite3
+    Per process pool of connections to an sqlite db.
+
+    Connections are handed out to app contexts by `get_db`, and given back to the pool
+    by `close_connection` when the app context is torn down, so that they (and their
+    cache of prepared statements and of db pages) are reused across requests.
+    At most `size` idle connections are kept; any connection beyond that is closed on release.
     """
-    return dict((cursor.description[idx][0], value) for idx, value in enumerate(row))
 
+    def __init__(
+        self, db_path: str, size: int, cache_size: int, synchronous: str, busy_timeout: float, cached_statements: int
+    ):
+        """
+        :param db_path: Path to the sqlite db file
+        :param size: Maximum number of idle connections kept in the pool
+        :param cache_size: Size in KiB of the page cache of each connection
+        :param synchronous: Value for the synchronous pragma
+        :param busy_timeout: Seconds to wait for a lock held by another connection
+        :param cached_statements: Number of prepared statements cached by each connection
+        """
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.idle: queue.LifoQueue = queue.LifoQueue(maxsize=size)
+        self.closed = False
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Open a new connection to the db, and tune it.
 
-def get_db(db_path):
-    db = getattr(g, '_database', None)
-    if db is None:
+        :return: A new connection
+        """
+        db = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout,
+            cached_statements=self.cached_statements,
+            check_same_thread=False,
+        )
+        db.row_factory = sqlite3.Row
+        db.execute(f"PRAGMA synchronous = {self.synchronous};")
+        db.execute(f"PRAGMA cache_size = -{self.cache_size};")
+        return db
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        Get an idle connection from the pool, or a new one if there are none.
+
+        :return: A connection to the db
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, db: sqlite3.Connection):
+        """
+        Give a connection back to the pool, rolling back any transaction left open.
+
+        :param db: The connection to release
+        """
+        try:
+            if self.closed:
+                raise queue.Full()
+            if db.in_transaction:
+                db.rollback()
+            self.idle.put_nowait(db)
+        except (sqlite3.Error, queue.Full):
+            db.close()
+
+    def close(self):
+        """
+        Close all idle connections, and any other connection as it is released.
+        """
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def init_db(db_path: str, config: Dict[str, Any]) -> ConnectionPool:
+    """
+    Prepare the sqlite db for use by this process: create the schema if the db does not exist,
+    switch it to WAL journaling, and upgrade it to the current version of the schema.
+    This is meant to be called once, at app startup, rather than on every connection.
+
+    :param db_path: Path to the sqlite db file
+    :param config: The configuration of the app
+    :return: The pool of connections to the db
+    """
+    with _pools_lock:
         exists = os.path.isfile(db_path)
-        db = g._database = sqlite3.connect(db_path)
+        pool = _pools.get(db_path)
+        if pool is not None and not exists:
+            # The db file has been removed, the connections in the pool point to it
+            pool.close()
+            pool = None
+        if pool is None:
+            pool = _pools[db_path] = ConnectionPool(
+                db_path,
+                config['SQLITE_MD_POOL_SIZE'],
+                config['SQLITE_MD_CACHE_SIZE'],
+                config['SQLITE_MD_SYNCHRONOUS'],
+                config['SQLITE_MD_BUSY_TIMEOUT'],
+                config['SQLITE_MD_CACHED_STATEMENTS'],
+            )
+
+        db = pool.acquire()
+        try:
+            if not exists:
+                db.cursor().executescript(DB_SCHEMA)
+                db.commit()
+
+            db.execute("PRAGMA journal_mode = WAL;")
+            upgrade(db)
+        finally:
+            pool.release(db)
+
+    return pool
 
-        if not exists:
-            db.cursor().executescript(DB_SCHEMA)
-            db.commit()
 
-        db.row_factory = make_dicts
+def get_db(db_path):
+    db = getattr(g, '_database', None)
+    if db is None:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = init_db(db_path, current_app.config)
 
-        upgrade(db)
+        db = g._database = pool.acquire()
+        g._database_pool = pool
 
     return db
 
@@ -180,6 +363,7 @@ def upgrade(db):
         cur.execute("PRAGMA user_version = 1;")
         cur.close()
         db.commit()
+        version = 1
 
     if version == 1:
         cur = db.cursor()
@@ -187,6 +371,7 @@ def upgrade(db):
         cur.execute("PRAGMA user_version = 2;")
         cur.close()
         db.commit()
+        version = 2
 
     if version == 2:
         cur = db.cursor()
@@ -194,6 +379,7 @@ def upgrade(db):
         cur.execute("PRAGMA user_version = 3;")
         cur.close()
         db.commit()
+        version = 3
 
     if version == 3:
         cur = db.cursor()
@@ -244,6 +430,7 @@ def upgrade(db):
         cur.execute("PRAGMA user_version = 5;")
         cur.close()
         db.commit()
+        version = 5
 
     if version == 5:
         cur = db.cursor()
@@ -252,6 +439,7 @@ def upgrade(db):
         cur.execute("PRAGMA user_version = 6;")
         cur.close()
         db.commit()
+        version = 6
 
     if version == 6:
         cur = db.cursor()
@@ -259,6 +447,7 @@ def upgrade(db):
         cur.execute("PRAGMA user_version = 7;")
         cur.close()
         db.commit()
+        version = 7
 
     if version == 7:
         cur = db.cursor()
@@ -268,6 +457,7 @@ def upgrade(db):
         cur.execute("PRAGMA user_version = 8;")
         cur.close()
         db.commit()
+        version = 8
 
     if version == 8:
         cur = db.cursor()
@@ -276,6 +466,42 @@ def upgrade(db):
         cur.execute("PRAGMA user_version = 9;")
         cur.close()
         db.commit()
+        version = 9
+
+    if version == 9:
+        cur = db.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS [Previews] ([key] VARCHAR(255) PRIMARY KEY, [digest] VARCHAR(255) NOT NULL, [preview] TEXT NOT NULL);"
+        )
+        cur.execute("PRAGMA user_version = 10;")
+        cur.close()
+        db.commit()
+        version = 10
+
+    if version == 10:
+        cur = db.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS [Outbox] ([msg_id] INTEGER PRIMARY KEY AUTOINCREMENT, [message] TEXT NOT NULL, [attempts] INTEGER DEFAULT 0, [available] REAL NOT NULL, [dead] INTEGER DEFAULT 0, [error] TEXT DEFAULT NULL);"
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS [OutboxAvailableIX] ON [Outbox] ([dead], [available]);")
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS [OutboxCounters] ([name] VARCHAR(50) PRIMARY KEY, [value] INTEGER NOT NULL DEFAULT 0);"
+        )
+        cur.execute("PRAGMA user_version = 11;")
+        cur.close()
+        db.commit()
+        version = 11
+
+    if version == 11:
+        cur = db.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS [Downloads] ([key] VARCHAR(255) PRIMARY KEY, [name] VARCHAR(255) NOT NULL, [size] INTEGER NOT NULL, [expires] REAL NOT NULL);"
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS [DownloadExpiresIX] ON [Downloads] ([expires]);")
+        cur.execute("PRAGMA user_version = 12;")
+        cur.close()
+        db.commit()
+        version = 12
 
 
 def drop_owner_and_locked_by_in_documents(cur):
@@ -339,9 +565,9 @@ def drop_user_id_in_invites(cur):
 
 
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        g.pop('_database_pool').release(db)
 
 
 class SqliteMD(ABCMetadata):
@@ -362,14 +588,14 @@ class SqliteMD(ABCMetadata):
         self.config = app.config
         self.logger = app.logger
         self.db_path = app.config['SQLITE_MD_DB_PATH']
+        init_db(self.db_path, app.config)
 
-    def _db_execute(self, stmt: str, args: tuple = ()):
+    def _db_execute(self, stmt: str, args: tuple = ()) -> int:
         db = get_db(self.db_path)
-        db.execute(stmt, args)
+        return db.execute(stmt, args).rowcount
 
-    def _db_query(
-        self, query: str, args: tuple = (), one: bool = False
-    ) -> Union[List[Dict[str, Any]], Dict[str, Any], None]:
+    def _db_query(self, query: str, args: tuple = (), one: bool = False) -> Union[List[sqlite3.Row], sqlite3.Row, None]:
+        # The rows can be read by column name, and are converted to dicts only where they are modified or returned
         cur = get_db(self.db_path).execute(query, args)
         rv = cur.fetchall()
         cur.close()
@@ -532,21 +758,51 @@ class SqliteMD(ABCMetadata):
             ),
         )
 
-    def get_old(self, days: int) -> List[uuid.UUID]:
+    def get_old(self, days: int) -> Iterator[uuid.UUID]:
         """
         Get the keys identifying stored documents that are older than the provided number of days.
 
+        The keys are read lazily, in batches of OLD_DOCUMENTS_BATCH_SIZE, each with its own query
+        starting after the last doc_id of the previous batch, so that no cursor is kept open
+        (and the db is not kept locked) while the caller processes the keys.
+
         :param days: max number of days a document is kept in the db.
-        :return: A list of UUIDs identifying the documents
+        :return: An iterator over the UUIDs identifying the documents
         """
         assert isinstance(days, int)
         query = DOCUMENT_QUERY_OLD % days
-        old_docs = self._db_query(query, ())
+        batch_size = self.config['OLD_DOCUMENTS_BATCH_SIZE']
+        last_id = 0
+        while True:
+            old_docs = self._db_query(query, (last_id, batch_size))
+
+            if old_docs is None or isinstance(old_docs, sqlite3.Row):
+                return
+
+            for doc in old_docs:
+                yield uuid.UUID(doc['key'])
 
-        if old_docs is None or isinstance(old_docs, dict):
+            if len(old_docs) < batch_size:
+                return
+
+            last_id = old_docs[-1]['doc_id']
+
+    def get_document_stats(self) -> List[Dict[str, Any]]:
+        """
+        Get the number and total size of the stored documents, aggregated by content type and age in days,
+        with a single aggregate query.
+
+        :return: A list of dictionaries with keys type, age, count, and size
+        """
+        stats = self._db_query(DOCUMENT_QUERY_STATS, ())
+
+        if stats is None or isinstance(stats, sqlite3.Row):
             return []
 
-        return [uuid.UUID(doc['key']) for doc in old_docs]
+        return [
+            {'type': row['type'], 'age': max(row['age'], 0), 'count': row['count'], 'size': row['size']}
+            for row in stats
+        ]
 
     def get_pending(self, emails: List[str]) -> List[Dict[str, Any]]:
         """
@@ -570,17 +826,30 @@ class SqliteMD(ABCMetadata):
                  + created: creation timestamp for the invitation
                  + ordered: Whether to send invitations in order.
         """
+        if not emails:
+            return []
+
+        query = INVITE_QUERY_PENDING_FROM_EMAILS % " ,".join(["?"] * len(emails))
+        rows = self._db_query(query, tuple(emails))
+        if rows is None or isinstance(rows, sqlite3.Row):
+            return []
+
+        # Group the rows, first by the email of the invitee, and then by invitation,
+        # collecting all the invitations to the same document (subinvites).
+        invites_by_email: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        for row in rows:
+            invites = invites_by_email.setdefault(row['invitee_email'], {})
+            if row['invite_key'] not in invites:
+                invites[row['invite_key']] = {'row': row, 'subinvites': []}
+            invites[row['invite_key']]['subinvites'].append(row)
+
         pending = []
         doc_ids = []
         for email in emails:
-            invites = self._db_query(INVITE_QUERY_FROM_EMAIL, (email,))
-            if invites is None or isinstance(invites, dict):
-                return []
-
-            for invite in invites:
-                document_id = invite['doc_id']
-                document = self._db_query(DOCUMENT_QUERY, (document_id,), one=True)
-                if document is None or isinstance(document, list):
+            for invite_key, invite in invites_by_email.get(email, {}).items():
+                row = invite['row']
+                document_id = row['doc_id']
+                if row['key'] is None:
                     self.logger.error(
                         f"Db seems corrupted, an invite for {email}"
                         f" references a non existing document with id {document_id}"
@@ -588,54 +857,64 @@ class SqliteMD(ABCMetadata):
                     continue
 
                 if document_id in doc_ids:
-                    self.rm_invitation(uuid.UUID(invite['key']), uuid.UUID(document['key']))
+                    self.rm_invitation(uuid.UUID(invite_key), uuid.UUID(row['key']))
                     continue
                 else:
                     doc_ids.append(document_id)
 
+                document = {
+                    'key': uuid.UUID(row['key']),
+                    'name': row['name'],
+                    'size': row['size'],
+                    'type': row['type'],
+                    'owner_email': row['owner_email'],
+                    'owner_name': row['owner_name'],
+                    'owner_lang': row['owner_lang'],
+                    'owner_eppn': row['owner_eppn'],
+                    'prev_signatures': row['prev_signatures'],
+                    'loa': row['loa'],
+                    'ordered_invitations': row['ordered_invitations'],
+                }
                 document['owner'] = {
-                    'email': document['owner_email'],
-                    'name': document['owner_name'],
-                    'lang': document['owner_lang'],
-                    'eppn': document['owner_eppn'],
+                    'email': row['owner_email'],
+                    'name': row['owner_name'],
+                    'lang': row['owner_lang'],
+                    'eppn': row['owner_eppn'],
                 }
-                document['key'] = uuid.UUID(document['key'])
-                document['invite_key'] = uuid.UUID(invite['key'])
+                document['invite_key'] = uuid.UUID(invite_key)
                 document['pending'] = []
                 document['signed'] = []
                 document['declined'] = []
                 document['state'] = "unconfirmed"
-                document['created'] = datetime.fromisoformat(document['created']).timestamp() * 1000
-                document['ordered'] = document['ordered_invitations']
-
-                subinvites = self._db_query(INVITE_QUERY_FROM_DOC, (document_id,))
-
-                if subinvites is not None and not isinstance(subinvites, dict):
-                    if document["ordered"]:
-                        subinvites.sort(key=lambda i: i["order_invitation"])
-                        is_next = False
-                        for subinvite in subinvites:
-                            if not subinvite['signed'] and not subinvite['declined']:
-                                if subinvite['user_email'] == email:
-                                    is_next = True
-                                break
-                        if not is_next:
-                            continue
+                document['created'] = datetime.fromisoformat(row['created']).timestamp() * 1000
+                document['ordered'] = row['ordered_invitations']
+
+                subinvites = invite['subinvites']
+
+                if document["ordered"]:
+                    is_next = False
                     for subinvite in subinvites:
-                        subemail_result = {
-                            'email': subinvite['user_email'],
-                            'name': subinvite['user_name'],
-                            'lang': subinvite['user_lang'],
-                            'order': int(subinvite['order_invitation']),
-                        }
-                        if subemail_result['email'] == email:
-                            continue
-                        if subinvite['declined'] == 1:
-                            document['declined'].append(subemail_result)
-                        elif subinvite['signed'] == 1:
-                            document['signed'].append(subemail_result)
-                        else:
-                            document['pending'].append(subemail_result)
+                        if not subinvite['signed'] and not subinvite['declined']:
+                            if subinvite['user_email'] == email:
+                                is_next = True
+                            break
+                    if not is_next:
+                        continue
+                for subinvite in subinvites:
+                    subemail_result = {
+                        'email': subinvite['user_email'],
+                        'name': subinvite['user_name'],
+                        'lang': subinvite['user_lang'],
+                        'order': int(subinvite['order_invitation']),
+                    }
+                    if subemail_result['email'] == email:
+                        continue
+                    if subinvite['declined'] == 1:
+                        document['declined'].append(subemail_result)
+                    elif subinvite['signed'] == 1:
+                        document['signed'].append(subemail_result)
+                    else:
+                        document['pending'].append(subemail_result)
 
                 pending.append(document)
 
@@ -716,7 +995,7 @@ class SqliteMD(ABCMetadata):
                  + sendsigned: Whether to send signed documents in final email
         """
         documents = self._db_query(DOCUMENT_QUERY_FROM_OWNER, (eppn,))
-        if documents is None or isinstance(documents, dict):
+        if documents is None or isinstance(documents, sqlite3.Row):
             return []
 
         return self._get_owned(documents)
@@ -743,12 +1022,13 @@ class SqliteMD(ABCMetadata):
                  + sendsigned: Whether to send signed documents in final email
         """
         documents = self._db_query(DOCUMENT_QUERY_FROM_OWNER_BY_EMAIL, (email,))
-        if documents is None or isinstance(documents, dict):
+        if documents is None or isinstance(documents, sqlite3.Row):
             return []
 
         return self._get_owned(documents)
 
-    def _get_owned(self, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def _get_owned(self, rows: List[sqlite3.Row]) -> List[Dict[str, Any]]:
+        documents = [dict(row) for row in rows]
         for document in documents:
             document['key'] = uuid.UUID(document['key'])
             document['pending'] = []
@@ -760,7 +1040,7 @@ class SqliteMD(ABCMetadata):
             document_id = document['doc_id']
             invites = self._db_query(INVITE_QUERY_FROM_DOC, (document_id,))
             del document['doc_id']
-            if invites is None or isinstance(invites, dict):
+            if invites is None or isinstance(invites, sqlite3.Row):
                 document['state'] = state
                 continue
             for invite in invites:
@@ -804,7 +1084,7 @@ class SqliteMD(ABCMetadata):
         doc_id = document_result['doc_id']
 
         invites = self._db_query(INVITE_QUERY_FROM_DOC, (doc_id,))
-        if invites is None or isinstance(invites, dict):
+        if invites is None or isinstance(invites, sqlite3.Row):
             self.logger.error(f"Trying to retrieve non-existing invitees to sign document with key {key}")
             return invitees
 
@@ -841,7 +1121,7 @@ class SqliteMD(ABCMetadata):
             return invitees
 
         invites = self._db_query(INVITE_QUERY_FROM_DOC, (document_result['doc_id'],))
-        if invites is None or isinstance(invites, dict):
+        if invites is None or isinstance(invites, sqlite3.Row):
             self.logger.error(f"Trying to remind non-existing invitees to sign document with key {key}")
             return invitees
 
@@ -873,7 +1153,9 @@ class SqliteMD(ABCMetadata):
         invites = self._db_query(INVITE_QUERY_UNSIGNED_FROM_DOC, (document_id,))
 
         if not force:
-            if invites is None or isinstance(invites, dict):  # This should never happen, it's just to please mypy
+            if invites is None or isinstance(
+                invites, sqlite3.Row
+            ):  # This should never happen, it's just to please mypy
                 pass
             elif len(invites) != 0:
                 self.logger.error(f"Refusing to remove document {key} with pending emails")
@@ -883,10 +1165,36 @@ class SqliteMD(ABCMetadata):
             self._db_execute(INVITE_DELETE_ALL, (document_id,))
 
         self._db_execute(DOCUMENT_DELETE, (str(key),))
+        self._db_execute(PREVIEW_DELETE, (str(key),))
         self._db_commit()
 
         return True
 
+    def remove_many(self, keys: List[uuid.UUID]) -> List[uuid.UUID]:
+        """
+        Remove from the store the metadata corresponding to a batch of documents,
+        together with their invitations, whether or not there are pending signatures.
+        This is done with a single statement per table, in a single transaction.
+
+        :param keys: The keys identifying the documents.
+        :return: The keys of the documents that have been removed.
+        """
+        if not keys:
+            return []
+
+        str_keys = tuple(str(key) for key in keys)
+        placeholders = ', '.join(['?'] * len(str_keys))
+
+        found = self._db_query(DOCUMENT_QUERY_KEYS % placeholders, str_keys)
+        self._db_execute(INVITE_DELETE_ALL_MANY % placeholders, str_keys)
+        self._db_execute(DOCUMENT_DELETE_MANY % placeholders, str_keys)
+        self._db_execute(PREVIEW_DELETE_MANY % placeholders, str_keys)
+        self._db_commit()
+
+        if found is None or isinstance(found, sqlite3.Row):
+            return []
+        return [uuid.UUID(doc['key']) for doc in found]
+
     def get_invitation(self, key: uuid.UUID) -> Dict[str, Any]:
         """
         Get the invited user's name and email and the data on the document she's been invited to sign
@@ -899,12 +1207,12 @@ class SqliteMD(ABCMetadata):
             self.logger.error(f"Retrieving a non-existing invite with key {key}")
             return {}
 
-        doc = self._db_query(DOCUMENT_QUERY, (invite['doc_id'],), one=True)
-        if doc is None or isinstance(doc, list):
+        document_result = self._db_query(DOCUMENT_QUERY, (invite['doc_id'],), one=True)
+        if document_result is None or isinstance(document_result, list):
             self.logger.error(f"Retrieving a non-existing document with key {key}")
             return {}
 
-        doc['doc_id'] = invite['doc_id']
+        doc = dict(document_result, doc_id=invite['doc_id'])
         user = {'name': invite['user_name'], 'email': invite['user_email'], 'lang': invite['user_lang']}
 
         return {'document': doc, 'user': user}
@@ -979,7 +1287,49 @@ class SqliteMD(ABCMetadata):
             self.logger.debug(f"Trying to find a non-existing full document with key {key}")
             return {}
 
-        return document_result
+        return dict(document_result)
+
+    def get_full_documents(self, after_id: int, limit: int) -> List[Dict[str, Any]]:
+        """
+        Get full information about a batch of documents, together with their invitations,
+        in the format expected by `ABCMetadata.add_documents_raw`.
+        The documents are ordered by `doc_id`, so that all the documents can be read in batches,
+        starting each batch after the last `doc_id` of the previous one.
+
+        :param after_id: Get documents with a `doc_id` greater than this.
+        :param limit: Max number of documents to get.
+        :return: A list of dictionaries with the same keys as returned by `get_full_document`,
+                 plus the key `invites`, with a list of dictionaries with keys:
+                 + email: The email of the user
+                 + name: The name of the user
+                 + lang: The language of the user
+                 + signed: Whether the user has already signed the document
+                 + declined: Whether the user has declined signing the document
+                 + key: the key identifying the invite
+                 + order_invitation: the order of the invitation.
+        """
+        documents = self._db_query(DOCUMENT_QUERY_FULL_BATCH, (after_id, limit))
+        if documents is None or isinstance(documents, sqlite3.Row) or len(documents) == 0:
+            return []
+
+        by_id = {doc['doc_id']: dict(doc, invites=[]) for doc in documents}
+        placeholders = ', '.join(['?'] * len(by_id))
+        invites = self._db_query(INVITE_QUERY_FROM_DOCS % placeholders, tuple(by_id))
+        if isinstance(invites, list):
+            for invite in invites:
+                by_id[invite['doc_id']]['invites'].append(
+                    {
+                        'email': invite['user_email'],
+                        'name': invite['user_name'],
+                        'lang': invite['user_lang'],
+                        'signed': invite['signed'],
+                        'declined': invite['declined'],
+                        'key': invite['key'],
+                        'order_invitation': invite['order_invitation'],
+                    }
+                )
+
+        return list(by_id.values())
 
     def get_document(self, key: uuid.UUID) -> Dict[str, Any]:
         """
@@ -1001,106 +1351,59 @@ class SqliteMD(ABCMetadata):
             self.logger.debug(f"Trying to find a non-existing document with key {key}")
             return {}
 
-        return document_result
+        return dict(document_result)
 
     def add_lock(self, doc_id: int, locking_email: str) -> bool:
         """
         Lock document to avoid it being signed by more than one invitee in parallel.
-        This will first check that the doc is not already locked.
+        The lock is taken unless it is already held by some other user and has not expired,
+        atomically, with a single conditional update.
 
         :param doc_id: the pk for the document in the documents table
         :param locking_email: Email of the user locking the document
         :return: Whether the document has been locked.
         """
-        lock_info = self._db_query(DOCUMENT_QUERY_LOCK, (doc_id,), one=True)
-        self.logger.debug(f"Checking lock for {locking_email} in document with id {doc_id}: {lock_info}")
-        if lock_info is None or isinstance(lock_info, list):
-            self.logger.error(f"Trying to lock a non-existing document with id {doc_id}")
-            return False
-
         now = datetime.now()
-
-        if isinstance(lock_info['locked'], str):
-            locked = datetime.fromisoformat(lock_info['locked'])
-        else:
-            locked = lock_info['locked']
-
-        if (
-            locked is None
-            or (now - locked) > current_app.config['DOC_LOCK_TIMEOUT']
-            or lock_info['locking_email'] == locking_email
-        ):
-            self.logger.debug(f"Adding lock for {locking_email} in document with id {doc_id}: {lock_info}")
-            self._db_execute(DOCUMENT_ADD_LOCK, (now, locking_email, doc_id))
-            self._db_commit()
-            return True
-
-        return False
+        expired = now - current_app.config['DOC_LOCK_TIMEOUT']
+        locked = self._db_execute(DOCUMENT_ADD_LOCK, (now, locking_email, doc_id, expired, locking_email))
+        self._db_commit()
+        self.logger.debug(f"Lock on document with id {doc_id} for {locking_email}: {bool(locked)}")
+        return locked == 1
 
     def rm_lock(self, doc_id: int, unlocking_email: List[str]) -> bool:
         """
         Remove lock from document. If the document is not locked, do nothing.
         The user unlocking must be that same user that locked it.
+        The lock is checked and removed atomically, with a single conditional update.
 
         :param doc_id: the pk for the document in the documents table
         :param unlocking_email: Emails of the user unlocking the document
         :return: Whether the document has been unlocked.
         """
-        lock_info = self._db_query(DOCUMENT_QUERY_LOCK, (doc_id,), one=True)
-        if lock_info is None or isinstance(lock_info, list):
-            self.logger.error(f"Trying to unlock a non-existing document with id {doc_id}")
-            return False
-
-        if lock_info['locked'] is None:
-            return True
-
-        now = datetime.now()
-
-        if isinstance(lock_info['locked'], str):
-            locked = datetime.fromisoformat(lock_info['locked'])
-        else:
-            locked = lock_info['locked']
-
-        if (now - locked) < current_app.config['DOC_LOCK_TIMEOUT'] and lock_info['locking_email'] in unlocking_email:
-            self._db_execute(DOCUMENT_RM_LOCK, (doc_id,))
-            self._db_commit()
-            return True
-
-        return False
+        if isinstance(unlocking_email, str):
+            unlocking_email = [unlocking_email]
+        expired = datetime.now() - current_app.config['DOC_LOCK_TIMEOUT']
+        placeholders = ', '.join(['?'] * len(unlocking_email))
+        unlocked = self._db_execute(DOCUMENT_RM_LOCK % placeholders, (doc_id, expired, *unlocking_email))
+        self._db_commit()
+        return unlocked == 1
 
     def check_lock(self, doc_id: int, locking_email: List[str]) -> bool:
         """
         Check whether the document identified by doc_id is locked.
-        This will remove stale locks (older than the configured timeout).
+        Stale locks (older than the configured timeout) are not taken into account.
 
         :param doc_id: the pk for the document in the documents table
         :param locking_email: Email of the user locking the document
         :return: Whether the document is locked by the user with `locking_email` emails
         """
-        lock_info = self._db_query(DOCUMENT_QUERY_LOCK, (doc_id,), one=True)
-        if lock_info is None or isinstance(lock_info, list):
-            self.logger.error(f"Trying to check a non-existing document with id {doc_id}")
-            return False
-
-        if lock_info['locked'] is None:
-            self.logger.debug(f"Check a non-locked document with id {doc_id}")
-            return False
-
-        if isinstance(lock_info['locked'], str):
-            locked = datetime.fromisoformat(lock_info['locked'])
-        else:
-            locked = lock_info['locked']
-
-        now = datetime.now()
-
-        if (now - locked) > current_app.config['DOC_LOCK_TIMEOUT']:
-            self.logger.debug(f"Lock for document with id {doc_id} has expired")
-            self._db_execute(DOCUMENT_RM_LOCK, (doc_id,))
-            self._db_commit()
-            return False
-
-        self.logger.debug(f"Checking lock for {doc_id} by {lock_info['locking_email']} for {locking_email}")
-        return lock_info['locking_email'] in locking_email
+        if isinstance(locking_email, str):
+            locking_email = [locking_email]
+        expired = datetime.now() - current_app.config['DOC_LOCK_TIMEOUT']
+        placeholders = ', '.join(['?'] * len(locking_email))
+        locked = self._db_query(DOCUMENT_QUERY_LOCK % placeholders, (doc_id, expired, *locking_email), one=True)
+        self.logger.debug(f"Checking lock for {doc_id} for {locking_email}: {locked is not None}")
+        return locked is not None
 
     def get_sendsigned(self, key: uuid.UUID) -> bool:
         """
@@ -1199,3 +1502,177 @@ class SqliteMD(ABCMetadata):
             return ''
 
         return str(document_result['invitation_text'])
+
+    def get_preview(self, key: uuid.UUID, digest: str) -> Optional[str]:
+        """
+        Get the cached HTML preview for a version of the document
+
+        :param key: The key identifying the document
+        :param digest: Digest of the contents of the document the preview was rendered from
+        :return: The base64 encoded preview, or None if there is no preview cached for this version of the document
+        """
+        preview_result = self._db_query(PREVIEW_QUERY, (str(key), digest), one=True)
+        if preview_result is None or isinstance(preview_result, list):
+            return None
+
+        return str(preview_result['preview'])
+
+    def add_preview(self, key: uuid.UUID, digest: str, preview: str):
+        """
+        Cache the HTML preview for a version of the document
+
+        :param key: The key identifying the document
+        :param digest: Digest of the contents of the document the preview was rendered from
+        :param preview: The base64 encoded preview
+        """
+        self._db_execute(PREVIEW_INSERT, (str(key), digest, preview))
+        self._db_commit()
+
+    def rm_preview(self, key: uuid.UUID):
+        """
+        Remove any cached preview for the document
+
+        :param key: The key identifying the document
+        """
+        self._db_execute(PREVIEW_DELETE, (str(key),))
+        self._db_commit()
+
+    def add_download(self, key: uuid.UUID, name: str, size: int, expires: datetime):
+        """
+        Store metadata for a signed document kept to be downloaded through a link sent by email
+
+        :param key: The key identifying the download in the storage
+        :param name: The file name of the document
+        :param size: Size of the document
+        :param expires: When the download link expires
+        """
+        self._db_execute(DOWNLOAD_INSERT, (str(key), name, size, expires.timestamp()))
+        self._db_commit()
+
+    def get_download(self, key: uuid.UUID) -> Dict[str, Any]:
+        """
+        Get metadata for a signed document kept to be downloaded
+
+        :param key: The key identifying the download in the storage
+        :return: A dictionary with keys name, size and expires, or an empty dictionary if there is no such download
+        """
+        download = self._db_query(DOWNLOAD_QUERY, (str(key),), one=True)
+        if download is None or isinstance(download, list):
+            self.logger.debug(f"Trying to find a non-existing download with key {key}")
+            return {}
+
+        return dict(download, expires=datetime.fromtimestamp(download['expires']))
+
+    def get_expired_downloads(self) -> List[uuid.UUID]:
+        """
+        Get the keys of the downloads whose links have expired
+
+        :return: A list of keys identifying the downloads in the storage
+        """
+        downloads = self._db_query(DOWNLOAD_QUERY_EXPIRED, (time.time(),))
+        if downloads is None or isinstance(downloads, sqlite3.Row):
+            return []
+        return [uuid.UUID(download['key']) for download in downloads]
+
+    def rm_download(self, key: uuid.UUID):
+        """
+        Remove metadata for a signed document kept to be downloaded
+
+        :param key: The key identifying the download in the storage
+        """
+        self._db_execute(DOWNLOAD_DELETE, (str(key),))
+        self._db_commit()
+
+    def _incr_counter(self, name: str, value: int):
+        self._db_execute(OUTBOX_COUNTER_INCR, (name, value))
+
+    def enqueue_emails(self, messages: List[str]):
+        """
+        Add email messages to the outbox, to be sent by the outbox worker
+
+        :param messages: The serialized messages
+        """
+        now = time.time()
+        for message in messages:
+            self._db_execute(OUTBOX_INSERT, (message, now))
+        self._incr_counter('enqueued', len(messages))
+        self._db_commit()
+
+    def claim_emails(self, limit: int, lease: int) -> List[Dict[str, Any]]:
+        """
+        Claim a batch of messages from the outbox that are due to be sent.
+        The claim is done within an immediate transaction,
+        so that concurrent workers never get hold of the same messages.
+
+        :param limit: Maximum number of messages to claim
+        :param lease: Number of seconds the messages are claimed for
+        :return: A list of dictionaries with keys msg_id, message, and attempts
+        """
+        db = get_db(self.db_path)
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE;")
+        try:
+            messages = self._db_query(OUTBOX_QUERY_DUE, (now, limit))
+            if messages is None or isinstance(messages, sqlite3.Row):
+                messages = []
+            if messages:
+                msg_ids = [msg['msg_id'] for msg in messages]
+                claim = OUTBOX_CLAIM % ', '.join(['?'] * len(msg_ids))
+                self._db_execute(claim, (now + lease, *msg_ids))
+        except Exception:
+            db.rollback()
+            raise
+        db.commit()
+        return [dict(msg) for msg in messages]
+
+    def ack_emails(self, msg_ids: List[int]):
+        """
+        Remove messages that have been sent from the outbox
+
+        :param msg_ids: pks of the messages in the outbox
+        """
+        if not msg_ids:
+            return
+        delete = OUTBOX_DELETE % ', '.join(['?'] * len(msg_ids))
+        self._db_execute(delete, tuple(msg_ids))
+        self._incr_counter('sent', len(msg_ids))
+        self._db_commit()
+
+    def retry_email(self, msg_id: int, delay: int, error: str):
+        """
+        Schedule a message that could not be sent for a new attempt
+
+        :param msg_id: pk of the message in the outbox
+        :param delay: Number of seconds to wait before the new attempt
+        :param error: The error that prevented sending the message
+        """
+        self._db_execute(OUTBOX_RETRY, (time.time() + delay, error, msg_id))
+        self._incr_counter('retried', 1)
+        self._db_commit()
+
+    def dead_letter_email(self, msg_id: int, error: str):
+        """
+        Set aside a message that cannot be sent, so that it is not attempted again
+
+        :param msg_id: pk of the message in the outbox
+        :param error: The error that prevented sending the message
+        """
+        self._db_execute(OUTBOX_DEAD, (error, msg_id))
+        self._db_commit()
+
+    def get_outbox_stats(self) -> Dict[str, int]:
+        """
+        Get the depth of the outbox and the counters of messages processed through it
+
+        :return: A dictionary with keys pending, dead, enqueued, sent, and retried
+        """
+        stats = {'pending': 0, 'dead': 0, 'enqueued': 0, 'sent': 0, 'retried': 0}
+        depth = self._db_query(OUTBOX_QUERY_DEPTH)
+        if isinstance(depth, list):
+            for row in depth:
+                stats['dead' if row['dead'] else 'pending'] = row['count']
+        counters = self._db_query(OUTBOX_COUNTERS_QUERY)
+        if isinstance(counters, list):
+            for row in counters:
+                stats[row['name']] = row['value']
+        return stats
@@ -30,11 +30,11 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
-import base64
 import logging
 import os
+import shutil
 import uuid
-from typing import Optional
+from typing import BinaryIO, Optional
 
 from edusign_webapp.doc_store import ABCStorage
 
@@ -54,27 +54,25 @@ class LocalStorage(ABCStorage):
         self.logger = logger
         self.base_dir = config['LOCAL_STORAGE_BASE_DIR']
 
-    def add(self, key: uuid.UUID, content: str):
+    def add(self, key: uuid.UUID, content: bytes):
         """
         Store a new document.
 
         :param key: UUID key identifying the document
-        :param content: Contents of the document, as a base64 string.
+        :param content: Raw contents of the document.
         """
         path = os.path.join(self.base_dir, str(key))
-        bcontent = base64.b64decode(content.encode('utf8'))
         with open(path, 'wb') as f:
-            f.write(bcontent)
+            f.write(content)
 
         self.logger.info(f"Saved document contents with key {key}")
 
-    def get_content(self, key: uuid.UUID) -> Optional[str]:
+    def get_content(self, key: uuid.UUID) -> Optional[bytes]:
         """
-        Get the content of some document identified by the `key`,
-        as a base64 string.
+        Get the raw content of some document identified by the `key`.
 
         :param key: The key identifying the document.
-        :return: base64 string with the contents of the document.
+        :return: the contents of the document, or None if there is no such document.
         """
         path = os.path.join(self.base_dir, str(key))
 
@@ -82,20 +80,18 @@ class LocalStorage(ABCStorage):
             return None
 
         with open(path, 'rb') as f:
-            bcontent = f.read()
-        return base64.b64encode(bcontent).decode('utf8')
+            return f.read()
 
-    def update(self, key: uuid.UUID, content: str):
+    def update(self, key: uuid.UUID, content: bytes):
         """
         Update a document, usually because a new signature has been added.
 
         :param key: The key identifying the document.
-        :param content: base64 string with the contents of the new version of the document.
+        :param content: Raw contents of the new version of the document.
         """
         path = os.path.join(self.base_dir, str(key))
-        bcontent = base64.b64decode(content.encode('utf8'))
         with open(path, 'wb') as f:
-            f.write(bcontent)
+            f.write(content)
 
         self.logger.info(f"Updated document contents with key {key}")
 
@@ -110,3 +106,43 @@ class LocalStorage(ABCStorage):
             os.remove(path)
 
         self.logger.info(f"Removed document contents with key {key}")
+
+    def get_size(self, key: uuid.UUID) -> Optional[int]:
+        """
+        Get the size in bytes of the contents of the document identified by the `key`.
+
+        :param key: The key identifying the document.
+        :return: the size of the document, or None if there is no such document.
+        """
+        path = os.path.join(self.base_dir, str(key))
+        if not os.path.isfile(path):
+            return None
+        return os.path.getsize(path)
+
+    def read_stream(self, key: uuid.UUID) -> Optional[BinaryIO]:
+        """
+        Get the raw contents of some document identified by the `key`,
+        as a binary file like object that the caller has to close.
+
+        :param key: The key identifying the document.
+        :return: file like object with the contents of the document, or None if there is no such document.
+        """
+        path = os.path.join(self.base_dir, str(key))
+
+        if not os.path.isfile(path):
+            return None
+
+        return open(path, 'rb')
+
+    def write_stream(self, key: uuid.UUID, stream: BinaryIO):
+        """
+        Store the raw contents of a document, copying them in chunks from a binary file like object.
+
+        :param key: The key identifying the document.
+        :param stream: file like object with the contents of the document.
+        """
+        path = os.path.join(self.base_dir, str(key))
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(stream, f, self.config['STORAGE_CHUNK_SIZE'])
+
+        self.logger.info(f"Wrote document contents with key {key}")
@@ -30,16 +30,20 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
-import base64
 import io
 import logging
 import uuid
-from typing import Optional
+from typing import BinaryIO, List, Optional
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 
 from edusign_webapp.doc_store import ABCStorage
 
+# Max number of keys that S3 accepts in a single DeleteObjects request
+S3_DELETE_MAX_KEYS = 1000
+
 
 class S3Storage(ABCStorage):
     """
@@ -64,45 +68,47 @@ class S3Storage(ABCStorage):
         )
         self.s3_bucket_name = config['AWS_BUCKET_NAME']
         self.s3_bucket = self.s3.Bucket(config['AWS_BUCKET_NAME'])
+        self.transfer_config = TransferConfig(
+            multipart_threshold=config['AWS_MULTIPART_THRESHOLD'],
+            multipart_chunksize=config['AWS_MULTIPART_CHUNKSIZE'],
+        )
 
-    def add(self, key: uuid.UUID, content: str):
+    def add(self, key: uuid.UUID, content: bytes):
         """
         Store a new document.
 
         :param key: UUID key identifying the document
-        :param content: Contents of the document, as a base64 string.
+        :param content: Raw contents of the document.
         """
-        bcontent = base64.b64decode(content.encode('utf8'))
-        f = io.BytesIO(bcontent)
-        self.s3_bucket.upload_fileobj(f, str(key))
+        f = io.BytesIO(content)
+        self.s3_bucket.upload_fileobj(f, str(key), Config=self.transfer_config)
 
         self.logger.info(f"Saved document contents with key {key}")
 
-    def get_content(self, key: uuid.UUID) -> Optional[str]:
+    def get_content(self, key: uuid.UUID) -> Optional[bytes]:
         """
-        Get the content of some document identified by the `key`,
-        as a base64 string.
+        Get the raw content of some document identified by the `key`.
 
         :param key: The key identifying the document.
-        :return: base64 string with the contents of the document.
+        :return: the contents of the document, or None if there is no such document.
         """
-        f = io.BytesIO()
-        self.s3_bucket.download_fileobj(str(key), f)
-        f.seek(0)
-        bcontent = f.read()
-        f.close()
-        return base64.b64encode(bcontent).decode('utf8')
-
-    def update(self, key: uuid.UUID, content: str):
+        body = self.read_stream(key)
+        if body is None:
+            return None
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def update(self, key: uuid.UUID, content: bytes):
         """
         Update a document, usually because a new signature has been added.
 
         :param key: The key identifying the document.
-        :param content: base64 string with the contents of the new version of the document.
+        :param content: Raw contents of the new version of the document.
         """
-        bcontent = base64.b64decode(content.encode('utf8'))
-        f = io.BytesIO(bcontent)
-        self.s3_bucket.upload_fileobj(f, str(key))
+        f = io.BytesIO(content)
+        self.s3_bucket.upload_fileobj(f, str(key), Config=self.transfer_config)
 
         self.logger.info(f"Updated document contents with key {key}")
 
@@ -116,3 +122,70 @@ class S3Storage(ABCStorage):
         doc.delete()
 
         self.logger.info(f"Removed document contents with key {key}")
+
+    def remove_many(self, keys: List[uuid.UUID]) -> List[uuid.UUID]:
+        """
+        Remove a batch of documents from the store,
+        with a DeleteObjects request for each S3_DELETE_MAX_KEYS documents.
+
+        :param keys: The keys identifying the documents.
+        :return: The keys of the documents that have been removed.
+        """
+        removed = []
+        for start in range(0, len(keys), S3_DELETE_MAX_KEYS):
+            batch = keys[start : start + S3_DELETE_MAX_KEYS]
+            response = self.s3_bucket.delete_objects(
+                Delete={'Objects': [{'Key': str(key)} for key in batch], 'Quiet': True}
+            )
+            failed = set()
+            for error in response.get('Errors', []):
+                self.logger.error(f"Problem removing document contents with key {error['Key']}: {error['Message']}")
+                failed.add(error['Key'])
+
+            removed.extend([key for key in batch if str(key) not in failed])
+
+        self.logger.info(f"Removed contents of {len(removed)} documents out of {len(keys)}")
+        return removed
+
+    def get_size(self, key: uuid.UUID) -> Optional[int]:
+        """
+        Get the size in bytes of the contents of the document identified by the `key`,
+        with a HEAD request, without downloading it.
+
+        :param key: The key identifying the document.
+        :return: the size of the document, or None if there is no such document.
+        """
+        try:
+            return self.s3.meta.client.head_object(Bucket=self.s3_bucket_name, Key=str(key))['ContentLength']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    def read_stream(self, key: uuid.UUID) -> Optional[BinaryIO]:
+        """
+        Get the raw contents of some document identified by the `key`,
+        as a binary file like object that the caller has to close.
+        The contents are streamed from S3 as they are read, and never held in memory as a whole.
+
+        :param key: The key identifying the document.
+        :return: file like object with the contents of the document, or None if there is no such document.
+        """
+        try:
+            response = self.s3.Object(self.s3_bucket_name, str(key)).get()
+        except self.s3.meta.client.exceptions.NoSuchKey:
+            return None
+
+        return response['Body']
+
+    def write_stream(self, key: uuid.UUID, stream: BinaryIO):
+        """
+        Store the raw contents of a document, reading them from a binary file like object.
+        Large documents are uploaded to S3 in parts, so that only one part at a time is held in memory.
+
+        :param key: The key identifying the document.
+        :param stream: file like object with the contents of the document.
+        """
+        self.s3_bucket.upload_fileobj(stream, str(key), Config=self.transfer_config)
+
+        self.logger.info(f"Wrote document contents with key {key}")
@@ -1,82 +1,146 @@
+import logging
 import os.path
-from base64 import b64decode, b64encode
 from tempfile import TemporaryDirectory
 
 import fitz
-from flask import current_app
+from lxml import etree
 from ocrmypdf import ocr
-from ocrmypdf.pdfa import file_claims_pdfa
 
+# Forms are filled in in worker processes, out of the app context
+logger = logging.getLogger(__name__)
 
-def _load_b64_pdf(b64_pdf):
+# XMP namespace for the identification of the PDF/A part and conformance level claimed by a document
+PDFAID_NS = 'http://www.aiim.org/pdfa/ns/id/'
+
+# The PDF/A part and conformance levels that are accepted as valid claims, as in ocrmypdf.
+PDFA_VERSIONS = frozenset(
+    ('PDF/A-1A', 'PDF/A-1B', 'PDF/A-2A', 'PDF/A-2B', 'PDF/A-2U', 'PDF/A-3A', 'PDF/A-3B', 'PDF/A-3U')
+)
+
+
+def _load_pdf(pdf):
     """
-    Load to PyMuPDF a base64 encoding of a PDF document
+    Load to PyMuPDF the raw contents of a PDF document
     """
-    if ',' in b64_pdf:
-        b64_pdf = b64_pdf.split(',')[1]
-
-    b64_bytes = b64_pdf.encode('ascii')
-    pdf_bytes = b64decode(b64_bytes)
-    return fitz.open(stream=pdf_bytes, filetype='application/pdf')
+    return fitz.open(stream=pdf, filetype='application/pdf')
 
 
-def has_pdf_form(b64_pdf):
+def has_pdf_form(pdf):
     """
     Check that the provided PDF contains a form.
     """
-    doc = _load_b64_pdf(b64_pdf)
+    doc = _load_pdf(pdf)
     return doc.is_form_pdf
 
 
-def update_pdf_form(b64_pdf, fields):
+def get_pdfa_claim(xmp: bytes) -> str:
+    """
+    Find out from the XMP metadata of a PDF document whether it claims to be PDF/A.
+    The claim may be given either as elements or as attributes of a `rdf:Description` element.
+
+    :param xmp: the raw XMP metadata
+    :return: the claimed PDF/A version (e.g. `PDF/A-2B`), or empty if there is no claim.
+    """
+    parser = etree.XMLParser(recover=True, resolve_entities=False, no_network=True)
+    try:
+        root = etree.fromstring(xmp, parser)
+    except etree.XMLSyntaxError:
+        return ""
+    if root is None:
+        return ""
+
+    claim = {'part': '', 'conformance': ''}
+    for element in root.iter():
+        for name in claim:
+            tag = f'{{{PDFAID_NS}}}{name}'
+            if element.tag == tag and element.text:
+                claim[name] = element.text.strip()
+            elif element.get(tag):
+                claim[name] = element.get(tag).strip()
+
+    if not claim['part']:
+        return ""
+    return f"PDF/A-{claim['part']}{claim['conformance'].upper()}"
+
+
+def _index_fields(fields):
+    """
+    Map the names of the fields to the values given for them.
+    If there are several values for the same name, the first one is used.
+    """
+    index = {}
+    for field in fields:
+        index.setdefault(field['name'], field)
+    return index
+
+
+def _fill_widget(widget, field, radio):
+    """
+    Set the value of a form widget, from the data for its field.
+    Radio buttons are counted per page in `radio`, and the value of a radio field
+    is the (1 based) position of the chosen button.
+    """
+    if widget.field_type == fitz.PDF_WIDGET_TYPE_CHECKBOX:
+        widget.field_value = True if field['value'] == 'on' else False
+    elif widget.field_type == fitz.PDF_WIDGET_TYPE_RADIOBUTTON:
+        radio[widget.field_name] = radio.get(widget.field_name, 0) + 1
+        if radio[widget.field_name] == field['value']:
+            widget.field_value = True
+    else:
+        widget.field_value = field['value']
+
+
+def update_pdf_form(pdf, fields):
     """
     Fill in the PDF form in the provided PDF
-    with the values given in the fields param.
+    with the values given in the fields param,
+    and return the raw contents of the filled in PDF.
+    All the widgets in the form are made read only.
+    If the provided PDF claims to be PDF/A, the filled in PDF is converted to PDF/A.
     """
-    doc = _load_b64_pdf(b64_pdf)
+    doc = _load_pdf(pdf)
+    index = _index_fields(fields)
+
     for page in doc:
         radio = {}
-        for field in page.widgets():
-            for f in fields:
-                if field.field_name == f['name']:
-                    if field.field_type == 2:  # checkbox
-                        field.field_value = True if f['value'] == 'on' else False
-                    elif field.field_type == 5:  # radio button
-                        if field.field_name in radio:
-                            radio[field.field_name] += 1
-                        else:
-                            radio[field.field_name] = 1
-                        if radio[field.field_name] == f['value']:
-                            field.field_value = True
-                    else:
-                        field.field_value = f['value']
-
-                    break
-
-            field.field_flags = fitz.PDF_FIELD_IS_READ_ONLY
-            field.update()
-
-    orig_doc = _load_b64_pdf(b64_pdf)
+        for widget in page.widgets():
+            field = index.get(widget.field_name)
+            if field is not None:
+                _fill_widget(widget, field, radio)
+
+            widget.field_flags = fitz.PDF_FIELD_IS_READ_ONLY
+            widget.update()
 
     try:
-        doc = try_pdfa(orig_doc, doc)
+        if claims_pdfa(pdf, doc):
+            doc = convert_to_pdfa(doc)
     except Exception as e:
-        current_app.logger.info(f"Problem ensuring PDF/A: {e}")
+        logger.info(f"Problem ensuring PDF/A: {e}")
 
-    doc_bytes = doc.tobytes()
-    newpdf = b64encode(doc_bytes)
-    return newpdf
+    return doc.tobytes()
 
 
-def try_pdfa(orig_doc, doc):
+def claims_pdfa(pdf, doc=None):
+    """
+    Check whether the raw contents of a PDF document claim conformance with PDF/A,
+    reading the XMP metadata of the document in memory.
+
+    :param pdf: the raw contents of the document
+    :param doc: the document already loaded in PyMuPDF, to avoid parsing it again.
+    """
+    if doc is None:
+        doc = _load_pdf(pdf)
+    xmp = doc.get_xml_metadata()
+    return bool(xmp) and get_pdfa_claim(xmp.encode('utf8')) in PDFA_VERSIONS
+
+
+def convert_to_pdfa(doc):
+    """
+    Convert a PDF document loaded in PyMuPDF to PDF/A, and return the converted document.
+    """
     with TemporaryDirectory() as dirname:
-        orig_fname = os.path.join(dirname, 'orig.pdf')
-        orig_doc.save(orig_fname)
-        if file_claims_pdfa(orig_fname):
-            fname = os.path.join(dirname, 'filled.pdf')
-            doc.save(fname)
-            fname_a = os.path.join(dirname, 'filled-a.pdf')
-            ocr(input_file=fname, output_file=fname_a, output_type='pdfa', skip_text=True)
-            new_doc = fitz.open(fname_a)
-            return new_doc
-    return doc
+        fname = os.path.join(dirname, 'filled.pdf')
+        doc.save(fname)
+        fname_a = os.path.join(dirname, 'filled-a.pdf')
+        ocr(input_file=fname, output_file=fname_a, output_type='pdfa', skip_text=True)
+        return fitz.open(fname_a)
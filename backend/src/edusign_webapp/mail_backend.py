@@ -1,42 +1,180 @@
-import asyncio
+import queue
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
 
 from flask import current_app
 from flask_mailman.backends.smtp import EmailBackend
 
 
+class BatchReport(object):
+    """
+    Outcome of sending a batch of messages with `ParallelEmailBackend.send_messages_in_parallel`.
+    """
+
+    def __init__(self, total: int):
+        """
+        :param total: Number of messages in the batch
+        """
+        self.total = total
+        self.sent = 0
+        self.retries = 0
+        self.connections = 0
+        self.failed: List[Dict[str, Any]] = []
+        self.unreachable = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def add_sent(self, retries: int):
+        with self._lock:
+            self.sent += 1
+            self.retries += retries
+
+    def add_failed(self, message, error: Exception, retries: int, unreachable: bool = False):
+        with self._lock:
+            if unreachable:
+                self.unreachable += 1
+            self.failed.append(
+                {
+                    'recipients': message.recipients(),
+                    'subject': message.subject,
+                    'error': str(error),
+                    'transient': _is_transient(error),
+                    'message': message,
+                }
+            )
+            self.retries += retries
+
+    def add_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def __str__(self):
+        return (
+            f"{self.sent} of {self.total} emails sent in {self.elapsed:.2f}s "
+            f"over {self.connections} connections, with {self.retries} retries and {len(self.failed)} failures"
+        )
+
+
+class MailSendError(Exception):
+    """
+    Raised when a batch of messages could not be sent,
+    either because none of them was sent or because the SMTP server could not be reached.
+    """
+
+    def __init__(self, report: BatchReport):
+        super().__init__(f"Problem sending emails: {report}")
+        self.report = report
+
+
+def _is_transient(error: Exception) -> bool:
+    """
+    Whether it makes sense to retry sending a message that has failed with the given error.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return False
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, OSError))
+
+
+def _discard(backend):
+    """
+    Close the connection of a pooled backend, ignoring errors, since it may already be broken.
+    """
+    try:
+        backend.close()
+    except Exception:
+        pass
+
+
 class ParallelEmailBackend(EmailBackend):
+    def _pooled_connection(self):
+        """
+        Get a new backend with the same settings as this one, to hold one of the connections of the pool.
+        The timeout of the pooled connections bounds the time spent on each SMTP command.
+        """
+        return type(self)(
+            mailman=self.mailman,
+            host=self.host,
+            port=self.port,
+            username=self.username,
+            password=self.password,
+            use_tls=self.use_tls,
+            use_ssl=self.use_ssl,
+            timeout=current_app.config['MAIL_SEND_TIMEOUT'],
+            ssl_keyfile=self.ssl_keyfile,
+            ssl_certfile=self.ssl_certfile,
+        )
+
     def send_messages_in_parallel(self, email_messages):
         """
-        Send one or more EmailMessage objects in parallel
+        Send one or more EmailMessage objects in parallel,
+        over a pool of up to MAIL_POOL_SIZE SMTP connections.
+
+        Each message is retried up to MAIL_SEND_RETRIES times on transient errors,
+        reopening the connection in case it has been dropped.
+
+        :return: A BatchReport with the outcome of sending the messages
         """
+        report = BatchReport(len(email_messages))
         if not email_messages:
-            return 0
-
-        async def send_email(msg):
-            return self._send(msg)
+            return report
 
-        with self._lock:
-            new_conn_created = self.open()
-            if not self.connection or new_conn_created is None:
-                current_app.logger.error(f"Emails not sent: no SMTP connection")
-                # We failed silently on open().
-                # Trying to send would be pointless.
-                return 0
+        app = current_app._get_current_object()
+        retries = app.config['MAIL_SEND_RETRIES']
+        backoff = app.config['MAIL_RETRY_BACKOFF']
+        pool_size = min(app.config['MAIL_POOL_SIZE'], len(email_messages))
 
-            loop = asyncio.new_event_loop()
-            tasks = []
+        pending = queue.Queue()
+        for message in email_messages:
+            pending.put(message)
 
-            for message in email_messages:
-                current_app.logger.debug(f"Message to send: {str(message)}")
-                task = loop.create_task(send_email(message))
-                tasks.append(task)
+        def _send_with_retries(backend, message):
+            attempt = 0
+            while True:
+                opening = True
+                try:
+                    if backend.open():
+                        report.add_connection()
+                    opening = False
+                    if backend._send(message):
+                        report.add_sent(attempt)
+                    else:
+                        report.add_failed(message, ValueError('No recipients'), attempt)
+                    return
+                except Exception as e:
+                    _discard(backend)
+                    if attempt >= retries or not _is_transient(e):
+                        app.logger.error(f"Email to {message.recipients()} not sent: {e}")
+                        report.add_failed(message, e, attempt, unreachable=opening)
+                        return
+                    attempt += 1
+                    app.logger.warning(f"Retrying email to {message.recipients()} after error: {e}")
+                    time.sleep(backoff * attempt)
 
-            result = loop.run_until_complete(asyncio.wait(tasks))
-            loop.close()
+        def _worker():
+            with app.app_context():
+                backend = self._pooled_connection()
+                try:
+                    while True:
+                        try:
+                            message = pending.get_nowait()
+                        except queue.Empty:
+                            return
+                        _send_with_retries(backend, message)
+                finally:
+                    _discard(backend)
 
-            current_app.logger.debug(f"Emails sent: {result}")
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            workers = [executor.submit(_worker) for _ in range(pool_size)]
+            for worker in workers:
+                worker.result()
+        report.elapsed = time.monotonic() - start
 
-            if new_conn_created:
-                self.close()
+        app.logger.info(f"Emails sent: {report}")
 
-        return result
+        return report
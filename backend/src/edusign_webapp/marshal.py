@@ -31,6 +31,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import hashlib
+import hmac
 import json
 import os
 from functools import wraps
@@ -68,6 +70,47 @@ def csrf_check_headers() -> None:
         raise ValidationError(f'CSRF cross origin request, origin: {origin}, target: {target}')
 
 
+def _password_hash_token(user_key: str, secret: str) -> str:
+    """
+    Produce a CSRF token as a salted password hash (with the configured `HASH_METHOD`)
+    of the key kept in the session of the user plus the app secret.
+    This is deliberately expensive to compute.
+    """
+    method = current_app.config['HASH_METHOD']
+    salt_length = current_app.config['SALT_LENGTH']
+    token_hash = generate_password_hash(user_key + secret, method=method, salt_length=salt_length)
+    return token_hash.replace(method + ':', '')
+
+
+def _password_hash_check(token: str, user_key: str, secret: str) -> bool:
+    method = current_app.config['HASH_METHOD']
+    return check_password_hash(f'{method}:{token}', user_key + secret)
+
+
+def _hmac_token(user_key: str, secret: str) -> str:
+    """
+    Produce a CSRF token as an HMAC-SHA256, keyed with the app secret,
+    of the (random, per response) key kept in the session of the user.
+    """
+    return hmac.new(secret.encode('utf8'), user_key.encode('utf8'), hashlib.sha256).hexdigest()
+
+
+def _hmac_check(token: str, user_key: str, secret: str) -> bool:
+    if '$' in token:
+        # Token issued with the password hash method, before switching to HMAC,
+        # only accepted while upgrading since it is expensive to check
+        if not current_app.config['CSRF_ACCEPT_PASSWORD_HASH_TOKENS']:
+            return False
+        return _password_hash_check(token, user_key, secret)
+    return hmac.compare_digest(token, _hmac_token(user_key, secret))
+
+
+CSRF_TOKEN_METHODS = {
+    'hmac': (_hmac_token, _hmac_check),
+    'password-hash': (_password_hash_token, _password_hash_check),
+}
+
+
 class ResponseSchema(Schema):
     """
     Basic Schema for responses to front side app requests,
@@ -93,17 +136,14 @@ class ResponseSchema(Schema):
         :param sess: Mapping to use as session, to be used in tests
         :return: The provided `out_data` dict, with the added `csrf_token` key.
         """
-        method = current_app.config['HASH_METHOD']
+        make_token, _ = CSRF_TOKEN_METHODS[current_app.config['CSRF_TOKEN_METHOD']]
         secret = current_app.config['SECRET_KEY']
-        salt_length = current_app.config['SALT_LENGTH']
         user_key = str(os.urandom(16))
         if sess is None:
             session['user_key'] = user_key
         else:
             sess['user_key'] = user_key
-        token_hash = generate_password_hash(user_key + secret, method=method, salt_length=salt_length)
-        token = token_hash.replace(method + ':', '')
-        out_data['csrf_token'] = token
+        out_data['csrf_token'] = make_token(user_key, secret)
         return out_data
 
 
@@ -184,13 +224,10 @@ class RequestSchema(Schema):
 
         csrf_check_headers()
 
-        method = current_app.config['HASH_METHOD']
-        token = f'{method}:{value}'
-
+        _, check_token = CSRF_TOKEN_METHODS[current_app.config['CSRF_TOKEN_METHOD']]
         secret = current_app.config['SECRET_KEY']
-        key = session['user_key'] + secret
 
-        if not check_password_hash(token, key):
+        if not check_token(value, session['user_key'], secret):
             raise ValidationError('CSRF token failed to validate')
 
     @post_load
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+Sample = Tuple[Dict[str, Any], Union[int, float]]
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_metric(name: str, help: str, type: str, samples: Iterable[Sample]) -> str:
+    """
+    Format a metric in the Prometheus text exposition format.
+
+    :param name: The name of the metric
+    :param help: The description of the metric
+    :param type: The type of the metric, e.g. gauge or counter
+    :param samples: Pairs of dicts with the labels and the value of each sample of the metric
+    :return: The HELP and TYPE lines followed by a line per sample
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    for labels, value in samples:
+        if labels:
+            label_str = ','.join(f'{label}="{_escape(value)}"' for label, value in labels.items())
+            lines.append(f"{name}{{{label_str}}} {value}")
+        else:
+            lines.append(f"{name} {value}")
+
+    return '\n'.join(lines) + '\n'
+
+
+def document_metrics(stats: List[Dict[str, Any]], age_days: List[int]) -> str:
+    """
+    Format the aggregated document stats, as returned by `DocStore.get_document_stats`,
+    as the number and total size of the stored documents by content type,
+    and of the documents older than each of the given numbers of days.
+
+    :param stats: A list of dicts with keys type, age, count, and size
+    :param age_days: The numbers of days for which to report the documents older than that
+    :return: The metrics in the Prometheus text exposition format
+    """
+    by_type: Dict[str, List[int]] = {}
+    for entry in stats:
+        totals = by_type.setdefault(entry['type'], [0, 0])
+        totals[0] += entry['count']
+        totals[1] += entry['size']
+
+    older: Dict[int, List[int]] = {days: [0, 0] for days in sorted(set(age_days))}
+    for entry in stats:
+        for days, totals in older.items():
+            if entry['age'] >= days:
+                totals[0] += entry['count']
+                totals[1] += entry['size']
+
+    return ''.join(
+        [
+            format_metric(
+                'edusign_documents',
+                'Number of stored documents, by content type.',
+                'gauge',
+                [({'type': type}, totals[0]) for type, totals in sorted(by_type.items())],
+            ),
+            format_metric(
+                'edusign_documents_bytes',
+                'Total size of the stored documents in bytes, by content type.',
+                'gauge',
+                [({'type': type}, totals[1]) for type, totals in sorted(by_type.items())],
+            ),
+            format_metric(
+                'edusign_documents_older_than',
+                'Number of stored documents created at least the given number of days ago.',
+                'gauge',
+                [({'days': days}, totals[0]) for days, totals in older.items()],
+            ),
+            format_metric(
+                'edusign_documents_older_than_bytes',
+                'Total size in bytes of the stored documents created at least the given number of days ago.',
+                'gauge',
+                [({'days': days}, totals[1]) for days, totals in older.items()],
+            ),
+        ]
+    )
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import argparse
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Dict, Optional
+
+from flask import Flask
+
+from edusign_webapp.doc_store import ABCStorage, DocStore
+
+
+def _new_checkpoint() -> Dict[str, int]:
+    return {'last_doc_id': 0, 'documents': 0, 'invites': 0, 'bytes': 0, 'skipped': 0, 'missing': 0}
+
+
+def load_checkpoint(path: str) -> Dict[str, int]:
+    """
+    Load the checkpoint of a previous migration, or get a new one if there is none at `path`.
+
+    :param path: Path to the JSON file with the checkpoint
+    :return: A dict with the id of the last migrated document in the source db, and the migration counters
+    """
+    checkpoint = _new_checkpoint()
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoint.update(json.load(f))
+    return checkpoint
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, int]):
+    """
+    Save the checkpoint atomically, so that an interrupted migration always finds a complete checkpoint.
+
+    :param path: Path to the JSON file with the checkpoint
+    :param checkpoint: The checkpoint to save
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+class _CountingReader(object):
+    """
+    File like object wrapping a stream, to count the bytes read from it.
+    """
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data
+
+
+class MigrationError(Exception):
+    """
+    Some documents in a batch could not be migrated. The checkpoint is left at the start of the batch,
+    so that migrating again retries it.
+    """
+
+
+def migrate_documents(
+    app: Flask,
+    source_md: Any,
+    source_storage: ABCStorage,
+    checkpoint_path: str,
+    batch_size: int,
+    concurrency: int,
+    progress: Optional[Callable[[Dict[str, int]], None]] = None,
+) -> Dict[str, int]:
+    """
+    Migrate the documents and invitations in the SQLite db and their contents in the local storage
+    to the doc store of the app, typically using Redis and S3.
+
+    The documents are read from SQLite in batches of `batch_size`. For each batch, the contents are copied,
+    streaming them, with up to `concurrency` copies at the same time, and then the metadata of the documents
+    whose contents have been copied is added in a single round trip. After each batch, a checkpoint is saved,
+    so that an interrupted migration can be resumed by migrating again.
+    Documents that are already in the destination are not added again, so re-migrating a batch is harmless.
+
+    Documents without invitations are skipped, as are documents without contents in the source storage.
+
+    :param app: The Flask app, with the destination doc store.
+    :param source_md: The SqliteMD instance to migrate from.
+    :param source_storage: The storage instance to migrate from.
+    :param checkpoint_path: Path to the JSON file where the checkpoint is kept.
+    :param batch_size: Number of documents to migrate in each batch.
+    :param concurrency: Max number of documents whose contents are copied at the same time.
+    :param progress: Function called with the checkpoint after each batch.
+    :raises MigrationError: if the contents of some document in a batch could not be copied.
+    :return: The final checkpoint, with the id of the last migrated document and the migration counters.
+    """
+    dest = app.extensions['doc_store']
+    checkpoint = load_checkpoint(checkpoint_path)
+
+    def _copy(document):
+        key = uuid.UUID(document['key'])
+        with app.app_context():
+            stream = source_storage.read_stream(key)
+            if stream is None:
+                return None
+            try:
+                reader = _CountingReader(stream)
+                dest.add_document_stream(key, reader)
+            finally:
+                stream.close()
+            return reader.count
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            documents = source_md.get_full_documents(checkpoint['last_doc_id'], batch_size)
+            if not documents:
+                break
+
+            to_migrate = [document for document in documents if document['invites']]
+            futures = [executor.submit(_copy, document) for document in to_migrate]
+            copied, sizes, missing, failed = [], {}, 0, []
+            for document, future in zip(to_migrate, futures):
+                try:
+                    size = future.result()
+                except Exception as e:
+                    app.logger.error(f"Problem copying contents of document with key {document['key']}: {e}")
+                    failed.append(document['key'])
+                    continue
+                if size is None:
+                    app.logger.warning(f"Document with key {document['key']} has no contents, skipping")
+                    missing += 1
+                    continue
+                copied.append(document)
+                sizes[uuid.UUID(document['key'])] = size
+
+            added = set(dest.add_documents_raw(copied))
+            checkpoint['documents'] += len(added)
+            checkpoint['invites'] += sum(len(doc['invites']) for doc in copied if uuid.UUID(doc['key']) in added)
+            checkpoint['bytes'] += sum(sizes[key] for key in added)
+
+            if failed:
+                save_checkpoint(checkpoint_path, checkpoint)
+                raise MigrationError(f"Could not copy the contents of documents {', '.join(failed)}")
+
+            checkpoint['skipped'] += len(documents) - len(to_migrate)
+            checkpoint['missing'] += missing
+            checkpoint['last_doc_id'] = documents[-1]['doc_id']
+            save_checkpoint(checkpoint_path, checkpoint)
+            if progress is not None:
+                progress(checkpoint)
+
+    return checkpoint
+
+
+def verify_migration(
+    app: Flask, source_md: Any, source_storage: ABCStorage, batch_size: int, concurrency: int
+) -> Dict[str, Any]:
+    """
+    Check that all the documents that should have been migrated are in the doc store of the app,
+    with the same metadata size, the same number of invitations, and contents of the same size.
+
+    :param app: The Flask app, with the destination doc store.
+    :param source_md: The SqliteMD instance migrated from.
+    :param source_storage: The storage instance migrated from.
+    :param batch_size: Number of documents to check in each batch.
+    :param concurrency: Max number of documents checked at the same time.
+    :return: A dict with the number of documents checked and the total size of their contents in bytes,
+             the number of documents missing or with different metadata or contents in the destination,
+             and a list with the keys of (up to 100 of) the problematic documents.
+    """
+    dest = app.extensions['doc_store']
+    report: Dict[str, Any] = {'documents': 0, 'bytes': 0, 'missing': 0, 'mismatched': 0, 'problems': []}
+
+    def _check(document):
+        key = uuid.UUID(document['key'])
+        with app.app_context():
+            size = source_storage.get_size(key)
+            if size is None:
+                return 0, None
+            try:
+                dest_size = dest.get_document_size(key)
+            except KeyError:
+                return size, 'missing'
+            if (
+                dest_size != document['size']
+                or len(dest.get_full_invites(key)) != len(document['invites'])
+                or dest.get_document_content_size(key) != size
+            ):
+                return size, 'mismatched'
+            return size, None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        last_doc_id = 0
+        while True:
+            documents = source_md.get_full_documents(last_doc_id, batch_size)
+            if not documents:
+                break
+            last_doc_id = documents[-1]['doc_id']
+
+            to_check = [document for document in documents if document['invites']]
+            for document, (size, problem) in zip(to_check, executor.map(_check, to_check)):
+                report['documents'] += 1
+                report['bytes'] += size
+                if problem is not None:
+                    report[problem] += 1
+                    if len(report['problems']) < 100:
+                        report['problems'].append(document['key'])
+
+    return report
+
+
+def get_migration_source(app: Flask) -> DocStore:
+    """
+    Get a doc store with the SQLite db and the local storage configured for the app, to migrate from.
+
+    :param app: The Flask app
+    :return: A doc store with SqliteMD metadata and LocalStorage storage
+    """
+    from edusign_webapp.document.metadata.sqlite import SqliteMD
+    from edusign_webapp.document.storage.local import LocalStorage
+
+    return DocStore.custom(app, LocalStorage(app.config, app.logger), SqliteMD(app))
+
+
+def main():
+    from edusign_webapp.run import edusign_init_app
+
+    app = edusign_init_app('edusign-migrate')
+
+    parser = argparse.ArgumentParser(description="Migrate the eduSign doc store from SQLite & local fs to Redis & S3")
+    parser.add_argument('--batch-size', type=int, default=app.config['MIGRATION_BATCH_SIZE'])
+    parser.add_argument('--concurrency', type=int, default=app.config['MIGRATION_CONCURRENCY'])
+    parser.add_argument('--checkpoint', default=app.config['MIGRATION_CHECKPOINT_PATH'])
+    parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start from the beginning")
+    parser.add_argument('--verify-only', action='store_true', help="Only check the result of a previous migration")
+    args = parser.parse_args()
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    source = get_migration_source(app)
+
+    with app.app_context():
+        if not args.verify_only:
+            start = time.monotonic()
+            checkpoint = load_checkpoint(args.checkpoint)
+            initial_documents, initial_bytes = checkpoint['documents'], checkpoint['bytes']
+            if checkpoint['last_doc_id']:
+                print(f"Resuming migration after document with id {checkpoint['last_doc_id']}")
+
+            def _progress(checkpoint):
+                elapsed = time.monotonic() - start
+                documents = checkpoint['documents'] - initial_documents
+                mbytes = (checkpoint['bytes'] - initial_bytes) / 2**20
+                print(
+                    f"Migrated {checkpoint['documents']} documents, {checkpoint['invites']} invitations, "
+                    f"{checkpoint['bytes']} bytes, up to id {checkpoint['last_doc_id']}: "
+                    f"{documents / elapsed:.1f} docs/s, {mbytes / elapsed:.2f} MiB/s"
+                )
+
+            try:
+                checkpoint = migrate_documents(
+                    app,
+                    source.metadata,
+                    source.storage,
+                    args.checkpoint,
+                    args.batch_size,
+                    args.concurrency,
+                    progress=_progress,
+                )
+            except MigrationError as e:
+                print(f"{e}. Run again to resume the migration.")
+                raise SystemExit(1)
+
+            print(
+                f"Migrated {checkpoint['documents']} documents and {checkpoint['invites']} invitations, "
+                f"skipped {checkpoint['skipped']} without invitations and {checkpoint['missing']} without contents"
+            )
+
+        report = verify_migration(app, source.metadata, source.storage, args.batch_size, args.concurrency)
+
+    print(
+        f"Verified {report['documents']} documents with {report['bytes']} bytes: "
+        f"{report['missing']} missing and {report['mismatched']} mismatched"
+    )
+    if report['problems']:
+        print(f"Problematic documents: {', '.join(report['problems'])}")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
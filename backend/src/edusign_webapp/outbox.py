@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import argparse
+import signal
+import time
+from typing import Optional
+
+from flask import Flask, current_app
+
+from edusign_webapp.mail_backend import ParallelEmailBackend
+from edusign_webapp.utils import compose_message, deserialize_message
+
+
+def _send(msgs: list) -> list:
+    """
+    Send a batch of messages with the configured mail backend.
+
+    :param msgs: the EmailMessage objects to send
+    :return: the failures reported by the backend, as dictionaries with keys message, error and transient
+    """
+    if current_app.config['MAIL_BACKEND'] == 'dummy':
+        conn = current_app.extensions['mailer'].get_connection(backend='dummy')
+        conn.send_messages(msgs)
+        conn.close()
+        return []
+
+    conn = current_app.extensions['mailer'].get_connection(backend=ParallelEmailBackend)
+    report = conn.send_messages_in_parallel(msgs)
+    conn.close()
+    return report.failed
+
+
+def _handle_failure(entry: dict, error: str, transient: bool):
+    """
+    Schedule a new attempt to send a message from the outbox that has failed with a transient error,
+    with exponential backoff, or dead letter it if it has failed with a permanent error
+    or has reached MAIL_OUTBOX_MAX_ATTEMPTS.
+
+    :param entry: the message as claimed from the outbox
+    :param error: the error with which sending the message failed
+    :param transient: whether the error is transient
+    """
+    doc_store = current_app.extensions['doc_store']
+    config = current_app.config
+    attempts = entry['attempts'] + 1
+    if transient and attempts < config['MAIL_OUTBOX_MAX_ATTEMPTS']:
+        delay = config['MAIL_OUTBOX_RETRY_DELAY'] * 2 ** (attempts - 1)
+        current_app.logger.warning(f"Email {entry['msg_id']} will be attempted again in {delay}s")
+        doc_store.retry_email(entry['msg_id'], delay, error)
+    else:
+        current_app.logger.error(f"Dead lettering email {entry['msg_id']} after {attempts} attempts")
+        doc_store.dead_letter_email(entry['msg_id'], error)
+
+
+def process_outbox_batch() -> int:
+    """
+    Claim a batch of messages from the outbox and send them.
+    Sent messages are removed from the outbox. Messages that fail with transient errors,
+    or that cannot be sent at all (e.g. because the SMTP server cannot be reached),
+    are scheduled for a new attempt, with exponential backoff, until they reach MAIL_OUTBOX_MAX_ATTEMPTS,
+    and messages that fail with permanent errors, or that cannot be composed, are dead lettered.
+
+    Must be called within an app context.
+
+    :return: the number of messages claimed from the outbox
+    """
+    doc_store = current_app.extensions['doc_store']
+    config = current_app.config
+
+    claimed = doc_store.claim_emails(config['MAIL_OUTBOX_BATCH_SIZE'], config['MAIL_OUTBOX_LEASE'])
+    if not claimed:
+        return 0
+
+    msgs = []
+    entries = {}
+    for entry in claimed:
+        try:
+            msg = compose_message(**deserialize_message(entry['message']))
+        except Exception as e:
+            current_app.logger.error(f"Dead lettering email {entry['msg_id']} that cannot be composed: {e}")
+            doc_store.dead_letter_email(entry['msg_id'], str(e))
+            continue
+        msgs.append(msg)
+        entries[id(msg)] = entry
+
+    try:
+        failures = _send(msgs)
+    except Exception as e:
+        # e.g. the SMTP server cannot be reached; none of the messages has been sent
+        current_app.logger.error(f"Problem sending {len(msgs)} emails from the outbox: {e}")
+        for entry in entries.values():
+            _handle_failure(entry, str(e), True)
+        return len(claimed)
+
+    failed_ids = set()
+    for failure in failures:
+        entry = entries[id(failure['message'])]
+        failed_ids.add(entry['msg_id'])
+        _handle_failure(entry, failure['error'], failure['transient'])
+
+    doc_store.ack_emails([entry['msg_id'] for entry in entries.values() if entry['msg_id'] not in failed_ids])
+
+    return len(claimed)
+
+
+def run_worker(app: Flask, once: bool = False, stop: Optional[list] = None):
+    """
+    Drain the outbox in batches, polling it every MAIL_OUTBOX_POLL_INTERVAL seconds when it is empty.
+
+    :param app: the Flask app, with the doc store holding the outbox
+    :param once: whether to return once the outbox is empty, rather than keep polling it
+    :param stop: a list that will be appended to when the worker should stop
+    """
+    stop = stop if stop is not None else []
+    with app.app_context():
+        app.logger.info("Outbox worker started")
+        while not stop:
+            try:
+                claimed = process_outbox_batch()
+            except Exception as e:
+                app.logger.error(f"Problem processing the outbox: {e}")
+                claimed = 0
+            if claimed == 0:
+                if once:
+                    break
+                time.sleep(app.config['MAIL_OUTBOX_POLL_INTERVAL'])
+        app.logger.info(f"Outbox worker stopped, outbox stats: {app.extensions['doc_store'].get_outbox_stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send the notification emails queued in the eduSign outbox")
+    parser.add_argument('--once', action='store_true', help="Exit once the outbox is empty")
+    args = parser.parse_args()
+
+    from edusign_webapp.run import edusign_init_app
+
+    app = edusign_init_app('edusign-outbox')
+
+    stop = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.append(signum))
+
+    run_worker(app, once=args.once, stop=stop)
+
+
+if __name__ == '__main__':
+    main()
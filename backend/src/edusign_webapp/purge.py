@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import argparse
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from flask import Flask
+
+
+def _batches(keys: Iterable[uuid.UUID], size: int) -> Iterator[List[uuid.UUID]]:
+    batch = []
+    for key in keys:
+        batch.append(key)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def purge_documents(
+    app: Flask,
+    keys: Iterable[uuid.UUID],
+    batch_size: int,
+    concurrency: int,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[int, int]:
+    """
+    Remove documents from the doc store in batches, with up to `concurrency` batches being removed at the same time,
+    whether or not there are pending signatures.
+
+    Each batch is removed with one call to the storage and one transaction in the metadata backend,
+    and documents that cannot be removed are left in place, so purging can be interrupted at any moment,
+    and resumed just by purging again the documents that are still old.
+
+    :param app: the Flask app, with the doc store holding the documents
+    :param keys: the keys identifying the documents to remove, consumed lazily from the calling thread,
+                 so that e.g. `DocStore.get_old_documents` can be passed from within an app context
+    :param batch_size: number of documents to remove in each batch
+    :param concurrency: max number of batches to remove at the same time
+    :param progress: function called after each batch, with the number of documents processed and removed so far
+    :return: the number of documents processed and the number of documents removed
+    """
+    processed = 0
+    removed = 0
+
+    def _purge(batch):
+        with app.app_context():
+            try:
+                return len(app.extensions['doc_store'].remove_documents(batch))
+            except Exception as e:
+                app.logger.error(f"Problem removing batch of {len(batch)} documents: {e}")
+                return 0
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = {}
+        batches = _batches(keys, batch_size)
+        while True:
+            for batch in batches:
+                in_flight[executor.submit(_purge, batch)] = len(batch)
+                if len(in_flight) >= concurrency:
+                    break
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                processed += in_flight.pop(future)
+                removed += future.result()
+                if progress is not None:
+                    progress(processed, removed)
+
+    return processed, removed
+
+
+def main():
+    from edusign_webapp.run import edusign_init_app
+
+    app = edusign_init_app('edusign-purge')
+
+    parser = argparse.ArgumentParser(description="Remove old documents from the eduSign doc store")
+    parser.add_argument(
+        '--days', type=int, default=app.config['MAX_DOCUMENT_AGE'], help="Remove documents older than this"
+    )
+    parser.add_argument('--batch-size', type=int, default=app.config['CLEANUP_BATCH_SIZE'])
+    parser.add_argument('--concurrency', type=int, default=app.config['CLEANUP_CONCURRENCY'])
+    parser.add_argument('--dry-run', action='store_true', help="Only count the documents to remove")
+    args = parser.parse_args()
+
+    with app.app_context():
+        keys = app.extensions['doc_store'].get_old_documents(args.days)
+
+        if args.dry_run:
+            total = sum(1 for _ in keys)
+            print(f"{total} documents older than {args.days} days")
+            return
+
+        start = time.monotonic()
+
+        def _progress(processed, removed):
+            elapsed = time.monotonic() - start
+            print(f"Processed {processed} documents, removed {removed}, {processed / elapsed:.1f} docs/s")
+
+        total, removed = purge_documents(app, keys, args.batch_size, args.concurrency, progress=_progress)
+        downloads = app.extensions['doc_store'].remove_expired_downloads()
+
+    print(f"Removed {removed} documents out of {total} older than {args.days} days, and {downloads} expired downloads")
+    if removed < total:
+        print("Run again to retry removing the remaining documents")
+
+
+if __name__ == '__main__':
+    main()
@@ -42,6 +42,7 @@ from werkzeug.wrappers import Request, Response
 
 from edusign_webapp.api_client import APIClient
 from edusign_webapp.doc_store import DocStore
+from edusign_webapp.workers import WorkerPool
 
 
 def get_locale():
@@ -82,6 +83,10 @@ class EduSignApp(Flask):
 
         self.extensions['mailer'] = Mail(self)
 
+        self.extensions['pdf_workers'] = WorkerPool(
+            self.config['PDF_WORKERS'], self.config['PDF_WORKERS_MAX_QUEUED'], self.config['PDF_WORKERS_TIMEOUT']
+        )
+
         if self.config['ENVIRONMENT'] == 'e2e':
             self.extensions['email_msgs'] = {}
 
@@ -31,8 +31,13 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
-from marshmallow import Schema, fields
+from base64 import b64encode
 
+from flask import current_app
+from flask_babel import gettext
+from marshmallow import Schema, ValidationError, fields
+
+from edusign_webapp.utils import b64decode_blob, b64encode_stream
 from edusign_webapp.validators import (
     validate_doc_type,
     validate_language,
@@ -42,6 +47,33 @@ from edusign_webapp.validators import (
 )
 
 
+class Base64Bytes(fields.Field):
+    """
+    Field for the contents of documents, that are base64 encoded in JSON,
+    but are handled as raw bytes in the backend.
+    When serializing, the value can also be a binary file like object,
+    that will be encoded in chunks and closed.
+    """
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        if value is None:
+            return None
+        if hasattr(value, 'read'):
+            with value:
+                return b64encode_stream(value, current_app.config['STORAGE_CHUNK_SIZE'])
+        return b64encode(value).decode('ascii')
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        if not isinstance(value, str):
+            raise ValidationError(gettext('There was an error. Please try again, or contact the site administrator.'))
+        try:
+            return b64decode_blob(value)
+        except ValueError:
+            # binascii.Error for wrong base64, or a plain ValueError for non ASCII strings
+            current_app.logger.debug('Validate base64: wrong encoding')
+            raise ValidationError(gettext('There was an error. Please try again, or contact the site administrator.'))
+
+
 class _DocumentSchema(Schema):
     """
     Schema to unmarshal a document's data sent from the frontend to be prepared for signing.
@@ -168,7 +200,7 @@ class BlobSchema(Schema):
     Schema to marshal a document's contents sent to the frontend for preview.
     """
 
-    blob = fields.Raw(required=True, validate=[validate_nonempty])
+    blob = Base64Bytes(required=True, validate=[validate_nonempty])
     pprinted = fields.String(required=True, validate=[validate_nonempty])
 
 
@@ -178,14 +210,15 @@ class _DocumentSchemaWithKey(_DocumentSchema):
     """
 
     key = fields.String(required=True, validate=[validate_nonempty, validate_uuid4])
-    blob = fields.Raw(required=True, validate=[validate_nonempty])
+    blob: fields.Field = fields.Raw(required=True, validate=[validate_nonempty])
 
 
 class DocumentSchemaWithKey(_DocumentSchemaWithKey):
     """
-    Schema to unmarshal a document's data sent from the frontend to be prepared for signing.
+    Schema to unmarshal a document's data sent from the frontend to be stored in the backend.
     """
 
+    blob = Base64Bytes(required=True, validate=[validate_nonempty])
     prev_signatures = fields.String()
 
 
@@ -300,7 +333,7 @@ class SignedDocumentsSchema(Schema):
         id = fields.String(required=True, validate=[validate_nonempty])
         name = fields.String(required=True, validate=[validate_nonempty])
         type = fields.String(required=True, validate=[validate_nonempty, validate_doc_type])
-        signed_content = fields.Raw(required=True, validate=[validate_nonempty])
+        signed_content = Base64Bytes(required=True, validate=[validate_nonempty])
         validated = fields.Boolean()
         pprinted = fields.String(required=True, validate=[validate_nonempty])
         pending = fields.List(fields.Nested(Invitee))
@@ -375,9 +408,9 @@ class DocSchema(Schema):
     sent to extract a PDF form
     """
 
-    document = fields.String(required=True, validate=[validate_nonempty])
+    document = Base64Bytes(required=True, validate=[validate_nonempty])
 
 
 class FillFormSchema(Schema):
-    document = fields.String(required=True, validate=[validate_nonempty])
+    document = Base64Bytes(required=True, validate=[validate_nonempty])
     form_fields = fields.List(fields.Nested(Field))
@@ -237,7 +237,7 @@ def s3_app(request):
 @pytest.fixture
 def local_storage():
     tempdir = tempfile.TemporaryDirectory()
-    config = {'LOCAL_STORAGE_BASE_DIR': tempdir.name}
+    config = {'LOCAL_STORAGE_BASE_DIR': tempdir.name, 'STORAGE_CHUNK_SIZE': 1024}
     config.update(config_dev)
     # return tempdir, since once it goes out of scope, it is removed
     yield tempdir, LocalStorage(config, logging.getLogger(__name__))
@@ -353,6 +353,25 @@ def sample_doc_2():
     yield doc
 
 
+@pytest.fixture
+def sample_binary_pdf_data_2():
+    yield b64decode(pdf_simple_2.encode('utf8'))
+
+
+@pytest.fixture
+def sample_stored_doc_1():
+    doc = {'blob': b64decode(pdf_simple_1.encode('utf8'))}
+    doc.update(_sample_metadata_1)
+    yield doc
+
+
+@pytest.fixture
+def sample_stored_doc_2():
+    doc = {'blob': b64decode(pdf_simple_2.encode('utf8'))}
+    doc.update(_sample_metadata_2)
+    yield doc
+
+
 @pytest.fixture
 def sample_invites_1():
     yield [
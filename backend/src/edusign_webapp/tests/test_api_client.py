@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import threading
+from base64 import b64encode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from edusign_webapp import run
+from edusign_webapp.api_client import APIClient, HTTPSessionPool
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_http_session_pool_reuses_connections():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f'http://127.0.0.1:{server.server_port}/'
+
+    try:
+        pool = HTTPSessionPool(pool_size=2, retries=1, backoff_factor=0)
+        session = pool.session(base_url)
+
+        assert pool.session(base_url) is session
+
+        for _ in range(3):
+            assert session.get(base_url + 'endpoint').text == 'ok'
+
+        stats = pool.stats()
+        session.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert stats[base_url] == {'requests': 3, 'connections': 1}
+
+
+def test_process_sign_request_decodes_contents(monkeypatch):
+    def mock_post(self, url, request_data, *args, **kwargs):
+        return {
+            'signedDocuments': [
+                {
+                    'id': '6e46692d-7d34-4954-b760-96ee6ce48f61',
+                    'mimeType': 'application/pdf',
+                    'signedContent': b64encode(b'Dummy signed content').decode('ascii'),
+                }
+            ]
+        }
+
+    monkeypatch.setattr(APIClient, '_post', mock_post)
+    monkeypatch.setattr(APIClient, 'initialize_credentials', lambda self: None)
+    monkeypatch.setattr(run.app.extensions['api_client'], 'api_base_url', 'https://test.localhost', raising=False)
+
+    with run.app.test_request_context():
+        process_data = run.app.extensions['api_client'].process_sign_request('sign response', 'relay state')
+        error_data = {'errorCode': 'error.dss', 'message': 'dummy message'}
+        monkeypatch.setattr(APIClient, '_post', lambda self, *args, **kwargs: error_data)
+        error = run.app.extensions['api_client'].process_sign_request('sign response', 'relay state')
+
+    assert process_data['signedDocuments'][0]['signedContent'] == b'Dummy signed content'
+    assert error == error_data
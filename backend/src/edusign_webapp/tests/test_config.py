@@ -290,3 +290,21 @@ def test_get_config_with_ordered_invitations(
     assert '' == json.loads(response1.data)['payload']['pending_multisign'][0]['message']
 
     assert len(json.loads(response2.data)['payload']['pending_multisign']) == 0
+
+
+def test_get_config_with_invitations_no_content(
+    app_and_client, environ_base, monkeypatch, sample_owned_doc_1, sample_invites_1, environ_base_2
+):
+    from edusign_webapp.doc_store import DocStore
+
+    def mock_get_document_content(self, key):
+        raise AssertionError("Document contents should not be retrieved to list invitations")
+
+    monkeypatch.setattr(DocStore, "get_document_content", mock_get_document_content)
+
+    response1, _ = _test_get_config_with_invitations(
+        app_and_client, environ_base, environ_base_2, monkeypatch, sample_owned_doc_1, sample_invites_1, 'low', False
+    )
+    pending = json.loads(response1.data)['payload']['pending_multisign']
+    assert len(pending) == 1
+    assert pending[0]['pprinted'] == 'not-needed-for-pdf'
@@ -31,6 +31,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import json
+import uuid
 
 from edusign_webapp.marshal import ResponseSchema
 
@@ -131,6 +132,45 @@ def test_create_multi_sign_request_raises(app_and_client, monkeypatch, sample_do
     assert resp_data['message'] == 'Problem creating invitation to sign, please try again'
 
 
+def test_create_multi_sign_request_mail_unreachable(app_and_client, monkeypatch, sample_doc_1):
+    doc_data = {
+        'payload': {
+            'document': sample_doc_1,
+            'owner': 'tester@example.org',
+            'text': 'Test text',
+            'sendsigned': True,
+            'skipfinal': False,
+            'loa': 'low',
+            'ordered': False,
+            'invites': [
+                {'name': 'invite0', 'email': 'invite0@example.org', 'lang': 'en'},
+                {'name': 'invite1', 'email': 'invite1@example.org', 'lang': 'en'},
+            ],
+        },
+    }
+
+    from edusign_webapp.mail_backend import ParallelEmailBackend
+
+    def mock_open(self):
+        raise ConnectionRefusedError('Mock connection refused')
+
+    app, client = app_and_client
+    monkeypatch.setattr(ParallelEmailBackend, 'open', mock_open)
+    monkeypatch.setitem(app.config, 'MAIL_BACKEND', 'smtp')
+    monkeypatch.setitem(app.config, 'MAIL_SEND_RETRIES', 0)
+
+    response = _test_create_multi_sign_request(app_and_client, monkeypatch, doc_data)
+
+    assert response.status == '200 OK'
+
+    resp_data = json.loads(response.data)
+
+    assert resp_data['message'] == 'There was a problem and the invitation email(s) were not sent'
+
+    with app.app_context():
+        assert app.extensions['doc_store'].get_document_name(uuid.UUID(sample_doc_1['key'])) == ''
+
+
 def test_create_multi_sign_wrong_owner(app_and_client, monkeypatch, sample_doc_1):
     doc_data = {
         'payload': {
@@ -178,12 +218,21 @@ def test_metrics(app_and_client, monkeypatch, sample_doc_1):
         },
     }
 
-    _test_create_multi_sign_request(app_and_client, monkeypatch, doc_data)
+    app, client = app_and_client
+    monkeypatch.setitem(app.config, 'MAIL_OUTBOX', True)
 
-    _, client = app_and_client
+    _test_create_multi_sign_request(app_and_client, monkeypatch, doc_data)
 
     response = client.get('/sign/metrics')
 
-    assert b"Number of documents: 1" in response.data
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+
+    assert b'edusign_documents{type="application/pdf"} 1\n' in response.data
+
+    assert b'edusign_documents_bytes{type="application/pdf"} 1500000\n' in response.data
+
+    assert b'edusign_documents_older_than{days="1"} 0\n' in response.data
+
+    assert b"edusign_outbox_pending 1\n" in response.data
 
-    assert b"Total bytes: 1500000" in response.data
+    assert b"edusign_outbox_enqueued_total 1\n" in response.data
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import pytest
+
+from edusign_webapp import marshal, run
+from edusign_webapp.marshal import CSRF_TOKEN_METHODS, ResponseSchema
+
+
+@pytest.mark.parametrize('method', ['hmac', 'password-hash'])
+def test_csrf_token(method):
+    old = run.app.config['CSRF_TOKEN_METHOD']
+    run.app.config['CSRF_TOKEN_METHOD'] = method
+    _, check_token = CSRF_TOKEN_METHODS[method]
+    secret = run.app.config['SECRET_KEY']
+
+    with run.app.test_request_context():
+        sess = {}
+        token = ResponseSchema().get_csrf_token({}, sess=sess)['csrf_token']
+
+        assert check_token(token, sess['user_key'], secret)
+        assert not check_token(token, sess['user_key'] + 'x', secret)
+        assert not check_token(token, sess['user_key'], secret + 'x')
+
+    run.app.config['CSRF_TOKEN_METHOD'] = old
+
+
+def test_csrf_token_hmac_accepts_password_hash_token(monkeypatch):
+    make_token, _ = CSRF_TOKEN_METHODS['password-hash']
+    _, check_token = CSRF_TOKEN_METHODS['hmac']
+    secret = run.app.config['SECRET_KEY']
+    monkeypatch.setitem(run.app.config, 'CSRF_ACCEPT_PASSWORD_HASH_TOKENS', True)
+
+    with run.app.test_request_context():
+        token = make_token('user-key', secret)
+
+        assert check_token(token, 'user-key', secret)
+        assert not check_token(token, 'other-key', secret)
+
+
+def test_csrf_token_hmac_rejects_password_hash_token(monkeypatch):
+    make_token, _ = CSRF_TOKEN_METHODS['password-hash']
+    _, check_token = CSRF_TOKEN_METHODS['hmac']
+    secret = run.app.config['SECRET_KEY']
+
+    def no_password_hash_check(*args):
+        raise AssertionError("Password hash tokens should not be checked")
+
+    monkeypatch.setattr(marshal, '_password_hash_check', no_password_hash_check)
+
+    with run.app.test_request_context():
+        token = make_token('user-key', secret)
+
+        assert not check_token(token, 'user-key', secret)
@@ -30,7 +30,6 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
-import base64
 import os
 import sqlite3
 import uuid
@@ -46,11 +45,11 @@ invitation_flags = [
 ]
 
 
-def test_add(doc_store_local_sqlite, sample_doc_1, sample_owner_1, sample_invites_1):
+def test_add(doc_store_local_sqlite, sample_stored_doc_1, sample_owner_1, sample_invites_1):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
 
     assert len(os.listdir(doc_store.storage.base_dir)) == 1
     assert 'test.db' in os.listdir('/tmp')
@@ -63,129 +62,131 @@ def test_add(doc_store_local_sqlite, sample_doc_1, sample_owner_1, sample_invite
     cur.close()
     conn.close()
 
-    assert result[2:5] == (sample_doc_1['name'], sample_doc_1['size'], sample_doc_1['type'])
+    assert result[2:5] == (sample_stored_doc_1['name'], sample_stored_doc_1['size'], sample_stored_doc_1['type'])
 
 
-def test_add_and_get_pending(doc_store_local_sqlite, sample_doc_1, sample_owner_1, sample_invites_1):
+def test_add_and_get_pending(doc_store_local_sqlite, sample_stored_doc_1, sample_owner_1, sample_invites_1):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
         pending = doc_store.get_pending_documents([sample_invites_1[1]['email']])
 
     assert len(pending) == 1
-    assert pending[0]['name'] == sample_doc_1['name']
-    assert pending[0]['size'] == sample_doc_1['size']
-    assert pending[0]['type'] == sample_doc_1['type']
+    assert pending[0]['name'] == sample_stored_doc_1['name']
+    assert pending[0]['size'] == sample_stored_doc_1['size']
+    assert pending[0]['type'] == sample_stored_doc_1['type']
     assert pending[0]['owner'] == sample_owner_1
 
 
-def test_add_two_and_get_pending(doc_store_local_sqlite, sample_doc_1, sample_doc_2, sample_owner_1, sample_invites_1):
+def test_add_two_and_get_pending(
+    doc_store_local_sqlite, sample_stored_doc_1, sample_stored_doc_2, sample_owner_1, sample_invites_1
+):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
-        doc_store.add_document(sample_doc_2, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_2, sample_owner_1, sample_invites_1, *invitation_flags)
         pending = doc_store.get_pending_documents([sample_invites_1[1]['email']])
 
     assert len(pending) == 2
-    assert pending[0]['name'] == sample_doc_1['name']
-    assert pending[0]['size'] == sample_doc_1['size']
-    assert pending[0]['type'] == sample_doc_1['type']
+    assert pending[0]['name'] == sample_stored_doc_1['name']
+    assert pending[0]['size'] == sample_stored_doc_1['size']
+    assert pending[0]['type'] == sample_stored_doc_1['type']
     assert pending[0]['owner'] == sample_owner_1
-    assert pending[1]['name'] == sample_doc_2['name']
-    assert pending[1]['size'] == sample_doc_2['size']
-    assert pending[1]['type'] == sample_doc_2['type']
+    assert pending[1]['name'] == sample_stored_doc_2['name']
+    assert pending[1]['size'] == sample_stored_doc_2['size']
+    assert pending[1]['type'] == sample_stored_doc_2['type']
     assert pending[1]['owner'] == sample_owner_1
 
 
-def test_add_and_get_content(doc_store_local_sqlite, sample_doc_1, sample_owner_1, sample_invites_1):
+def test_add_and_get_content(doc_store_local_sqlite, sample_stored_doc_1, sample_owner_1, sample_invites_1):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
         pending = doc_store.get_pending_documents([sample_invites_1[1]['email']])
         content = doc_store.get_document_content(pending[0]['key'])
 
-    assert content == sample_doc_1['blob']
+    assert content == sample_stored_doc_1['blob']
 
 
 def test_add_and_update_and_get_content(
-    doc_store_local_sqlite, sample_doc_1, sample_doc_2, sample_owner_1, sample_invites_1
+    doc_store_local_sqlite, sample_stored_doc_1, sample_stored_doc_2, sample_owner_1, sample_invites_1
 ):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
         pending = doc_store.get_pending_documents([sample_invites_1[1]['email']])
-        doc_store.update_document(pending[0]['key'], sample_doc_2['blob'], [sample_invites_1[1]['email']])
+        doc_store.update_document(pending[0]['key'], sample_stored_doc_2['blob'], [sample_invites_1[1]['email']])
         content = doc_store.get_document_content(pending[0]['key'])
         pending0 = doc_store.get_pending_documents([sample_invites_1[0]['email']])
         pending1 = doc_store.get_pending_documents([sample_invites_1[1]['email']])
 
-    assert content != sample_doc_1['blob']
-    assert content == sample_doc_2['blob']
+    assert content != sample_stored_doc_1['blob']
+    assert content == sample_stored_doc_2['blob']
 
     assert len(pending0) == 1
-    assert pending0[0]['name'] == sample_doc_1['name']
-    assert pending0[0]['size'] == sample_doc_1['size']
-    assert pending0[0]['type'] == sample_doc_1['type']
+    assert pending0[0]['name'] == sample_stored_doc_1['name']
+    assert pending0[0]['size'] == sample_stored_doc_1['size']
+    assert pending0[0]['type'] == sample_stored_doc_1['type']
     assert pending0[0]['owner'] == sample_owner_1
 
     assert len(pending1) == 0
 
 
 def test_add_and_update_and_get_owned(
-    doc_store_local_sqlite, sample_doc_1, sample_doc_2, sample_owner_1, sample_invites_1
+    doc_store_local_sqlite, sample_stored_doc_1, sample_stored_doc_2, sample_owner_1, sample_invites_1
 ):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
         pending = doc_store.get_pending_documents([sample_invites_1[1]['email']])
-        doc_store.update_document(pending[0]['key'], sample_doc_2['blob'], [sample_invites_1[1]['email']])
+        doc_store.update_document(pending[0]['key'], sample_stored_doc_2['blob'], [sample_invites_1[1]['email']])
         content = doc_store.get_document_content(pending[0]['key'])
         owned = doc_store.get_owned_documents(sample_owner_1['eppn'], [sample_owner_1['email']])
 
-    assert content != sample_doc_1['blob']
-    assert content == sample_doc_2['blob']
+    assert content != sample_stored_doc_1['blob']
+    assert content == sample_stored_doc_2['blob']
 
     assert len(owned) == 1
-    assert owned[0]['name'] == sample_doc_1['name']
-    assert owned[0]['size'] == sample_doc_1['size']
-    assert owned[0]['type'] == sample_doc_1['type']
+    assert owned[0]['name'] == sample_stored_doc_1['name']
+    assert owned[0]['size'] == sample_stored_doc_1['size']
+    assert owned[0]['type'] == sample_stored_doc_1['type']
 
     assert sample_invites_1[0]['email'] in [o['email'] for o in owned[0]['pending']]
     assert sample_invites_1[1]['email'] not in [o['email'] for o in owned[0]['pending']]
 
 
 def test_add_two_and_update_and_get_owned(
-    doc_store_local_sqlite, sample_doc_1, sample_doc_2, sample_owner_1, sample_invites_1
+    doc_store_local_sqlite, sample_stored_doc_1, sample_stored_doc_2, sample_owner_1, sample_invites_1
 ):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
-        doc_store.add_document(sample_doc_2, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_2, sample_owner_1, sample_invites_1, *invitation_flags)
         pending = doc_store.get_pending_documents([sample_invites_1[1]['email']])
-        doc_store.update_document(pending[0]['key'], sample_doc_2['blob'], [sample_invites_1[1]['email']])
+        doc_store.update_document(pending[0]['key'], sample_stored_doc_2['blob'], [sample_invites_1[1]['email']])
         content = doc_store.get_document_content(pending[0]['key'])
         owned = doc_store.get_owned_documents(sample_owner_1['eppn'], [sample_owner_1['email']])
 
-    assert content != sample_doc_1['blob']
-    assert content == sample_doc_2['blob']
+    assert content != sample_stored_doc_1['blob']
+    assert content == sample_stored_doc_2['blob']
 
-    assert content != sample_doc_1['blob']
-    assert content == sample_doc_2['blob']
+    assert content != sample_stored_doc_1['blob']
+    assert content == sample_stored_doc_2['blob']
 
     assert len(owned) == 2
-    assert owned[0]['name'] == sample_doc_1['name']
-    assert owned[0]['size'] == sample_doc_1['size']
-    assert owned[0]['type'] == sample_doc_1['type']
+    assert owned[0]['name'] == sample_stored_doc_1['name']
+    assert owned[0]['size'] == sample_stored_doc_1['size']
+    assert owned[0]['type'] == sample_stored_doc_1['type']
 
-    assert owned[1]['name'] == sample_doc_2['name']
-    assert owned[1]['size'] == sample_doc_2['size']
-    assert owned[1]['type'] == sample_doc_2['type']
+    assert owned[1]['name'] == sample_stored_doc_2['name']
+    assert owned[1]['size'] == sample_stored_doc_2['size']
+    assert owned[1]['type'] == sample_stored_doc_2['type']
 
     assert sample_invites_1[0]['email'] in [o['email'] for o in owned[0]['pending']]
     assert sample_invites_1[1]['email'] not in [o['email'] for o in owned[0]['pending']]
@@ -195,21 +196,21 @@ def test_add_two_and_update_and_get_owned(
 
 
 def test_add_two_and_remove_not_one_and_get_owned(
-    doc_store_local_sqlite, sample_doc_1, sample_doc_2, sample_owner_1, sample_invites_1
+    doc_store_local_sqlite, sample_stored_doc_1, sample_stored_doc_2, sample_owner_1, sample_invites_1
 ):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
-        doc_store.add_document(sample_doc_2, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_2, sample_owner_1, sample_invites_1, *invitation_flags)
         owned = doc_store.get_owned_documents(sample_owner_1['eppn'], [sample_owner_1['email']])
         doc_store.remove_document(owned[0]['key'])
         reowned = doc_store.get_owned_documents(sample_owner_1['eppn'], [sample_owner_1['email']])
 
     assert len(reowned) == 2
-    assert reowned[0]['name'] == sample_doc_1['name']
-    assert reowned[0]['size'] == sample_doc_1['size']
-    assert reowned[0]['type'] == sample_doc_1['type']
+    assert reowned[0]['name'] == sample_stored_doc_1['name']
+    assert reowned[0]['size'] == sample_stored_doc_1['size']
+    assert reowned[0]['type'] == sample_stored_doc_1['type']
 
     assert sample_invites_1[0]['email'] in [o['email'] for o in owned[0]['pending']]
     assert sample_invites_1[1]['email'] in [o['email'] for o in owned[0]['pending']]
@@ -219,63 +220,63 @@ def test_add_two_and_remove_not_one_and_get_owned(
 
 
 def test_add_two_and_remove_force_one_and_get_owned(
-    doc_store_local_sqlite, sample_doc_1, sample_doc_2, sample_owner_1, sample_invites_1
+    doc_store_local_sqlite, sample_stored_doc_1, sample_stored_doc_2, sample_owner_1, sample_invites_1
 ):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
-        doc_store.add_document(sample_doc_2, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_2, sample_owner_1, sample_invites_1, *invitation_flags)
         owned = doc_store.get_owned_documents(sample_owner_1['eppn'], [sample_owner_1['email']])
         doc_store.remove_document(owned[0]['key'], force=True)
         reowned = doc_store.get_owned_documents(sample_owner_1['eppn'], [sample_owner_1['email']])
 
     assert len(reowned) == 1
-    assert reowned[0]['name'] == sample_doc_2['name']
-    assert reowned[0]['size'] == sample_doc_2['size']
-    assert reowned[0]['type'] == sample_doc_2['type']
+    assert reowned[0]['name'] == sample_stored_doc_2['name']
+    assert reowned[0]['size'] == sample_stored_doc_2['size']
+    assert reowned[0]['type'] == sample_stored_doc_2['type']
 
 
 def test_add_two_and_remove_one_and_get_owned(
-    doc_store_local_sqlite, sample_doc_1, sample_doc_2, sample_owner_1, sample_invites_1
+    doc_store_local_sqlite, sample_stored_doc_1, sample_stored_doc_2, sample_owner_1, sample_invites_1
 ):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
-        doc_store.add_document(sample_doc_2, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_store.add_document(sample_stored_doc_2, sample_owner_1, sample_invites_1, *invitation_flags)
         pending = doc_store.get_pending_documents([sample_invites_1[1]['email']])
-        doc_store.update_document(pending[0]['key'], sample_doc_2['blob'], [sample_invites_1[0]['email']])
-        doc_store.update_document(pending[0]['key'], sample_doc_2['blob'], [sample_invites_1[1]['email']])
+        doc_store.update_document(pending[0]['key'], sample_stored_doc_2['blob'], [sample_invites_1[0]['email']])
+        doc_store.update_document(pending[0]['key'], sample_stored_doc_2['blob'], [sample_invites_1[1]['email']])
         doc_store.remove_document(pending[0]['key'])
         owned = doc_store.get_owned_documents(sample_owner_1['eppn'], [sample_owner_1['email']])
 
         content = doc_store.get_document_content(pending[0]['key'])
 
     assert len(owned) == 1
-    assert owned[0]['name'] == sample_doc_2['name']
-    assert owned[0]['size'] == sample_doc_2['size']
-    assert owned[0]['type'] == sample_doc_2['type']
+    assert owned[0]['name'] == sample_stored_doc_2['name']
+    assert owned[0]['size'] == sample_stored_doc_2['size']
+    assert owned[0]['type'] == sample_stored_doc_2['type']
 
     assert content is None
 
 
-def test_add_and_get_invitation(doc_store_local_sqlite, sample_doc_1, sample_owner_1, sample_invites_1):
+def test_add_and_get_invitation(doc_store_local_sqlite, sample_stored_doc_1, sample_owner_1, sample_invites_1):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        invites = doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        invites = doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
         invitation = doc_store.get_invitation(invites[0]['key'])
 
     assert len(invites) == 2
     assert invitation['user']['email'] == 'invite0@example.org'
 
 
-def test_add_and_get_invitation_twice(doc_store_local_sqlite, sample_doc_1, sample_owner_1, sample_invites_1):
+def test_add_and_get_invitation_twice(doc_store_local_sqlite, sample_stored_doc_1, sample_owner_1, sample_invites_1):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        invites = doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        invites = doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
         doc_store.get_invitation(invites[0]['key'])
         try:
             doc_store.get_invitation(invites[1]['key'])
@@ -292,27 +293,31 @@ def test_get_invitation_none(doc_store_local_sqlite):
     assert data == {}
 
 
-def test_add_and_get_invitation_twice_unlocking(doc_store_local_sqlite, sample_doc_1, sample_owner_1, sample_invites_1):
+def test_add_and_get_invitation_twice_unlocking(
+    doc_store_local_sqlite, sample_stored_doc_1, sample_owner_1, sample_invites_1
+):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        invites = doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        invites = doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
         doc_store.get_invitation(invites[0]['key'])
-        doc_store.unlock_document(sample_doc_1['key'], invites[0]['email'])
+        doc_store.unlock_document(sample_stored_doc_1['key'], invites[0]['email'])
         invitation = doc_store.get_invitation(invites[1]['key'])
 
     assert invitation['user']['email'] == 'invite1@example.org'
 
 
-def test_add_and_get_invitation_and_check_lock(doc_store_local_sqlite, sample_doc_1, sample_owner_1, sample_invites_1):
+def test_add_and_get_invitation_and_check_lock(
+    doc_store_local_sqlite, sample_stored_doc_1, sample_owner_1, sample_invites_1
+):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        invites = doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        invites = doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
         doc_store.get_invitation(invites[0]['key'])
 
-        assert doc_store.check_document_locked(sample_doc_1['key'], invites[0]['email'])
-        assert not doc_store.check_document_locked(sample_doc_1['key'], 'dummy@example.org')
+        assert doc_store.check_document_locked(sample_stored_doc_1['key'], invites[0]['email'])
+        assert not doc_store.check_document_locked(sample_stored_doc_1['key'], 'dummy@example.org')
 
 
 def test_check_locked_none(doc_store_local_sqlite):
@@ -323,44 +328,159 @@ def test_check_locked_none(doc_store_local_sqlite):
 
 
 def test_add_and_get_invitation_twice_unlocking_check(
-    doc_store_local_sqlite, sample_doc_1, sample_owner_1, sample_invites_1
+    doc_store_local_sqlite, sample_stored_doc_1, sample_owner_1, sample_invites_1
 ):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        invites = doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        invites = doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
         doc_store.get_invitation(invites[0]['key'])
-        doc_store.unlock_document(sample_doc_1['key'], invites[0]['email'])
+        doc_store.unlock_document(sample_stored_doc_1['key'], invites[0]['email'])
         doc_store.get_invitation(invites[1]['key'])
 
-        assert not doc_store.check_document_locked(sample_doc_1['key'], invites[0]['email'])
-        assert doc_store.check_document_locked(sample_doc_1['key'], invites[1]['email'])
+        assert not doc_store.check_document_locked(sample_stored_doc_1['key'], invites[0]['email'])
+        assert doc_store.check_document_locked(sample_stored_doc_1['key'], invites[1]['email'])
 
 
-def test_add_and_sign_and_get_signed(doc_store_local_sqlite, sample_doc_1, sample_owner_1, sample_invites_1):
+def test_add_and_sign_and_get_signed(doc_store_local_sqlite, sample_stored_doc_1, sample_owner_1, sample_invites_1):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        invites = doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        invites = doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
 
-        content_1 = base64.b64encode(b"dummy content 1").decode('utf8')
-        content_2 = base64.b64encode(b"dummy content 2").decode('utf8')
-        doc_store.update_document(sample_doc_1['key'], content_1, [invites[0]['email']])
-        doc_store.update_document(sample_doc_1['key'], content_2, [invites[1]['email']])
+        content_1 = b"dummy content 1"
+        content_2 = b"dummy content 2"
+        doc_store.update_document(sample_stored_doc_1['key'], content_1, [invites[0]['email']])
+        doc_store.update_document(sample_stored_doc_1['key'], content_2, [invites[1]['email']])
 
-        signed = doc_store.get_signed_document(sample_doc_1['key'])
+        signed = doc_store.get_signed_document(sample_stored_doc_1['key'])
 
-        assert signed['key'] == sample_doc_1['key']
+        assert signed['key'] == sample_stored_doc_1['key']
         assert signed['blob'] == content_2
 
 
 def test_add_and_get_invitation_and_get_owner_data(
-    doc_store_local_sqlite, sample_doc_1, sample_owner_1, sample_invites_1
+    doc_store_local_sqlite, sample_stored_doc_1, sample_owner_1, sample_invites_1
 ):
     tempdir, doc_store = doc_store_local_sqlite
 
     with run.app.app_context():
-        doc_store.add_document(sample_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
-        owner = doc_store.get_owner_data(sample_doc_1['key'])
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        owner = doc_store.get_owner_data(sample_stored_doc_1['key'])
 
     assert owner['email'] == sample_owner_1['email']
+
+
+def test_add_and_update_invalidates_preview(
+    doc_store_local_sqlite, sample_stored_doc_1, sample_stored_doc_2, sample_owner_1, sample_invites_1
+):
+    tempdir, doc_store = doc_store_local_sqlite
+
+    with run.app.app_context():
+        doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        key = uuid.UUID(sample_stored_doc_1['key'])
+        doc_store.add_document_preview(key, 'digest1', 'preview1')
+        preview = doc_store.get_document_preview(key, 'digest1')
+        doc_store.update_document(key, sample_stored_doc_2['blob'], [sample_invites_1[1]['email']])
+        updated = doc_store.get_document_preview(key, 'digest1')
+
+    assert preview == 'preview1'
+    assert updated is None
+
+
+def _test_downloads(doc_store, content):
+    with run.app.app_context():
+        key = doc_store.add_download('test-signed.pdf', content, 300)
+        expired_key = doc_store.add_download('test-expired.pdf', content, -1)
+
+        download = doc_store.get_download(key)
+        with download['stream'] as stream:
+            downloaded = stream.read()
+        expired = doc_store.get_download(expired_key)
+        missing = doc_store.get_download(uuid.uuid4())
+
+        removed = doc_store.remove_expired_downloads()
+        still_there = doc_store.get_download(key)
+        still_there['stream'].close()
+
+    assert download['name'] == 'test-signed.pdf'
+    assert download['size'] == len(content)
+    assert downloaded == content
+    assert expired == {}
+    assert missing == {}
+    assert removed == 1
+    assert still_there['name'] == 'test-signed.pdf'
+    assert doc_store.storage.get_content(expired_key) is None
+
+
+def test_downloads_sqlite(doc_store_local_sqlite, sample_binary_pdf_data):
+    tempdir, doc_store = doc_store_local_sqlite
+    _test_downloads(doc_store, sample_binary_pdf_data)
+
+
+def test_downloads_redis(doc_store_local_redis, sample_binary_pdf_data):
+    tempdir, doc_store = doc_store_local_redis
+    doc_store.metadata.client.redis.flushall()
+    _test_downloads(doc_store, sample_binary_pdf_data)
+
+
+def _test_snapshot(doc_store, sample_stored_doc_1, sample_owner_1, sample_invites_1, monkeypatch):
+    key = sample_stored_doc_1['key']
+    with run.app.app_context():
+        invites = doc_store.add_document(sample_stored_doc_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        md = doc_store.metadata
+        expected = (md.get_sendsigned(key), md.get_skipfinal(key), md.get_ordered(key), md.get_loa(key))
+
+    fetched = []
+
+    def counting(name):
+        method = getattr(doc_store.metadata, name)
+
+        def wrapper(*args, **kwargs):
+            fetched.append(name)
+            return method(*args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(doc_store.metadata, 'get_full_document', counting('get_full_document'))
+    monkeypatch.setattr(doc_store.metadata, 'get_invited', counting('get_invited'))
+
+    with run.app.app_context():
+        name = doc_store.get_document_name(key)
+        owner = doc_store.get_owner_data(key)
+        sendsigned = doc_store.get_sendsigned(key)
+        skipfinal = doc_store.get_skipfinal(key)
+        ordered = doc_store.get_ordered(key)
+        loa = doc_store.get_loa(key)
+        pending = doc_store.get_pending_invites(key)
+        pending[0]['email'] = 'changed@example.org'
+        full_invites = doc_store.get_full_invites(key)
+        locked = doc_store.lock_document(key, 'owner@example.org')
+
+        read_once = list(fetched)
+
+        doc_store.update_document(key, b"dummy content", [invites[0]['email']])
+        pending_after = doc_store.get_pending_invites(key)
+
+    with run.app.app_context():
+        doc_store.get_document_name(key)
+
+    assert read_once == ['get_full_document', 'get_invited']
+    assert name == sample_stored_doc_1['name']
+    assert owner['email'] == sample_owner_1['email']
+    assert (sendsigned, skipfinal, ordered, loa) == expected
+    assert sorted(invite['email'] for invite in full_invites) == sorted(invite['email'] for invite in sample_invites_1)
+    assert locked
+    assert [invite['signed'] for invite in pending_after] == [True, False]
+    assert fetched == ['get_full_document', 'get_invited'] * 2 + ['get_full_document']
+
+
+def test_snapshot_sqlite(doc_store_local_sqlite, sample_stored_doc_1, sample_owner_1, sample_invites_1, monkeypatch):
+    tempdir, doc_store = doc_store_local_sqlite
+    _test_snapshot(doc_store, sample_stored_doc_1, sample_owner_1, sample_invites_1, monkeypatch)
+
+
+def test_snapshot_redis(doc_store_local_redis, sample_stored_doc_1, sample_owner_1, sample_invites_1, monkeypatch):
+    tempdir, doc_store = doc_store_local_redis
+    doc_store.metadata.client.redis.flushall()
+    _test_snapshot(doc_store, sample_stored_doc_1, sample_owner_1, sample_invites_1, monkeypatch)
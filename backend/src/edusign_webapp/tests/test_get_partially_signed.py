@@ -107,12 +107,13 @@ def test_get_partially_signed(client, monkeypatch, sample_doc_1):
     resp_data = _test_get_partially_signed_doc(client, monkeypatch, sample_doc_1)
 
     assert resp_data['message'] == 'Success'
+    assert resp_data['payload']['blob'] == sample_doc_1['blob']
 
 
 def _test_get_partially_signed_with_problem(client, monkeypatch, sample_doc_1, mock_get_content):
     from edusign_webapp.doc_store import DocStore
 
-    monkeypatch.setattr(DocStore, 'get_document_content', mock_get_content)
+    monkeypatch.setattr(DocStore, 'get_document_stream', mock_get_content)
 
     return _test_get_partially_signed_doc(client, monkeypatch, sample_doc_1)
 
@@ -128,7 +129,7 @@ def test_get_partially_signed_raises(client, monkeypatch, sample_doc_1):
 
 def test_get_partially_signed_doesnt(client, monkeypatch, sample_doc_1):
     def mock_get_content(*args, **kwargs):
-        return False
+        return None
 
     resp_data = _test_get_partially_signed_with_problem(client, monkeypatch, sample_doc_1, mock_get_content)
 
@@ -194,6 +194,36 @@ def test_get_signed_documents(client, monkeypatch):
     assert signed_content in response.data
 
 
+def test_get_signed_documents_xml_not_stored(client, monkeypatch):
+    from edusign_webapp.doc_store import DocStore
+
+    def no_preview_cache(*args, **kwargs):
+        raise AssertionError("Previews of documents not in the doc store should not be cached")
+
+    monkeypatch.setattr(DocStore, 'get_document_preview', no_preview_cache)
+    monkeypatch.setattr(DocStore, 'add_document_preview', no_preview_cache)
+
+    process_data = {
+        'correlationId': '2a08e13e-8719-4b53-8586-662037f153ec',
+        'id': '09d91b6f-199c-4388-a4e5-230807dd4ac4',
+        'signedDocuments': [
+            {
+                'id': '6e46692d-7d34-4954-b760-96ee6ce48f61',
+                'mimeType': 'application/xml',
+                'signedContent': b64encode(b'<root><child>Dummy signed content</child></root>').decode('ascii'),
+            }
+        ],
+    }
+
+    response = _test_get_signed_documents(client, monkeypatch, process_data=process_data)
+
+    assert response.status == '200 OK'
+
+    resp_data = json.loads(response.data)
+
+    assert resp_data['payload']['documents'][0]['pprinted'] != ''
+
+
 def test_get_signed_documents_process_error(client, monkeypatch):
     process_data = {'errorCode': 'error.dss', 'message': 'dummy message'}
 
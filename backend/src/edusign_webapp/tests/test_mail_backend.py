@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import smtplib
+import threading
+from typing import List
+
+import pytest
+
+from edusign_webapp import run
+from edusign_webapp.mail_backend import MailSendError, ParallelEmailBackend
+from edusign_webapp.utils import compose_message, sendmail_bulk
+
+
+class FakeSMTP:
+    barrier = None
+    errors: List[Exception] = []
+    sent: List[List[str]] = []
+
+    def __init__(self, host, port, **kwargs):
+        self.timeout = kwargs.get('timeout')
+
+    def sendmail(self, from_email, recipients, message, mail_options=None):
+        if self.barrier is not None:
+            self.barrier.wait()
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(recipients)
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _send(monkeypatch, n, errors=(), barrier=None):
+    monkeypatch.setattr(ParallelEmailBackend, 'connection_class', property(lambda self: FakeSMTP))
+    monkeypatch.setattr(FakeSMTP, 'barrier', barrier)
+    monkeypatch.setattr(FakeSMTP, 'errors', list(errors))
+    monkeypatch.setattr(FakeSMTP, 'sent', [])
+    monkeypatch.setitem(run.app.config, 'MAIL_RETRY_BACKOFF', 0)
+    monkeypatch.setitem(run.app.config, 'MAIL_POOL_SIZE', 3)
+
+    with run.app.test_request_context():
+        msgs = [compose_message([f'user{i}@example.org'], 'subject', 'body', '<p>body</p>') for i in range(n)]
+        conn = run.app.extensions['mailer'].get_connection(backend=ParallelEmailBackend)
+        return conn.send_messages_in_parallel(msgs)
+
+
+def test_send_concurrently(monkeypatch):
+    # All connections in the pool must be sending at the same time to get past the barrier
+    report = _send(monkeypatch, 6, barrier=threading.Barrier(3, timeout=5))
+
+    assert report.sent == 6
+    assert report.connections == 3
+    assert report.failed == []
+    assert len(FakeSMTP.sent) == 6
+
+
+def test_send_retries_transient_error(monkeypatch):
+    report = _send(monkeypatch, 1, errors=[smtplib.SMTPServerDisconnected('Mock disconnection')])
+
+    assert report.sent == 1
+    assert report.retries == 1
+    assert report.connections == 2
+    assert report.failed == []
+
+
+def test_send_gives_up_after_retries(monkeypatch):
+    errors = [smtplib.SMTPResponseException(451, b'Try again later') for _ in range(3)]
+    report = _send(monkeypatch, 1, errors=errors)
+
+    assert report.sent == 0
+    assert report.retries == 2
+    assert len(report.failed) == 1
+    assert report.failed[0]['recipients'] == ['user0@example.org']
+
+
+def test_send_does_not_retry_permanent_error(monkeypatch):
+    errors = [smtplib.SMTPRecipientsRefused({'user0@example.org': (550, b'No such user')})]
+    report = _send(monkeypatch, 2, errors=errors)
+
+    assert report.sent == 1
+    assert report.retries == 0
+    assert len(report.failed) == 1
+
+
+def test_send_nothing(monkeypatch):
+    report = _send(monkeypatch, 0)
+
+    assert report.total == 0
+    assert report.sent == 0
+
+
+def _refuse_connection(self):
+    raise ConnectionRefusedError('Mock connection refused')
+
+
+def test_send_unreachable(monkeypatch):
+    monkeypatch.setattr(ParallelEmailBackend, 'open', _refuse_connection)
+    monkeypatch.setitem(run.app.config, 'MAIL_SEND_RETRIES', 0)
+    report = _send(monkeypatch, 2)
+
+    assert report.sent == 0
+    assert report.unreachable == 2
+    assert len(report.failed) == 2
+
+
+def test_sendmail_bulk_raises_if_unreachable(monkeypatch):
+    monkeypatch.setattr(ParallelEmailBackend, 'open', _refuse_connection)
+    monkeypatch.setitem(run.app.config, 'MAIL_BACKEND', 'smtp')
+    monkeypatch.setitem(run.app.config, 'MAIL_OUTBOX', False)
+    monkeypatch.setitem(run.app.config, 'MAIL_SEND_RETRIES', 0)
+    monkeypatch.setitem(run.app.config, 'MAIL_RETRY_BACKOFF', 0)
+
+    with run.app.test_request_context():
+        with pytest.raises(MailSendError) as exc_info:
+            sendmail_bulk([((['user0@example.org'], 'subject', 'body', '<p>body</p>'), {})])
+
+    assert exc_info.value.report.unreachable == 1
+
+
+def test_sendmail_bulk_partial_failure(monkeypatch):
+    monkeypatch.setattr(ParallelEmailBackend, 'connection_class', property(lambda self: FakeSMTP))
+    monkeypatch.setattr(FakeSMTP, 'barrier', None)
+    errors = [smtplib.SMTPRecipientsRefused({'user0@example.org': (550, b'No such user')})]
+    monkeypatch.setattr(FakeSMTP, 'errors', errors)
+    monkeypatch.setattr(FakeSMTP, 'sent', [])
+    monkeypatch.setitem(run.app.config, 'MAIL_BACKEND', 'smtp')
+    monkeypatch.setitem(run.app.config, 'MAIL_OUTBOX', False)
+
+    with run.app.test_request_context():
+        report = sendmail_bulk([(([f'user{i}@example.org'], 'subject', 'body', '<p>body</p>'), {}) for i in range(2)])
+
+    assert report.sent == 1
+    assert len(report.failed) == 1
@@ -32,7 +32,9 @@
 #
 import os
 import sqlite3
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from edusign_webapp import run
@@ -108,7 +110,7 @@ def test_add_raw(sqlite_md, redis_md, sample_metadata_1, sample_owner_1, sample_
     with run.app.app_context():
         document = sqlite_test_md.get_full_document(dummy_key)
         sqlite_test_md.remove(dummy_key, force=True)
-        ids = sqlite_test_md.get_old(0)
+        ids = list(sqlite_test_md.get_old(0))
 
         assert len(ids) == 0
 
@@ -877,3 +879,252 @@ def test_add_and_get_user(redis_md, sample_metadata_1, sample_owner_1, sample_in
         invite = invites[0]
 
     assert invite['email'] == sample_invites_1[0]['email']
+
+
+def test_add_and_get_preview(redis_md, sample_metadata_1, sample_owner_1, sample_invites_1):
+    _, test_md = redis_md
+    test_md.client.redis.flushall()
+    dummy_key = uuid.uuid4()
+
+    with run.app.app_context():
+        test_md.add(dummy_key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        test_md.add_preview(dummy_key, 'digest1', 'preview1')
+        preview = test_md.get_preview(dummy_key, 'digest1')
+        other = test_md.get_preview(dummy_key, 'digest2')
+        test_md.remove(dummy_key, force=True)
+        removed = test_md.get_preview(dummy_key, 'digest1')
+
+    assert preview == 'preview1'
+    assert other is None
+    assert removed is None
+
+
+def test_add_and_get_pending_aliases(redis_md, sample_metadata_1, sample_owner_1, sample_invites_1):
+    _, test_md = redis_md
+    test_md.client.redis.flushall()
+    dummy_key = uuid.uuid4()
+
+    with run.app.app_context():
+        test_md.add(dummy_key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+
+        pending = test_md.get_pending(['invite0@example.org', 'invite1@example.org'])
+        invites = test_md.get_full_invites(dummy_key)
+
+    assert len(pending) == 1
+    assert pending[0]['key'] == dummy_key
+    assert len(invites) == 1
+
+
+def test_add_two_and_get_owned_pipelined(
+    redis_md, sample_metadata_1, sample_metadata_2, sample_owner_1, sample_invites_1
+):
+    _, test_md = redis_md
+    test_md.client.redis.flushall()
+
+    with run.app.app_context():
+        test_md.add(uuid.uuid4(), sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        test_md.add(uuid.uuid4(), sample_metadata_2, sample_owner_1, sample_invites_1, *invitation_flags)
+        test_md.update(test_md.get_owned('owner-eppn@example.org')[0]['key'], ['invite0@example.org'])
+
+        owned = test_md.get_owned('owner-eppn@example.org')
+
+    assert sorted(doc['name'] for doc in owned) == ['test1.pdf', 'test2.pdf']
+    assert sorted(len(doc['signed']) for doc in owned) == [0, 1]
+    assert all(len(doc['signed']) + len(doc['pending']) == 2 for doc in owned)
+
+
+def test_outbox(redis_md):
+    _, test_md = redis_md
+    test_md.client.redis.flushall()
+
+    with run.app.app_context():
+        test_md.enqueue_emails(['message0', 'message1', 'message2'])
+        claimed = test_md.claim_emails(2, 300)
+        claimed_again = test_md.claim_emails(2, 300)
+        nothing_left = test_md.claim_emails(2, 300)
+
+        test_md.ack_emails([claimed[0]['msg_id']])
+        test_md.retry_email(claimed[1]['msg_id'], 0, 'Try again later')
+        test_md.dead_letter_email(claimed_again[0]['msg_id'], 'No such user')
+        retried = test_md.claim_emails(2, 300)
+
+        stats = test_md.get_outbox_stats()
+
+    assert [msg['message'] for msg in claimed] == ['message0', 'message1']
+    assert [msg['message'] for msg in claimed_again] == ['message2']
+    assert nothing_left == []
+    assert len(retried) == 1
+    assert retried[0]['message'] == 'message1'
+    assert retried[0]['attempts'] == 1
+    assert stats == {'pending': 1, 'dead': 1, 'enqueued': 3, 'sent': 1, 'retried': 1}
+
+
+def test_outbox_claim_expired_lease(redis_md):
+    _, test_md = redis_md
+    test_md.client.redis.flushall()
+
+    with run.app.app_context():
+        test_md.enqueue_emails(['message0'])
+        claimed = test_md.claim_emails(1, -1)
+        reclaimed = test_md.claim_emails(1, 300)
+
+    assert claimed[0]['msg_id'] == reclaimed[0]['msg_id']
+
+
+def test_add_two_and_remove_many(
+    redis_md, sample_metadata_1, sample_metadata_2, sample_owner_1, sample_invites_1, sample_invites_2
+):
+    _, test_md = redis_md
+    test_md.client.redis.flushall()
+    dummy_key_1 = uuid.uuid4()
+    dummy_key_2 = uuid.uuid4()
+
+    with run.app.app_context():
+        test_md.add(dummy_key_1, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        test_md.add(dummy_key_2, sample_metadata_2, sample_owner_1, sample_invites_2, *invitation_flags)
+        test_md.update(dummy_key_1, [sample_invites_1[0]['email']])
+        test_md.add_preview(dummy_key_1, 'digest1', 'preview1')
+
+        removed = test_md.remove_many([dummy_key_1, uuid.uuid4()])
+
+        owned = test_md.get_owned('owner-eppn@example.org')
+        pending = test_md.get_pending([sample_invites_1[1]['email']])
+        preview = test_md.get_preview(dummy_key_1, 'digest1')
+        invites = test_md.get_full_invites(dummy_key_2)
+
+    assert removed == [dummy_key_1]
+    assert len(owned) == 1
+    assert owned[0]['key'] == dummy_key_2
+    assert [doc['key'] for doc in pending] == [dummy_key_2] * len(pending)
+    assert preview is None
+    assert len(invites) == len(sample_invites_2)
+
+
+def test_document_stats(redis_md, sample_metadata_1, sample_metadata_2, sample_owner_1, sample_invites_1):
+    _, test_md = redis_md
+    test_md.client.redis.flushall()
+    dummy_key_1 = uuid.uuid4()
+    dummy_key_2 = uuid.uuid4()
+    dummy_key_3 = uuid.uuid4()
+    sample_metadata_3 = dict(sample_metadata_2, type='application/xml', size=1000)
+
+    with run.app.app_context():
+        test_md.add(dummy_key_1, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        test_md.add(dummy_key_2, sample_metadata_2, sample_owner_1, sample_invites_1, *invitation_flags)
+        test_md.add(dummy_key_3, sample_metadata_3, sample_owner_1, sample_invites_1, *invitation_flags)
+        stats = test_md.get_document_stats()
+
+    assert sorted(stats, key=lambda entry: entry['type']) == [
+        {'type': 'application/pdf', 'age': 0, 'count': 2, 'size': 3000000},
+        {'type': 'application/xml', 'age': 0, 'count': 1, 'size': 1000},
+    ]
+
+    with run.app.app_context():
+        test_md.remove(dummy_key_3, force=True)
+        test_md.remove_many([dummy_key_2])
+        stats = test_md.get_document_stats()
+
+    assert stats == [{'type': 'application/pdf', 'age': 0, 'count': 1, 'size': 1500000}]
+    assert not any(b'application/xml' in field for field in test_md.client.redis.hkeys('doc:stats'))
+
+
+def test_document_stats_rebuild(redis_md, sample_metadata_1, sample_metadata_2, sample_owner_1, sample_invites_1):
+    _, test_md = redis_md
+    test_md.client.redis.flushall()
+    dummy_key_1 = uuid.uuid4()
+    dummy_key_2 = uuid.uuid4()
+
+    with run.app.app_context():
+        test_md.add(dummy_key_1, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        test_md.add(dummy_key_2, sample_metadata_2, sample_owner_1, sample_invites_1, *invitation_flags)
+
+    # Simulate documents stored before the counters were kept, one of them 10 days old
+    doc_id = int(test_md.client.redis.get(f"doc:key:{dummy_key_1}"))
+    then = datetime.now().timestamp() - 10 * 24 * 3600
+    test_md.client.redis.hset(f"doc:{doc_id}", 'created', then)
+    test_md.client.redis.delete('doc:stats', 'doc:stats:ready')
+
+    with run.app.app_context():
+        stats = test_md.get_document_stats()
+
+    assert sorted(stats, key=lambda entry: entry['age']) == [
+        {'type': 'application/pdf', 'age': 0, 'count': 1, 'size': 1500000},
+        {'type': 'application/pdf', 'age': 10, 'count': 1, 'size': 1500000},
+    ]
+
+
+def test_get_old_in_batches(redis_md, sample_metadata_1, sample_owner_1, sample_invites_1, monkeypatch):
+    _, test_md = redis_md
+    test_md.client.redis.flushall()
+    monkeypatch.setitem(test_md.config, 'OLD_DOCUMENTS_BATCH_SIZE', 2)
+    keys = [uuid.uuid4() for _ in range(7)]
+
+    with run.app.app_context():
+        for key in keys:
+            test_md.add(key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+
+    # Make some documents old, several of them created at the very same time
+    then = datetime.now().timestamp() - 3 * 24 * 3600
+    scores = [then - 100, then, then, then, then + 100]
+    test_md.client.redis.zadd('doc:created', {str(key): score for key, score in zip(keys, scores)})
+
+    with run.app.app_context():
+        old = test_md.get_old(2)
+        first = [next(old), next(old)]
+        # Documents removed while iterating do not make the iteration skip others
+        test_md.remove_many(first)
+        rest = list(old)
+        all_docs = list(test_md.get_old(0))
+        older = list(test_md.get_old(4))
+
+    assert sorted(first + rest) == sorted(keys[:5])
+    assert len(first + rest) == 5
+    assert sorted(all_docs) == sorted(set(keys) - set(first))
+    assert older == []
+
+
+def test_lock_reentrant_and_exclusive(redis_md, sample_metadata_1, sample_owner_1, sample_invites_1):
+    _, test_md = redis_md
+    test_md.client.redis.flushall()
+    dummy_key = uuid.uuid4()
+    email_0 = sample_invites_1[0]['email']
+    email_1 = sample_invites_1[1]['email']
+
+    with run.app.app_context():
+        test_md.add(dummy_key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_id = test_md.get_document(dummy_key)['doc_id']
+
+        assert test_md.add_lock(doc_id, email_0)
+        assert test_md.add_lock(doc_id, email_0)
+        assert not test_md.add_lock(doc_id, email_1)
+        assert not test_md.rm_lock(doc_id, [email_1])
+        assert test_md.check_lock(doc_id, [email_1, email_0])
+        assert test_md.rm_lock(doc_id, ['alias@example.org', email_0])
+        assert test_md.rm_lock(doc_id, [email_1])
+        assert test_md.add_lock(doc_id, email_1)
+
+
+def test_lock_contention(redis_md, sample_metadata_1, sample_owner_1, sample_invites_1):
+    _, test_md = redis_md
+    test_md.client.redis.flushall()
+    dummy_key = uuid.uuid4()
+
+    with run.app.app_context():
+        test_md.add(dummy_key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_id = test_md.get_document(dummy_key)['doc_id']
+
+    barrier = threading.Barrier(8)
+
+    def _lock(i):
+        with run.app.app_context():
+            barrier.wait()
+            return test_md.add_lock(doc_id, f'user{i}@example.org')
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        locked = list(executor.map(_lock, range(8)))
+
+    with run.app.app_context():
+        holders = [i for i in range(8) if test_md.check_lock(doc_id, [f'user{i}@example.org'])]
+
+    assert locked.count(True) == 1
+    assert holders == [locked.index(True)]
@@ -32,11 +32,14 @@
 #
 import os
 import sqlite3
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 from datetime import datetime
 
 from edusign_webapp import run
+from edusign_webapp.document.metadata.sqlite import DOCUMENT_QUERY_FULL, SqliteMD, get_db
 
 invitation_flags = [
     True,  # sendsigned
@@ -741,3 +744,366 @@ def test_add_and_get_user(sqlite_md, sample_metadata_1, sample_owner_1, sample_i
         invites = test_md.add(dummy_key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
 
     assert invites[0]['email'] == sample_invites_1[0]['email']
+
+
+def test_add_and_get_preview(sqlite_md, sample_metadata_1, sample_owner_1, sample_invites_1):
+    tempdir, test_md = sqlite_md
+    dummy_key = uuid.uuid4()
+
+    with run.app.app_context():
+        test_md.add(dummy_key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        test_md.add_preview(dummy_key, 'digest1', 'preview1')
+        preview = test_md.get_preview(dummy_key, 'digest1')
+        other = test_md.get_preview(dummy_key, 'digest2')
+        test_md.rm_preview(dummy_key)
+        removed = test_md.get_preview(dummy_key, 'digest1')
+
+    assert preview == 'preview1'
+    assert other is None
+    assert removed is None
+
+
+def test_add_and_get_pending_aliases(sqlite_md, sample_metadata_1, sample_owner_1, sample_invites_1):
+    tempdir, test_md = sqlite_md
+    dummy_key = uuid.uuid4()
+
+    with run.app.app_context():
+        test_md.add(dummy_key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+
+        pending = test_md.get_pending(['invite0@example.org', 'invite1@example.org'])
+        invites = test_md.get_full_invites(dummy_key)
+
+    assert len(pending) == 1
+    assert pending[0]['key'] == dummy_key
+    assert len(invites) == 1
+    assert invites[0]['email'] == 'invite0@example.org'
+
+
+def test_add_two_ordered_and_get_pending_mixed(
+    sqlite_md, sample_metadata_1, sample_metadata_2, sample_owner_1, sample_invites_1
+):
+    tempdir, test_md = sqlite_md
+    dummy_key_1 = uuid.uuid4()
+    dummy_key_2 = uuid.uuid4()
+
+    flags = copy(invitation_flags)
+    flags[3] = True  # ordered
+    with run.app.app_context():
+        test_md.add(dummy_key_1, sample_metadata_1, sample_owner_1, sample_invites_1, *flags)
+        test_md.add(dummy_key_2, sample_metadata_2, sample_owner_1, sample_invites_1, *invitation_flags)
+
+        pending = test_md.get_pending(['invite1@example.org'])
+
+    assert len(pending) == 1
+    assert pending[0]['key'] == dummy_key_2
+    assert pending[0]['pending'] == [{'email': 'invite0@example.org', 'name': 'invite0', 'lang': 'en', 'order': 0}]
+
+
+def test_outbox(sqlite_md):
+    tempdir, test_md = sqlite_md
+
+    with run.app.app_context():
+        test_md.enqueue_emails(['message0', 'message1', 'message2'])
+        claimed = test_md.claim_emails(2, 300)
+        claimed_again = test_md.claim_emails(2, 300)
+        nothing_left = test_md.claim_emails(2, 300)
+
+        test_md.ack_emails([claimed[0]['msg_id']])
+        test_md.retry_email(claimed[1]['msg_id'], 0, 'Try again later')
+        test_md.dead_letter_email(claimed_again[0]['msg_id'], 'No such user')
+        retried = test_md.claim_emails(2, 300)
+
+        stats = test_md.get_outbox_stats()
+
+    assert [msg['message'] for msg in claimed] == ['message0', 'message1']
+    assert [msg['message'] for msg in claimed_again] == ['message2']
+    assert nothing_left == []
+    assert len(retried) == 1
+    assert retried[0]['message'] == 'message1'
+    assert retried[0]['attempts'] == 1
+    assert stats == {'pending': 1, 'dead': 1, 'enqueued': 3, 'sent': 1, 'retried': 1}
+
+
+def test_outbox_claim_expired_lease(sqlite_md):
+    tempdir, test_md = sqlite_md
+
+    with run.app.app_context():
+        test_md.enqueue_emails(['message0'])
+        claimed = test_md.claim_emails(1, -1)
+        reclaimed = test_md.claim_emails(1, 300)
+
+    assert claimed[0]['msg_id'] == reclaimed[0]['msg_id']
+
+
+def test_outbox_upgrade(sqlite_md):
+    tempdir, test_md = sqlite_md
+
+    with run.app.app_context():
+        test_md.get_outbox_stats()
+
+    conn = sqlite3.connect(test_md.db_path)
+    conn.execute("DROP TABLE [Outbox];")
+    conn.execute("DROP TABLE [OutboxCounters];")
+    conn.execute("PRAGMA user_version = 10;")
+    conn.commit()
+    conn.close()
+
+    # The schema is upgraded at startup
+    test_md = SqliteMD(test_md.app)
+
+    with run.app.app_context():
+        test_md.enqueue_emails(['message0'])
+        stats = test_md.get_outbox_stats()
+
+    assert stats['pending'] == 1
+
+
+def test_upgrade_from_version_0(sqlite_md, monkeypatch):
+    tempdir, test_md = sqlite_md
+    db_path = os.path.join(tempdir.name, 'test-v0.db')
+    doc_key = uuid.uuid4()
+    invite_key = uuid.uuid4()
+
+    conn = sqlite3.connect(db_path)
+    conn.executescript(
+        """
+        CREATE TABLE [Users]
+        (      [user_id] INTEGER PRIMARY KEY AUTOINCREMENT,
+               [email] VARCHAR(255) NOT NULL,
+               [name] VARCHAR(255) NOT NULL
+        );
+        CREATE TABLE [Documents]
+        (      [doc_id] INTEGER PRIMARY KEY AUTOINCREMENT,
+               [key] VARCHAR(255) NOT NULL,
+               [name] VARCHAR(255) NOT NULL,
+               [size] INTEGER NOT NULL,
+               [type] VARCHAR(50) NOT NULL,
+               [created] TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               [updated] TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               [owner] INTEGER NOT NULL,
+               [locked] TIMESTAMP DEFAULT NULL,
+               [locked_by] INTEGER DEFAULT NULL
+        );
+        CREATE TABLE [Invites]
+        (      [inviteID] INTEGER PRIMARY KEY AUTOINCREMENT,
+               [key] VARCHAR(255) NOT NULL,
+               [user_id] INTEGER NOT NULL,
+               [doc_id] INTEGER NOT NULL,
+               [signed] INTEGER DEFAULT 0,
+               [declined] INTEGER DEFAULT 0
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS [EmailIX] ON [Users] ([email]);
+        CREATE UNIQUE INDEX IF NOT EXISTS [KeyIX] ON [Documents] ([key]);
+        CREATE INDEX IF NOT EXISTS [OwnerIX] ON [Documents] ([owner]);
+        CREATE INDEX IF NOT EXISTS [InviteeIX] ON [Invites] ([user_id]);
+        CREATE INDEX IF NOT EXISTS [InvitedIX] ON [Invites] ([doc_id]);
+        INSERT INTO Users (email, name) VALUES ('owner@example.org', 'Owner');
+        INSERT INTO Users (email, name) VALUES ('invitee@example.org', 'Invitee');
+        """
+    )
+    conn.execute(
+        "INSERT INTO Documents (key, name, size, type, owner) VALUES (?, 'test.pdf', 100, 'application/pdf', 1);",
+        (str(doc_key),),
+    )
+    conn.execute("INSERT INTO Invites (key, user_id, doc_id) VALUES (?, 2, 1);", (str(invite_key),))
+    conn.commit()
+    conn.close()
+
+    # The schema is upgraded at startup, through all versions at once
+    monkeypatch.setitem(test_md.app.config, 'SQLITE_MD_DB_PATH', db_path)
+    test_md = SqliteMD(test_md.app)
+
+    with run.app.app_context():
+        version = get_db(db_path).execute("PRAGMA user_version;").fetchone()['user_version']
+        document = test_md.get_full_document(doc_key)
+        invitation = test_md.get_invitation(invite_key)
+        test_md.enqueue_emails(['message0'])
+        stats = test_md.get_outbox_stats()
+
+    assert version == 12
+    assert document['name'] == 'test.pdf'
+    assert document['owner_email'] == 'owner@example.org'
+    assert document['loa'] == 'low'
+    assert invitation['user']['email'] == 'invitee@example.org'
+    assert stats['pending'] == 1
+
+
+def test_connection_pool(sqlite_md, sample_metadata_1, sample_owner_1, sample_invites_1):
+    tempdir, test_md = sqlite_md
+    dummy_key = uuid.uuid4()
+
+    with run.app.app_context():
+        test_md.add(dummy_key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        first = get_db(test_md.db_path)
+        journal_mode = first.execute("PRAGMA journal_mode;").fetchone()['journal_mode']
+        synchronous = first.execute("PRAGMA synchronous;").fetchone()['synchronous']
+
+    with run.app.app_context():
+        second = get_db(test_md.db_path)
+        document = test_md.get_document(dummy_key)
+
+    assert first is second
+    assert journal_mode == 'wal'
+    assert synchronous == 1  # NORMAL
+    assert isinstance(document, dict)
+    assert document['name'] == 'test1.pdf'
+
+
+def test_rows(sqlite_md, sample_metadata_1, sample_owner_1, sample_invites_1):
+    tempdir, test_md = sqlite_md
+    dummy_key = uuid.uuid4()
+
+    with run.app.app_context():
+        test_md.add(dummy_key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        row = test_md._db_query(DOCUMENT_QUERY_FULL, (str(dummy_key),), one=True)
+        document = test_md.get_full_document(dummy_key)
+
+    assert isinstance(row, sqlite3.Row)
+    assert row['name'] == 'test1.pdf'
+    assert isinstance(document, dict)
+    assert document == dict(row)
+
+
+def test_connection_pool_rolls_back(sqlite_md, sample_metadata_1, sample_owner_1, sample_invites_1):
+    tempdir, test_md = sqlite_md
+    dummy_key = uuid.uuid4()
+
+    with run.app.app_context():
+        get_db(test_md.db_path).execute(
+            "INSERT INTO Documents (key, name, size, type, owner_eppn, owner_email, owner_name, owner_lang)"
+            " VALUES (?, 'uncommitted.pdf', 1, 'application/pdf', 'e', 'e', 'e', 'en');",
+            (str(dummy_key),),
+        )
+
+    with run.app.app_context():
+        document = test_md.get_document(dummy_key)
+
+    assert document == {}
+
+
+def test_add_two_and_remove_many(
+    sqlite_md, sample_metadata_1, sample_metadata_2, sample_owner_1, sample_invites_1, sample_invites_2
+):
+    tempdir, test_md = sqlite_md
+    dummy_key_1 = uuid.uuid4()
+    dummy_key_2 = uuid.uuid4()
+
+    with run.app.app_context():
+        test_md.add(dummy_key_1, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        test_md.add(dummy_key_2, sample_metadata_2, sample_owner_1, sample_invites_2, *invitation_flags)
+        test_md.update(dummy_key_1, [sample_invites_1[0]['email']])
+        test_md.add_preview(dummy_key_1, 'digest1', 'preview1')
+
+        removed = test_md.remove_many([dummy_key_1, uuid.uuid4()])
+
+        owned = test_md.get_owned('owner-eppn@example.org')
+        pending = test_md.get_pending([sample_invites_1[1]['email']])
+        preview = test_md.get_preview(dummy_key_1, 'digest1')
+        invites = test_md.get_full_invites(dummy_key_2)
+
+    assert removed == [dummy_key_1]
+    assert len(owned) == 1
+    assert owned[0]['key'] == dummy_key_2
+    assert [doc['key'] for doc in pending] == [dummy_key_2] * len(pending)
+    assert preview is None
+    assert len(invites) == len(sample_invites_2)
+
+
+def test_document_stats(sqlite_md, sample_metadata_1, sample_metadata_2, sample_owner_1, sample_invites_1):
+    tempdir, test_md = sqlite_md
+    dummy_key_1 = uuid.uuid4()
+    dummy_key_2 = uuid.uuid4()
+    dummy_key_3 = uuid.uuid4()
+    sample_metadata_3 = dict(sample_metadata_2, type='application/xml', size=1000)
+
+    with run.app.app_context():
+        test_md.add(dummy_key_1, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        test_md.add(dummy_key_2, sample_metadata_2, sample_owner_1, sample_invites_1, *invitation_flags)
+        test_md.add(dummy_key_3, sample_metadata_3, sample_owner_1, sample_invites_1, *invitation_flags)
+        stats = test_md.get_document_stats()
+
+    assert sorted(stats, key=lambda entry: entry['type']) == [
+        {'type': 'application/pdf', 'age': 0, 'count': 2, 'size': 3000000},
+        {'type': 'application/xml', 'age': 0, 'count': 1, 'size': 1000},
+    ]
+
+    conn = sqlite3.connect(test_md.db_path)
+    conn.execute("UPDATE Documents SET created = datetime('now', '-10 days') WHERE key = ?;", (str(dummy_key_1),))
+    conn.commit()
+    conn.close()
+
+    with run.app.app_context():
+        test_md.remove(dummy_key_3, force=True)
+        stats = test_md.get_document_stats()
+        old = list(test_md.get_old(10))
+
+    assert sorted(stats, key=lambda entry: entry['age']) == [
+        {'type': 'application/pdf', 'age': 0, 'count': 1, 'size': 1500000},
+        {'type': 'application/pdf', 'age': 10, 'count': 1, 'size': 1500000},
+    ]
+    assert old == [dummy_key_1]
+
+
+def test_get_old_in_batches(sqlite_md, sample_metadata_1, sample_owner_1, sample_invites_1, monkeypatch):
+    tempdir, test_md = sqlite_md
+    monkeypatch.setitem(test_md.config, 'OLD_DOCUMENTS_BATCH_SIZE', 2)
+    keys = [uuid.uuid4() for _ in range(5)]
+
+    with run.app.app_context():
+        for key in keys:
+            test_md.add(key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+
+        old = test_md.get_old(0)
+        first = [next(old), next(old), next(old)]
+        # Documents removed while iterating do not make the iteration skip others
+        test_md.remove_many(first)
+        rest = list(old)
+        no_old = list(test_md.get_old(1))
+
+    assert first + rest == keys
+    assert no_old == []
+
+
+def test_lock_reentrant_and_exclusive(sqlite_md, sample_metadata_1, sample_owner_1, sample_invites_1):
+    tempdir, test_md = sqlite_md
+    dummy_key = uuid.uuid4()
+    email_0 = sample_invites_1[0]['email']
+    email_1 = sample_invites_1[1]['email']
+
+    with run.app.app_context():
+        test_md.add(dummy_key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_id = test_md.get_document(dummy_key)['doc_id']
+
+        assert test_md.add_lock(doc_id, email_0)
+        assert test_md.add_lock(doc_id, email_0)
+        assert not test_md.add_lock(doc_id, email_1)
+        assert not test_md.rm_lock(doc_id, [email_1])
+        assert test_md.check_lock(doc_id, [email_1, email_0])
+        assert test_md.rm_lock(doc_id, ['alias@example.org', email_0])
+        assert test_md.rm_lock(doc_id, [email_1])
+        assert test_md.add_lock(doc_id, email_1)
+
+
+def test_lock_contention(sqlite_md, sample_metadata_1, sample_owner_1, sample_invites_1):
+    tempdir, test_md = sqlite_md
+    dummy_key = uuid.uuid4()
+
+    with run.app.app_context():
+        test_md.add(dummy_key, sample_metadata_1, sample_owner_1, sample_invites_1, *invitation_flags)
+        doc_id = test_md.get_document(dummy_key)['doc_id']
+
+    barrier = threading.Barrier(8)
+
+    def _lock(i):
+        with run.app.app_context():
+            barrier.wait()
+            return test_md.add_lock(doc_id, f'user{i}@example.org')
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        locked = list(executor.map(_lock, range(8)))
+
+    with run.app.app_context():
+        holders = [i for i in range(8) if test_md.check_lock(doc_id, [f'user{i}@example.org'])]
+
+    assert locked.count(True) == 1
+    assert holders == [locked.index(True)]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+from edusign_webapp.metrics import document_metrics, format_metric
+
+
+def test_format_metric():
+    text = format_metric(
+        'edusign_test', 'A test metric.', 'gauge', [({'label': 'with "quotes"\\'}, 1), ({'label': 'plain'}, 2)]
+    )
+
+    assert text == (
+        '# HELP edusign_test A test metric.\n'
+        '# TYPE edusign_test gauge\n'
+        'edusign_test{label="with \\"quotes\\"\\\\"} 1\n'
+        'edusign_test{label="plain"} 2\n'
+    )
+
+
+def test_format_metric_no_labels():
+    text = format_metric('edusign_test_total', 'A test counter.', 'counter', [({}, 3)])
+
+    assert text.endswith('\nedusign_test_total 3\n')
+
+
+def test_document_metrics():
+    stats = [
+        {'type': 'application/pdf', 'age': 0, 'count': 2, 'size': 200},
+        {'type': 'application/pdf', 'age': 10, 'count': 3, 'size': 300},
+        {'type': 'application/xml', 'age': 40, 'count': 1, 'size': 10},
+    ]
+
+    text = document_metrics(stats, [30, 7, 30])
+
+    assert 'edusign_documents{type="application/pdf"} 5\n' in text
+    assert 'edusign_documents{type="application/xml"} 1\n' in text
+    assert 'edusign_documents_bytes{type="application/pdf"} 500\n' in text
+    assert 'edusign_documents_older_than{days="7"} 4\n' in text
+    assert 'edusign_documents_older_than{days="30"} 1\n' in text
+    assert 'edusign_documents_older_than_bytes{days="7"} 310\n' in text
+    assert text.count('edusign_documents_older_than{days="30"}') == 1
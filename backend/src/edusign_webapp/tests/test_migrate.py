@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import json
+import os
+import tempfile
+import uuid
+
+import pytest
+from moto import mock_aws
+
+from edusign_webapp import run
+from edusign_webapp.doc_store import DocStore
+from edusign_webapp.migrate import MigrationError, get_migration_source, migrate_documents, verify_migration
+from edusign_webapp.tests.conftest import config_dev
+
+invitation_flags = [
+    True,  # sendsigned
+    'any',  # loa
+    False,  # skipfinal
+    False,  # ordered
+    'Invitation text',  # invitation_text
+]
+
+
+@pytest.fixture
+def migration_app():
+    tempdir = tempfile.TemporaryDirectory()
+    config = {
+        'STORAGE_CLASS_PATH': 'edusign_webapp.document.storage.s3.S3Storage',
+        'DOC_METADATA_CLASS_PATH': 'edusign_webapp.document.metadata.redis_client.RedisMD',
+        'AWS_REGION_NAME': 'us-east-1',
+        'LOCAL_STORAGE_BASE_DIR': tempdir.name,
+    }
+    config.update(config_dev)
+    app = run.edusign_init_app('testing', config)
+    app.testing = True
+    app.extensions['doc_store'] = DocStore(app)
+    app.extensions['doc_store'].metadata.client.redis.flushall()
+    # return tempdir, since once it goes out of scope, it is removed
+    yield tempdir, app
+
+
+def _setup(app, sample_doc, owner, invites, n):
+    app.extensions['doc_store'].storage.s3.create_bucket(Bucket='edusign-storage')
+    source = get_migration_source(app)
+    keys = []
+    with app.app_context():
+        for i in range(n):
+            doc = dict(sample_doc, key=str(uuid.uuid4()), blob=sample_doc['blob'] + b'%d' % i)
+            source.add_document(doc, owner, invites, *invitation_flags)
+            keys.append(uuid.UUID(doc['key']))
+    return source, keys
+
+
+@mock_aws
+def test_migrate_documents(migration_app, sample_stored_doc_1, sample_owner_1, sample_invites_1):
+    tempdir, app = migration_app
+    source, keys = _setup(app, sample_stored_doc_1, sample_owner_1, sample_invites_1, 5)
+    checkpoint_path = os.path.join(tempdir.name, 'migration.json')
+    with app.app_context():
+        no_invites = dict(sample_stored_doc_1, key=str(uuid.uuid4()))
+        source.add_document(no_invites, sample_owner_1, [], *invitation_flags)
+        no_contents = dict(sample_stored_doc_1, key=str(uuid.uuid4()))
+        source.add_document(no_contents, sample_owner_1, sample_invites_1, *invitation_flags)
+        source.storage.remove(uuid.UUID(no_contents['key']))
+
+    progress = []
+    dest = app.extensions['doc_store']
+
+    with app.app_context():
+        checkpoint = migrate_documents(
+            app, source.metadata, source.storage, checkpoint_path, 2, 2, progress=lambda c: progress.append(dict(c))
+        )
+        contents = [dest.get_document_content(key) for key in keys]
+        invites = [dest.get_full_invites(key) for key in keys]
+        report = verify_migration(app, source.metadata, source.storage, 2, 2)
+
+    size = len(sample_stored_doc_1['blob']) + 1
+    assert checkpoint == {
+        'last_doc_id': 7,
+        'documents': 5,
+        'invites': 5 * len(sample_invites_1),
+        'bytes': 5 * size,
+        'skipped': 1,
+        'missing': 1,
+    }
+    with open(checkpoint_path) as f:
+        assert json.load(f) == checkpoint
+    assert [c['last_doc_id'] for c in progress] == [2, 4, 6, 7]
+    assert contents == [sample_stored_doc_1['blob'] + b'%d' % i for i in range(5)]
+    assert [len(invite) for invite in invites] == [len(sample_invites_1)] * 5
+    assert report == {'documents': 6, 'bytes': 5 * size, 'missing': 0, 'mismatched': 0, 'problems': []}
+
+
+@mock_aws
+def test_migrate_documents_resume(migration_app, sample_stored_doc_1, sample_owner_1, sample_invites_1, monkeypatch):
+    tempdir, app = migration_app
+    source, keys = _setup(app, sample_stored_doc_1, sample_owner_1, sample_invites_1, 5)
+    checkpoint_path = os.path.join(tempdir.name, 'migration.json')
+    dest = app.extensions['doc_store']
+    add_document_stream = dest.add_document_stream
+
+    def _failing_add_document_stream(key, stream):
+        if key == keys[3]:
+            raise IOError('Connection reset')
+        add_document_stream(key, stream)
+
+    monkeypatch.setattr(dest, 'add_document_stream', _failing_add_document_stream)
+
+    with app.app_context():
+        with pytest.raises(MigrationError):
+            migrate_documents(app, source.metadata, source.storage, checkpoint_path, 2, 2)
+
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+
+    assert checkpoint['last_doc_id'] == 2
+    assert checkpoint['documents'] == 3
+
+    monkeypatch.setattr(dest, 'add_document_stream', add_document_stream)
+
+    with app.app_context():
+        checkpoint = migrate_documents(app, source.metadata, source.storage, checkpoint_path, 2, 2)
+        stats = dest.get_document_stats()
+        report = verify_migration(app, source.metadata, source.storage, 2, 2)
+
+    assert checkpoint['last_doc_id'] == 5
+    assert checkpoint['documents'] == 5
+    assert checkpoint['invites'] == 5 * len(sample_invites_1)
+    assert sum(entry['count'] for entry in stats) == 5
+    assert report['missing'] == 0
+    assert report['mismatched'] == 0
+
+
+@mock_aws
+def test_verify_migration(migration_app, sample_stored_doc_1, sample_owner_1, sample_invites_1):
+    tempdir, app = migration_app
+    source, keys = _setup(app, sample_stored_doc_1, sample_owner_1, sample_invites_1, 3)
+    checkpoint_path = os.path.join(tempdir.name, 'migration.json')
+    dest = app.extensions['doc_store']
+
+    with app.app_context():
+        migrate_documents(app, source.metadata, source.storage, checkpoint_path, 10, 2)
+        dest.remove_document(keys[0], force=True)
+        dest.storage.update(keys[1], b'other contents')
+        report = verify_migration(app, source.metadata, source.storage, 10, 2)
+
+    assert report['documents'] == 3
+    assert report['missing'] == 1
+    assert report['mismatched'] == 1
+    assert report['problems'] == [str(keys[0]), str(keys[1])]
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import smtplib
+from base64 import b64decode
+from typing import List
+
+import pytest
+
+from edusign_webapp import outbox
+from edusign_webapp.mail_backend import ParallelEmailBackend
+from edusign_webapp.outbox import process_outbox_batch, run_worker
+from edusign_webapp.utils import EncodedAttachment, deserialize_message, sendmail, sendmail_bulk, serialize_message
+
+
+@pytest.fixture
+def app(app):
+    tempdir, app = app
+    app.config['MAIL_OUTBOX'] = True
+    yield tempdir, app
+
+
+class FakeSMTP:
+    errors: List[Exception] = []
+    sent: List[List[str]] = []
+
+    def __init__(self, host, port, **kwargs):
+        pass
+
+    def sendmail(self, from_email, recipients, message, mail_options=None):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(recipients)
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _use_smtp(monkeypatch, app, errors=()):
+    monkeypatch.setattr(ParallelEmailBackend, 'connection_class', property(lambda self: FakeSMTP))
+    monkeypatch.setattr(FakeSMTP, 'errors', list(errors))
+    monkeypatch.setattr(FakeSMTP, 'sent', [])
+    monkeypatch.setitem(app.config, 'MAIL_BACKEND', 'smtp')
+    monkeypatch.setitem(app.config, 'MAIL_SEND_RETRIES', 0)
+
+
+def _enqueue(app, n):
+    with app.app_context():
+        sendmail_bulk(
+            [(([f'user{i}@example.org'], 'subject', 'body', '<p>body</p>'), {}) for i in range(n)],
+        )
+
+
+def test_serialize_message():
+    args = (['user0@example.org'], 'subject', 'body', '<p>body</p>')
+    kwargs = {'attachment_name': 'test.pdf', 'attachment': b'%PDF-1.4 \xff'}
+
+    data = deserialize_message(serialize_message(args, kwargs))
+    attachment = data.pop('attachment')
+
+    assert data == {
+        'recipients': ['user0@example.org'],
+        'subject': 'subject',
+        'body_txt': 'body',
+        'body_html': '<p>body</p>',
+        'attachment_name': 'test.pdf',
+    }
+    assert b64decode(attachment.payload) == b'%PDF-1.4 \xff'
+
+
+def test_serialize_message_encoded_attachment():
+    args = (['user0@example.org'], 'subject', 'body', '<p>body</p>')
+    attachment = EncodedAttachment(b'%PDF-1.4 \xff')
+    kwargs = {'attachment_name': 'test.pdf', 'attachment': attachment}
+
+    data = deserialize_message(serialize_message(args, kwargs))
+
+    assert data['attachment'].payload == attachment.payload
+
+
+def test_sendmail_enqueues(app):
+    _, app = app
+
+    with app.app_context():
+        sendmail(['user0@example.org'], 'subject', 'body', '<p>body</p>')
+        sendmail_bulk([])
+        stats = app.extensions['doc_store'].get_outbox_stats()
+
+    assert stats['pending'] == 1
+    assert stats['enqueued'] == 1
+
+
+def test_process_batch(app, monkeypatch):
+    _, app = app
+    _use_smtp(monkeypatch, app)
+    monkeypatch.setitem(app.config, 'MAIL_OUTBOX_BATCH_SIZE', 2)
+    _enqueue(app, 3)
+
+    with app.app_context():
+        first = process_outbox_batch()
+        second = process_outbox_batch()
+        third = process_outbox_batch()
+        stats = app.extensions['doc_store'].get_outbox_stats()
+
+    assert (first, second, third) == (2, 1, 0)
+    assert len(FakeSMTP.sent) == 3
+    assert stats['pending'] == 0
+    assert stats['sent'] == 3
+
+
+def test_process_batch_retries_transient_error(app, monkeypatch):
+    _, app = app
+    _use_smtp(monkeypatch, app, errors=[smtplib.SMTPResponseException(451, b'Try again later')])
+    monkeypatch.setitem(app.config, 'MAIL_OUTBOX_RETRY_DELAY', 0)
+    _enqueue(app, 1)
+
+    with app.app_context():
+        process_outbox_batch()
+        stats_after_failure = app.extensions['doc_store'].get_outbox_stats()
+        process_outbox_batch()
+        stats = app.extensions['doc_store'].get_outbox_stats()
+
+    assert stats_after_failure['pending'] == 1
+    assert stats_after_failure['retried'] == 1
+    assert len(FakeSMTP.sent) == 1
+    assert stats['pending'] == 0
+    assert stats['sent'] == 1
+
+
+def test_process_batch_dead_letters_after_max_attempts(app, monkeypatch):
+    _, app = app
+    errors = [smtplib.SMTPResponseException(451, b'Try again later') for _ in range(2)]
+    _use_smtp(monkeypatch, app, errors=errors)
+    monkeypatch.setitem(app.config, 'MAIL_OUTBOX_RETRY_DELAY', 0)
+    monkeypatch.setitem(app.config, 'MAIL_OUTBOX_MAX_ATTEMPTS', 2)
+    _enqueue(app, 1)
+
+    with app.app_context():
+        process_outbox_batch()
+        process_outbox_batch()
+        claimed = process_outbox_batch()
+        stats = app.extensions['doc_store'].get_outbox_stats()
+
+    assert claimed == 0
+    assert FakeSMTP.sent == []
+    assert stats['pending'] == 0
+    assert stats['dead'] == 1
+    assert stats['retried'] == 1
+
+
+def test_process_batch_dead_letters_permanent_error(app, monkeypatch):
+    _, app = app
+    errors = [smtplib.SMTPRecipientsRefused({'user0@example.org': (550, b'No such user')})]
+    _use_smtp(monkeypatch, app, errors=errors)
+    _enqueue(app, 2)
+
+    with app.app_context():
+        process_outbox_batch()
+        stats = app.extensions['doc_store'].get_outbox_stats()
+
+    assert len(FakeSMTP.sent) == 1
+    assert stats['sent'] == 1
+    assert stats['dead'] == 1
+    assert stats['retried'] == 0
+
+
+def test_process_batch_send_raises(app, monkeypatch):
+    _, app = app
+
+    def mock_send(msgs):
+        raise ConnectionRefusedError('Mock connection refused')
+
+    monkeypatch.setattr(outbox, '_send', mock_send)
+    monkeypatch.setitem(app.config, 'MAIL_OUTBOX_RETRY_DELAY', 0)
+    monkeypatch.setitem(app.config, 'MAIL_OUTBOX_MAX_ATTEMPTS', 2)
+    _enqueue(app, 2)
+
+    with app.app_context():
+        first = process_outbox_batch()
+        stats_after_failure = app.extensions['doc_store'].get_outbox_stats()
+        second = process_outbox_batch()
+        third = process_outbox_batch()
+        stats = app.extensions['doc_store'].get_outbox_stats()
+
+    assert (first, second, third) == (2, 2, 0)
+    assert stats_after_failure['pending'] == 2
+    assert stats_after_failure['retried'] == 2
+    assert stats['pending'] == 0
+    assert stats['dead'] == 2
+
+
+def test_run_worker_once(app):
+    _, app = app
+    _enqueue(app, 3)
+
+    run_worker(app, once=True)
+
+    with app.app_context():
+        stats = app.extensions['doc_store'].get_outbox_stats()
+
+    assert stats['pending'] == 0
+    assert stats['sent'] == 3
@@ -30,12 +30,21 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import io
 import json
+import time
+from base64 import b64decode
 from unittest import TestCase
 
+import fitz
+import pikepdf
 import pytest
+from marshmallow import ValidationError
 
+from edusign_webapp import forms, run
 from edusign_webapp.marshal import ResponseSchema
+from edusign_webapp.schemata import FillFormSchema
+from edusign_webapp.workers import PoolTimeout, _timed_call
 
 
 def _test_get_form(app, environ_base, monkeypatch, form_data):
@@ -97,3 +106,144 @@ def test_get_form_1(app, environ_base, monkeypatch, sample_form_1):
 @pytest.mark.skip(reason="We do not do this any more. Transform these to test filling in a PDF form")
 def test_get_form_2(app, environ_base, monkeypatch, sample_form_2):
     _test_get_form(app, environ_base, monkeypatch, sample_form_2)
+
+
+def test_update_form(app, environ_base, monkeypatch, sample_form_1):
+    _, app = app
+
+    client = app.test_client()
+    client.environ_base.update(environ_base)
+
+    response1 = client.get('/sign/')
+
+    assert response1.status == '200 OK'
+
+    doc_data = {
+        'payload': {'document': sample_form_1['pdf'], 'form_fields': [{'name': 'City Text Box', 'value': 'Uppsala'}]}
+    }
+
+    with app.test_request_context():
+        with client.session_transaction() as sess:
+            csrf_token = ResponseSchema().get_csrf_token({}, sess=sess)['csrf_token']
+            user_key = sess['user_key']
+
+    from flask.sessions import SecureCookieSession
+
+    def mock_getitem(self, key):
+        if key == 'user_key':
+            return user_key
+        self.accessed = True
+        return super(SecureCookieSession, self).__getitem__(key)
+
+    monkeypatch.setattr(SecureCookieSession, '__getitem__', mock_getitem)
+
+    doc_data['csrf_token'] = csrf_token
+
+    try:
+        response = client.post(
+            '/sign/update-form',
+            headers={
+                'X-Requested-With': 'XMLHttpRequest',
+                'Origin': 'https://test.localhost',
+                'X-Forwarded-Host': 'test.localhost',
+            },
+            json=doc_data,
+        )
+    finally:
+        app.extensions['pdf_workers'].shutdown()
+
+    assert response.status == '200 OK'
+
+    resp_data = json.loads(response.data)
+
+    assert resp_data['message'] == 'Success'
+
+    doc = fitz.open(stream=b64decode(resp_data['payload']['document']), filetype='application/pdf')
+    values = {widget.field_name: widget.field_value for page in doc for widget in page.widgets()}
+
+    assert values['City Text Box'] == 'Uppsala'
+    assert app.extensions['pdf_workers'].stats()['completed'] == 1
+
+
+@pytest.mark.parametrize('document', ['abc', 'åäö'])
+def test_fill_form_bad_document(document):
+    with run.app.test_request_context():
+        with pytest.raises(ValidationError):
+            FillFormSchema().load({'document': document, 'form_fields': []})
+
+
+def test_update_pdf_form(sample_form_1):
+    fields = [
+        {'name': 'City Text Box', 'value': 'Uppsala'},
+        {'name': 'City Text Box', 'value': 'Lund'},
+        {'name': 'Driving License Check Box', 'value': 'on'},
+        {'name': 'Language 2 Check Box', 'value': 'off'},
+        {'name': 'Not In The Form', 'value': 'ignored'},
+    ]
+    updated = forms.update_pdf_form(b64decode(sample_form_1['pdf']), fields)
+
+    doc = fitz.open(stream=updated, filetype='application/pdf')
+    values, read_only = {}, []
+    for page in doc:
+        for widget in page.widgets():
+            values[widget.field_name] = widget.field_value
+            read_only.append(bool(widget.field_flags & fitz.PDF_FIELD_IS_READ_ONLY))
+
+    assert values['City Text Box'] == 'Uppsala'
+    assert values['Driving License Check Box'] not in ('Off', False)
+    assert values['Language 2 Check Box'] in ('Off', False)
+    assert values['Family Name Text Box'] == ''
+    assert all(read_only)
+
+
+def test_update_pdf_form_timeout(sample_form_1, monkeypatch):
+    pdf = _claiming_pdfa(b64decode(sample_form_1['pdf']), '2', 'B')
+
+    def slow_convert_to_pdfa(doc):
+        while True:
+            pass
+
+    monkeypatch.setattr(forms, 'convert_to_pdfa', slow_convert_to_pdfa)
+
+    # The deadline is reached within the conversion to PDF/A, which must not be taken as a failed conversion
+    with pytest.raises(PoolTimeout):
+        _timed_call(forms.update_pdf_form, (pdf, []), time.time() + 0.2)
+
+
+def _claiming_pdfa(content, part, conformance):
+    pdf = pikepdf.open(io.BytesIO(content))
+    with pdf.open_metadata(set_pikepdf_as_editor=False) as meta:
+        meta['pdfaid:part'] = part
+        meta['pdfaid:conformance'] = conformance
+    claiming = io.BytesIO()
+    pdf.save(claiming)
+    return claiming.getvalue()
+
+
+def test_claims_pdfa_in_memory(sample_binary_pdf_data, monkeypatch):
+    content = _claiming_pdfa(sample_binary_pdf_data, '2', 'B')
+
+    def no_temp_dirs(*args, **kwargs):
+        raise AssertionError("PDF/A claims should be checked in memory")
+
+    monkeypatch.setattr(forms, 'TemporaryDirectory', no_temp_dirs)
+
+    assert forms.claims_pdfa(content)
+    assert not forms.claims_pdfa(sample_binary_pdf_data)
+
+
+def test_claims_pdfa_loaded_doc(sample_binary_pdf_data, monkeypatch):
+    content = _claiming_pdfa(sample_binary_pdf_data, '3', 'u')
+    doc = fitz.open(stream=content, filetype='application/pdf')
+
+    def no_loading(pdf):
+        raise AssertionError("The loaded document should be used")
+
+    monkeypatch.setattr(forms, '_load_pdf', no_loading)
+
+    assert forms.claims_pdfa(content, doc)
+
+
+def test_claims_pdfa_unknown_version(sample_binary_pdf_data):
+    assert not forms.claims_pdfa(_claiming_pdfa(sample_binary_pdf_data, '4', 'B'))
+    assert not forms.claims_pdfa(_claiming_pdfa(sample_binary_pdf_data, '2', 'X'))
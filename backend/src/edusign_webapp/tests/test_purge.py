@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import uuid
+
+from edusign_webapp.purge import purge_documents
+
+invitation_flags = [
+    True,  # sendsigned
+    'any',  # loa
+    False,  # skipfinal
+    False,  # ordered
+    'Invitation text',  # invitation_text
+]
+
+
+def _add_documents(app, sample_doc, owner, invites, n):
+    doc_store = app.extensions['doc_store']
+    keys = []
+    with app.app_context():
+        for _ in range(n):
+            doc = dict(sample_doc, key=str(uuid.uuid4()))
+            doc_store.add_document(doc, owner, invites, *invitation_flags)
+            keys.append(uuid.UUID(doc['key']))
+    return keys
+
+
+def test_purge_documents(app, sample_stored_doc_1, sample_owner_1, sample_invites_1):
+    _, test_app = app
+    keys = _add_documents(test_app, sample_stored_doc_1, sample_owner_1, sample_invites_1, 5)
+    progress = []
+
+    processed, removed = purge_documents(test_app, keys, 2, 2, progress=lambda p, r: progress.append((p, r)))
+
+    assert processed == 5
+    assert removed == 5
+    assert len(progress) == 3
+    assert progress[-1] == (5, 5)
+    with test_app.app_context():
+        doc_store = test_app.extensions['doc_store']
+        assert list(doc_store.get_old_documents(0)) == []
+        assert doc_store.get_owned_documents(sample_owner_1['eppn'], [sample_owner_1['email']]) == []
+
+
+def test_purge_documents_unknown_keys(app, sample_stored_doc_1, sample_owner_1, sample_invites_1):
+    _, test_app = app
+    keys = _add_documents(test_app, sample_stored_doc_1, sample_owner_1, sample_invites_1, 2)
+
+    processed, removed = purge_documents(test_app, keys + [uuid.uuid4()], 10, 4)
+
+    assert processed == 3
+    assert removed == 2
+
+
+def test_purge_documents_empty(app):
+    _, test_app = app
+
+    assert purge_documents(test_app, iter([]), 10, 4) == (0, 0)
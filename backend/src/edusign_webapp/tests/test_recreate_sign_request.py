@@ -31,6 +31,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import json
+import threading
+import time
 import uuid
 
 from edusign_webapp import run
@@ -547,3 +549,107 @@ def test_recreate_sign_request_bad_api_response(client, monkeypatch, sample_doc_
 
         assert resp_data['error']
         assert resp_data['message'] == 'dummy message'
+
+
+def _recreate_two_docs(client, monkeypatch, sample_doc_1, mock_prepare):
+    from edusign_webapp.api_client import APIClient
+
+    def mock_post(self, url, *args, **kwargs):
+        if 'prepare' in url:
+            mock_prepare(url)
+            return {
+                'policy': 'edusign-test',
+                'updatedPdfDocumentReference': 'ba26478f-f8e0-43db-991c-08af7c65ed58',
+                'visiblePdfSignatureRequirement': {},
+            }
+
+        return {
+            'binding': 'POST/XML/1.0',
+            'destinationUrl': 'https://sig.idsec.se/sigservice-dev/request',
+            'relayState': '31dc573b-ab7d-496c-845e-cae8792ba063',
+            'signRequest': 'DUMMY SIGN REQUEST',
+            'state': {'id': '31dc573b-ab7d-496c-845e-cae8792ba063'},
+        }
+
+    monkeypatch.setattr(APIClient, '_post', mock_post)
+
+    response1 = client.get('/sign/')
+
+    assert response1.status == '200 OK'
+
+    with client.session_transaction() as sess:
+        csrf_token = ResponseSchema().get_csrf_token({}, sess=sess)['csrf_token']
+        user_key = sess['user_key']
+
+        from flask.sessions import SecureCookieSession
+
+        def mock_getitem(self, key):
+            if key == 'user_key':
+                return user_key
+            self.accessed = True
+            return super(SecureCookieSession, self).__getitem__(key)
+
+        monkeypatch.setattr(SecureCookieSession, '__getitem__', mock_getitem)
+
+        doc_data = {
+            'csrf_token': csrf_token,
+            'payload': {
+                'documents': {
+                    'local': [
+                        {
+                            'name': name,
+                            'size': 100,
+                            'type': 'application/pdf',
+                            'blob': sample_doc_1['blob'],
+                            'key': str(uuid.uuid4()),
+                        }
+                        for name in ('test1.pdf', 'test2.pdf')
+                    ],
+                    'owned': [],
+                    'invited': [],
+                }
+            },
+        }
+
+        response = client.post(
+            '/sign/recreate-sign-request',
+            headers={
+                'X-Requested-With': 'XMLHttpRequest',
+                'Origin': 'https://test.localhost',
+                'X-Forwarded-Host': 'test.localhost',
+            },
+            json=doc_data,
+        )
+
+        assert response.status == '200 OK'
+
+        return json.loads(response.data)
+
+
+def test_recreate_sign_request_prepares_concurrently(client, monkeypatch, sample_doc_1):
+    # Both documents must be in preparation at the same time to get past the barrier
+    barrier = threading.Barrier(2, timeout=5)
+
+    def mock_prepare(url):
+        barrier.wait()
+
+    resp_data = _recreate_two_docs(client, monkeypatch, sample_doc_1, mock_prepare)
+
+    assert len(resp_data['payload']['documents']) == 2
+    assert resp_data['payload']['failed'] == []
+
+
+def test_recreate_sign_request_prepare_timeout(client, monkeypatch, sample_doc_1):
+    client.application.config['PREPARE_TIMEOUT'] = 0.5
+    calls = []
+
+    def mock_prepare(url):
+        calls.append(url)
+        if len(calls) == 1:
+            time.sleep(2)
+
+    resp_data = _recreate_two_docs(client, monkeypatch, sample_doc_1, mock_prepare)
+
+    assert len(resp_data['payload']['documents']) == 1
+    assert len(resp_data['payload']['failed']) == 1
+    assert resp_data['payload']['failed'][0]['state'] == 'failed-signing'
@@ -31,6 +31,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import json
+import re
+from base64 import b64decode
 
 from edusign_webapp.marshal import ResponseSchema
 
@@ -157,3 +159,40 @@ def test_get_partially_signed_doesnt(client, monkeypatch, sample_doc_1):
     resp_data = _test_skip_final_signature_with_problem(client, monkeypatch, sample_doc_1, mock_get_signed)
 
     assert resp_data['message'] == 'Cannot find the document being signed'
+
+
+def test_skip_final_signature_download_link(client, monkeypatch, sample_doc_1):
+    app = client.application
+    monkeypatch.setitem(app.config, 'MAIL_ATTACHMENT_MAX_SIZE', 10)
+    # Read the emails from the outbox
+    monkeypatch.setitem(app.config, 'MAIL_OUTBOX', True)
+
+    resp_data = _test_skip_final_signature(client, monkeypatch, sample_doc_1)
+
+    assert resp_data['message'] == 'Success'
+
+    with app.app_context():
+        messages = app.extensions['doc_store'].claim_emails(10, 300)
+
+    # The invitation email, and the email to all signers
+    assert len(messages) == 2
+
+    message = json.loads(messages[1]['message'])
+
+    assert message['attachment'] == ''
+
+    match = re.search(r'https?://test\.localhost(/sign/download/[0-9a-f-]+)', message['body_txt'])
+
+    assert match is not None
+
+    response = client.get(match.group(1))
+
+    assert response.status == '200 OK'
+    assert response.mimetype == 'application/pdf'
+    assert response.data == b64decode(sample_doc_1['blob'])
+    assert 'test1-signed.pdf' in response.headers['Content-Disposition']
+    response.close()
+
+    response = client.get('/sign/download/not-a-key')
+
+    assert response.status == '404 NOT FOUND'
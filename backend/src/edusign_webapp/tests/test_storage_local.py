@@ -30,73 +30,120 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import io
 import os
 import uuid
 
 
-def test_add(local_storage, sample_pdf_data):
+def test_add(local_storage, sample_binary_pdf_data):
     _, storage = local_storage
     key = str(uuid.uuid4())
-    storage.add(key, sample_pdf_data)
+    storage.add(key, sample_binary_pdf_data)
 
     assert os.listdir(storage.base_dir) == [str(key)]
 
 
-def test_add_and_retrieve(local_storage, sample_pdf_data):
+def test_add_and_retrieve(local_storage, sample_binary_pdf_data):
     _, storage = local_storage
     key = str(uuid.uuid4())
-    storage.add(key, sample_pdf_data)
+    storage.add(key, sample_binary_pdf_data)
     content = storage.get_content(key)
 
-    assert content == sample_pdf_data
+    assert content == sample_binary_pdf_data
 
 
-def test_add_update_and_retrieve(local_storage, sample_pdf_data, sample_pdf_data_2):
+def test_add_update_and_retrieve(local_storage, sample_binary_pdf_data, sample_binary_pdf_data_2):
     _, storage = local_storage
     key = str(uuid.uuid4())
-    storage.add(key, sample_pdf_data)
+    storage.add(key, sample_binary_pdf_data)
 
-    storage.update(key, sample_pdf_data_2)
+    storage.update(key, sample_binary_pdf_data_2)
 
     content = storage.get_content(key)
 
-    assert content != sample_pdf_data
-    assert content == sample_pdf_data_2
+    assert content != sample_binary_pdf_data
+    assert content == sample_binary_pdf_data_2
 
 
-def test_add_two_update_and_retrieve(local_storage, sample_pdf_data, sample_pdf_data_2):
+def test_add_two_update_and_retrieve(local_storage, sample_binary_pdf_data, sample_binary_pdf_data_2):
     _, storage = local_storage
     key1 = str(uuid.uuid4())
     key2 = str(uuid.uuid4())
-    storage.add(key1, sample_pdf_data)
-    storage.add(key2, sample_pdf_data_2)
+    storage.add(key1, sample_binary_pdf_data)
+    storage.add(key2, sample_binary_pdf_data_2)
 
-    storage.update(key1, sample_pdf_data_2)
+    storage.update(key1, sample_binary_pdf_data_2)
 
     content1 = storage.get_content(key1)
     content2 = storage.get_content(key2)
 
-    assert content1 == sample_pdf_data_2
+    assert content1 == sample_binary_pdf_data_2
     assert content1 == content2
 
 
-def test_add_and_remove(local_storage, sample_pdf_data):
+def test_add_and_remove(local_storage, sample_binary_pdf_data):
     _, storage = local_storage
     key = str(uuid.uuid4())
-    storage.add(key, sample_pdf_data)
+    storage.add(key, sample_binary_pdf_data)
 
     storage.remove(key)
 
     assert os.listdir(storage.base_dir) == []
 
 
-def test_add_two_and_remove(local_storage, sample_pdf_data, sample_pdf_data_2):
+def test_add_two_and_remove(local_storage, sample_binary_pdf_data, sample_binary_pdf_data_2):
     _, storage = local_storage
     key1 = str(uuid.uuid4())
     key2 = str(uuid.uuid4())
-    storage.add(key1, sample_pdf_data)
-    storage.add(key2, sample_pdf_data_2)
+    storage.add(key1, sample_binary_pdf_data)
+    storage.add(key2, sample_binary_pdf_data_2)
 
     storage.remove(key1)
 
     assert os.listdir(storage.base_dir) == [str(key2)]
+
+
+def test_write_stream_and_read_stream(local_storage, sample_binary_pdf_data):
+    _, storage = local_storage
+    key = str(uuid.uuid4())
+    storage.write_stream(key, io.BytesIO(sample_binary_pdf_data))
+
+    with storage.read_stream(key) as stream:
+        content = stream.read()
+
+    assert content == sample_binary_pdf_data
+
+
+def test_write_stream_and_retrieve(local_storage, sample_binary_pdf_data):
+    _, storage = local_storage
+    key = str(uuid.uuid4())
+    storage.write_stream(key, io.BytesIO(sample_binary_pdf_data))
+
+    assert storage.get_content(key) == sample_binary_pdf_data
+
+
+def test_read_stream_missing(local_storage):
+    _, storage = local_storage
+
+    assert storage.read_stream(str(uuid.uuid4())) is None
+
+
+def test_remove_many(local_storage, sample_binary_pdf_data):
+    _, storage = local_storage
+    keys = [uuid.uuid4() for _ in range(3)]
+    for key in keys:
+        storage.add(key, sample_binary_pdf_data)
+
+    removed = storage.remove_many(keys[:2])
+
+    assert removed == keys[:2]
+    assert os.listdir(storage.base_dir) == [str(keys[2])]
+
+
+def test_get_size(local_storage, sample_binary_pdf_data):
+    _, storage = local_storage
+    key = uuid.uuid4()
+    storage.add(key, sample_binary_pdf_data)
+
+    assert storage.get_size(key) == len(sample_binary_pdf_data)
+    assert storage.get_size(uuid.uuid4()) is None
@@ -30,6 +30,7 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import io
 import uuid
 
 from moto import mock_aws
@@ -40,61 +41,61 @@ def _create_bucket(app):
 
 
 @mock_aws
-def test_add(s3_app, sample_pdf_data, sample_binary_pdf_data):
+def test_add(s3_app, sample_binary_pdf_data):
     _create_bucket(s3_app)
     key = str(uuid.uuid4())
 
-    s3_app.extensions['doc_store'].storage.add(key, sample_pdf_data)
+    s3_app.extensions['doc_store'].storage.add(key, sample_binary_pdf_data)
 
     assert list(s3_app.extensions['doc_store'].storage.s3_bucket.objects.all())[0].key == key
 
 
 @mock_aws
-def test_add_and_retrieve(s3_app, sample_pdf_data):
+def test_add_and_retrieve(s3_app, sample_binary_pdf_data):
     _create_bucket(s3_app)
     key = str(uuid.uuid4())
-    s3_app.extensions['doc_store'].storage.add(key, sample_pdf_data)
+    s3_app.extensions['doc_store'].storage.add(key, sample_binary_pdf_data)
     content = s3_app.extensions['doc_store'].storage.get_content(key)
 
-    assert content == sample_pdf_data
+    assert content == sample_binary_pdf_data
 
 
 @mock_aws
-def test_add_update_and_retrieve(s3_app, sample_pdf_data, sample_pdf_data_2):
+def test_add_update_and_retrieve(s3_app, sample_binary_pdf_data, sample_binary_pdf_data_2):
     _create_bucket(s3_app)
     key = str(uuid.uuid4())
-    s3_app.extensions['doc_store'].storage.add(key, sample_pdf_data)
+    s3_app.extensions['doc_store'].storage.add(key, sample_binary_pdf_data)
 
-    s3_app.extensions['doc_store'].storage.update(key, sample_pdf_data_2)
+    s3_app.extensions['doc_store'].storage.update(key, sample_binary_pdf_data_2)
 
     content = s3_app.extensions['doc_store'].storage.get_content(key)
 
-    assert content != sample_pdf_data
-    assert content == sample_pdf_data_2
+    assert content != sample_binary_pdf_data
+    assert content == sample_binary_pdf_data_2
 
 
 @mock_aws
-def test_add_two_update_and_retrieve(s3_app, sample_pdf_data, sample_pdf_data_2):
+def test_add_two_update_and_retrieve(s3_app, sample_binary_pdf_data, sample_binary_pdf_data_2):
     _create_bucket(s3_app)
     key1 = str(uuid.uuid4())
     key2 = str(uuid.uuid4())
-    s3_app.extensions['doc_store'].storage.add(key1, sample_pdf_data)
-    s3_app.extensions['doc_store'].storage.add(key2, sample_pdf_data_2)
+    s3_app.extensions['doc_store'].storage.add(key1, sample_binary_pdf_data)
+    s3_app.extensions['doc_store'].storage.add(key2, sample_binary_pdf_data_2)
 
-    s3_app.extensions['doc_store'].storage.update(key1, sample_pdf_data_2)
+    s3_app.extensions['doc_store'].storage.update(key1, sample_binary_pdf_data_2)
 
     content1 = s3_app.extensions['doc_store'].storage.get_content(key1)
     content2 = s3_app.extensions['doc_store'].storage.get_content(key2)
 
-    assert content1 == sample_pdf_data_2
+    assert content1 == sample_binary_pdf_data_2
     assert content1 == content2
 
 
 @mock_aws
-def test_add_and_remove(s3_app, sample_pdf_data):
+def test_add_and_remove(s3_app, sample_binary_pdf_data):
     _create_bucket(s3_app)
     key = str(uuid.uuid4())
-    s3_app.extensions['doc_store'].storage.add(key, sample_pdf_data)
+    s3_app.extensions['doc_store'].storage.add(key, sample_binary_pdf_data)
 
     s3_app.extensions['doc_store'].storage.remove(key)
 
@@ -102,12 +103,12 @@ def test_add_and_remove(s3_app, sample_pdf_data):
 
 
 @mock_aws
-def test_add_2_and_remove_1(s3_app, sample_pdf_data, sample_pdf_data_2):
+def test_add_2_and_remove_1(s3_app, sample_binary_pdf_data, sample_binary_pdf_data_2):
     _create_bucket(s3_app)
     key = str(uuid.uuid4())
-    s3_app.extensions['doc_store'].storage.add(key, sample_pdf_data)
+    s3_app.extensions['doc_store'].storage.add(key, sample_binary_pdf_data)
     key2 = str(uuid.uuid4())
-    s3_app.extensions['doc_store'].storage.add(key2, sample_pdf_data_2)
+    s3_app.extensions['doc_store'].storage.add(key2, sample_binary_pdf_data_2)
 
     s3_app.extensions['doc_store'].storage.remove(key)
 
@@ -115,4 +116,82 @@ def test_add_2_and_remove_1(s3_app, sample_pdf_data, sample_pdf_data_2):
 
     content2 = s3_app.extensions['doc_store'].storage.get_content(key2)
 
-    assert content2 == sample_pdf_data_2
+    assert content2 == sample_binary_pdf_data_2
+
+
+@mock_aws
+def test_write_stream_and_read_stream(s3_app, sample_binary_pdf_data):
+    _create_bucket(s3_app)
+    key = str(uuid.uuid4())
+    s3_app.extensions['doc_store'].storage.write_stream(key, io.BytesIO(sample_binary_pdf_data))
+
+    stream = s3_app.extensions['doc_store'].storage.read_stream(key)
+    content = stream.read()
+    stream.close()
+
+    assert content == sample_binary_pdf_data
+
+
+@mock_aws
+def test_write_stream_multipart(s3_app):
+    _create_bucket(s3_app)
+    storage = s3_app.extensions['doc_store'].storage
+    storage.transfer_config.multipart_threshold = 5 * 1024 * 1024
+    storage.transfer_config.multipart_chunksize = 5 * 1024 * 1024
+    data = bytes(range(256)) * (11 * 1024 * 1024 // 256)
+    key = str(uuid.uuid4())
+    storage.write_stream(key, io.BytesIO(data))
+
+    stream = storage.read_stream(key)
+    chunks = []
+    while True:
+        chunk = stream.read(1024 * 1024)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    stream.close()
+
+    assert b''.join(chunks) == data
+    assert storage.s3.Object(storage.s3_bucket_name, key).e_tag.endswith('-3"')
+
+
+@mock_aws
+def test_read_stream_missing(s3_app):
+    _create_bucket(s3_app)
+
+    assert s3_app.extensions['doc_store'].storage.read_stream(str(uuid.uuid4())) is None
+
+
+@mock_aws
+def test_get_content_missing(s3_app):
+    _create_bucket(s3_app)
+
+    assert s3_app.extensions['doc_store'].storage.get_content(str(uuid.uuid4())) is None
+
+
+@mock_aws
+def test_remove_many(s3_app, sample_binary_pdf_data, monkeypatch):
+    from edusign_webapp.document.storage import s3
+
+    monkeypatch.setattr(s3, 'S3_DELETE_MAX_KEYS', 2)
+    _create_bucket(s3_app)
+    storage = s3_app.extensions['doc_store'].storage
+    keys = [uuid.uuid4() for _ in range(6)]
+    for key in keys:
+        storage.add(key, sample_binary_pdf_data)
+
+    removed = storage.remove_many(keys[:5])
+
+    assert removed == keys[:5]
+    assert [obj.key for obj in storage.s3_bucket.objects.all()] == [str(keys[5])]
+
+
+@mock_aws
+def test_get_size(s3_app, sample_binary_pdf_data):
+    _create_bucket(s3_app)
+    storage = s3_app.extensions['doc_store'].storage
+    key = uuid.uuid4()
+    storage.add(key, sample_binary_pdf_data)
+
+    assert storage.get_size(key) == len(sample_binary_pdf_data)
+    assert storage.get_size(uuid.uuid4()) is None
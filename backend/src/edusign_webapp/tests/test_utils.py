@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import io
+import uuid
+from email import message_from_string
+
+import pikepdf
+import pytest
+from marshmallow import ValidationError
+
+from edusign_webapp import utils
+from edusign_webapp.schemata import BlobSchema, DocSchema
+from edusign_webapp.utils import (
+    EncodedAttachment,
+    analyze_pdf,
+    b64decode_blob,
+    b64encode_stream,
+    compose_message,
+    get_pdfa_claim,
+    pretty_print_any,
+)
+
+
+class ShortReads(io.BytesIO):
+    def read(self, size=-1):
+        return super().read(min(size, 7))
+
+
+def test_b64encode_stream(sample_binary_pdf_data, sample_pdf_data):
+    for chunk_size in (1, 3, 10, 1024, 1024 * 1024):
+        assert b64encode_stream(io.BytesIO(sample_binary_pdf_data), chunk_size) == sample_pdf_data
+
+
+def test_b64encode_stream_short_reads(sample_binary_pdf_data, sample_pdf_data):
+    assert b64encode_stream(ShortReads(sample_binary_pdf_data), 1024) == sample_pdf_data
+
+
+def test_b64encode_stream_empty():
+    assert b64encode_stream(io.BytesIO(b''), 1024) == ''
+
+
+def _get_attachment(msg):
+    parsed = message_from_string(msg.message().as_string())
+    for part in parsed.walk():
+        if part.get_filename() == 'test.pdf':
+            return part
+
+
+def test_compose_message_attachment(app, sample_binary_pdf_data):
+    _, app = app
+    with app.test_request_context():
+        msg = compose_message(
+            ['test@example.org'],
+            'subject',
+            'txt',
+            'html',
+            attachment_name='test.pdf',
+            attachment=sample_binary_pdf_data,
+        )
+        part = _get_attachment(msg)
+
+    assert part['Content-Transfer-Encoding'] == 'base64'
+    assert part.get_payload(decode=True) == sample_binary_pdf_data
+    assert max(len(line) for line in part.get_payload().splitlines()) == 76
+
+
+def test_compose_messages_shared_attachment(app, sample_binary_pdf_data):
+    _, app = app
+    attachment = EncodedAttachment(sample_binary_pdf_data)
+    with app.test_request_context():
+        msgs = [
+            compose_message([f'test{i}@example.org'], 'subject', 'txt', 'html', 'test.pdf', attachment)
+            for i in range(2)
+        ]
+        payloads = [part.get_payload() for msg in msgs for part in msg.attachments]
+        part = _get_attachment(msgs[1])
+
+    assert all(payload is attachment.payload for payload in payloads)
+    assert part.get_payload(decode=True) == sample_binary_pdf_data
+
+
+def test_b64decode_blob_data_url(sample_pdf_data, sample_binary_pdf_data):
+    assert b64decode_blob(sample_pdf_data) == sample_binary_pdf_data
+    assert b64decode_blob(f'data:application/pdf;base64,{sample_pdf_data}') == sample_binary_pdf_data
+
+
+def test_base64_bytes_field(app, sample_pdf_data, sample_binary_pdf_data):
+    _, app = app
+    with app.test_request_context():
+        assert DocSchema().load({'document': sample_pdf_data})['document'] == sample_binary_pdf_data
+        with pytest.raises(ValidationError):
+            DocSchema().load({'document': 'not base64'})
+
+        dumped = BlobSchema().dump({'blob': sample_binary_pdf_data, 'pprinted': 'not-needed-for-pdf'})
+        assert dumped['blob'] == sample_pdf_data
+
+        stream = io.BytesIO(sample_binary_pdf_data)
+        dumped = BlobSchema().dump({'blob': stream, 'pprinted': 'not-needed-for-pdf'})
+        assert dumped['blob'] == sample_pdf_data
+        assert stream.closed
+
+
+def test_pretty_print_any(app, monkeypatch, sample_owner_1, sample_invites_1):
+    _, app = app
+    content = b'<?xml version="1.0"?><doc><signed>yes</signed></doc>'
+    key = str(uuid.uuid4())
+    document = {
+        'key': key,
+        'name': 'test.xml',
+        'size': len(content),
+        'type': 'application/xml',
+        'blob': content,
+        'prev_signatures': '',
+    }
+
+    rendered = []
+    pretty_print_xml = utils.pretty_print_xml
+
+    def counting_pretty_print_xml(content):
+        rendered.append(content)
+        return pretty_print_xml(content)
+
+    monkeypatch.setattr(utils, 'pretty_print_xml', counting_pretty_print_xml)
+
+    with app.app_context():
+        app.extensions['doc_store'].add_document(
+            document, sample_owner_1, sample_invites_1, False, 'low', False, False, ''
+        )
+        uncached = pretty_print_any(content, 'application/xml')
+        cached = [pretty_print_any(content, 'application/xml', key=uuid.UUID(key)) for _ in range(2)]
+
+    assert isinstance(uncached, str)
+    assert cached == [uncached, uncached]
+    assert len(rendered) == 2
+    assert pretty_print_any(content, 'application/pdf') == 'not-needed-for-pdf'
+
+
+def test_analyze_pdf(app, sample_binary_pdf_data, sample_form_1):
+    _, app = app
+    with app.app_context():
+        simple = analyze_pdf(sample_binary_pdf_data, 'test.pdf')
+        form = analyze_pdf(b64decode_blob(sample_form_1['pdf']), 'form.pdf')
+        broken = analyze_pdf(b'not a pdf', 'broken.pdf')
+
+    assert simple == {'prev_signatures': '', 'has_form': False, 'pages': 1, 'pdfa': ''}
+    assert form == {'prev_signatures': '', 'has_form': True, 'pages': 1, 'pdfa': ''}
+    assert broken == {'prev_signatures': 'pdf read error', 'has_form': False, 'pages': 0, 'pdfa': ''}
+
+
+def test_analyze_pdf_pdfa(app, sample_binary_pdf_data):
+    _, app = app
+    pdf = pikepdf.open(io.BytesIO(sample_binary_pdf_data))
+    with pdf.open_metadata(set_pikepdf_as_editor=False) as meta:
+        meta['pdfaid:part'] = '2'
+        meta['pdfaid:conformance'] = 'B'
+    content = io.BytesIO()
+    pdf.save(content)
+
+    with app.app_context():
+        analysis = analyze_pdf(content.getvalue(), 'test.pdf')
+
+    assert analysis['pdfa'] == 'PDF/A-2B'
+
+
+def test_get_pdfa_claim():
+    xmp = b"""<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+  <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+    <rdf:Description rdf:about="" xmlns:pdfaid="http://www.aiim.org/pdfa/ns/id/" pdfaid:part="3" pdfaid:conformance="u"/>
+  </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>"""
+
+    assert get_pdfa_claim(xmp) == 'PDF/A-3U'
+    assert get_pdfa_claim(xmp.replace(b'pdfaid:part="3"', b'')) == ''
+    assert get_pdfa_claim(b'not xml') == ''
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import threading
+import time
+
+import requests
+
+from edusign_webapp import run
+
+
+class MockResponse:
+    status_code = 200
+    content = b'validated'
+
+
+def _to_validate(n):
+    return [
+        {
+            'key': f'key{i}',
+            'owner': 'dummy',
+            'doc': {'blob': b'signed', 'type': 'application/pdf'},
+            'sendsigned': False,
+        }
+        for i in range(n)
+    ]
+
+
+def test_validate_signatures_concurrently(monkeypatch):
+    # All documents must be in validation at the same time to get past the barrier
+    barrier = threading.Barrier(3, timeout=5)
+
+    def mock_post(self, url, *args, **kwargs):
+        barrier.wait()
+        return MockResponse()
+
+    monkeypatch.setattr(requests.Session, 'post', mock_post)
+
+    with run.app.test_request_context():
+        validated = run.app.extensions['api_client'].validate_signatures(_to_validate(3))
+
+    assert [doc['key'] for doc in validated] == ['key0', 'key1', 'key2']
+    assert all(doc['validated'] for doc in validated)
+    assert all(doc['doc']['signedContent'] == b'validated' for doc in validated)
+
+
+def test_validate_signatures_error(monkeypatch):
+    def mock_post(self, url, *args, **kwargs):
+        raise requests.ConnectionError('Mock connection error')
+
+    monkeypatch.setattr(requests.Session, 'post', mock_post)
+
+    with run.app.test_request_context():
+        validated = run.app.extensions['api_client'].validate_signatures(_to_validate(2))
+
+    assert not any(doc['validated'] for doc in validated)
+    assert all(doc['doc']['signedContent'] == doc['doc']['blob'] for doc in validated)
+
+
+def test_validate_signatures_error_from_api(monkeypatch):
+    def mock_post(self, url, *args, **kwargs):
+        raise requests.ConnectionError('Mock connection error')
+
+    monkeypatch.setattr(requests.Session, 'post', mock_post)
+
+    to_validate = [
+        {
+            'key': 'key0',
+            'owner': 'dummy',
+            'doc': {'signedContent': b'signed', 'type': 'application/pdf'},
+            'sendsigned': False,
+        }
+    ]
+    with run.app.test_request_context():
+        validated = run.app.extensions['api_client'].validate_signatures(to_validate)
+
+    assert not validated[0]['validated']
+    assert validated[0]['doc']['signedContent'] == b'signed'
+
+
+def test_validate_signatures_timeout(monkeypatch):
+    release = threading.Event()
+
+    def mock_post(self, url, *args, **kwargs):
+        release.wait(5)
+        return MockResponse()
+
+    monkeypatch.setattr(requests.Session, 'post', mock_post)
+    monkeypatch.setitem(run.app.config, 'VALIDATOR_TIMEOUT', 0.1)
+
+    to_validate = _to_validate(1)
+    with run.app.test_request_context():
+        validated = run.app.extensions['api_client'].validate_signatures(to_validate)
+
+    # Let the late validation finish, updating the original doc
+    release.set()
+    for _ in range(50):
+        if to_validate[0].get('validated'):
+            break
+        time.sleep(0.1)
+
+    assert to_validate[0]['validated']
+    assert not validated[0]['validated']
+    assert validated[0]['doc']['signedContent'] == b'signed'
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import threading
+import time
+
+import pytest
+
+from edusign_webapp.workers import PoolSaturated, PoolTimeout, WorkerPool
+
+
+def test_run_inline():
+    pool = WorkerPool(0, 0, 10)
+
+    assert pool.run(pow, 2, 10) == 1024
+
+    stats = pool.stats()
+    assert stats['completed'] == 1
+    assert stats['in_flight'] == 0
+
+
+def test_run_in_worker():
+    pool = WorkerPool(1, 0, 30)
+    try:
+        results = [pool.run(pow, 2, exp) for exp in range(3)]
+        with pytest.raises(ZeroDivisionError):
+            pool.run(divmod, 1, 0)
+    finally:
+        pool.shutdown()
+
+    stats = pool.stats()
+    assert results == [1, 2, 4]
+    assert stats['completed'] == 3
+    assert stats['failed'] == 1
+    assert stats['in_flight'] == 0
+    assert stats['run_seconds'] >= 0
+
+
+def test_timeout():
+    pool = WorkerPool(1, 0, 0.5)
+    try:
+        pool.run(pow, 1, 1)
+        start = time.time()
+        with pytest.raises(PoolTimeout):
+            pool.run(time.sleep, 5)
+        waited = time.time() - start
+        # the worker has interrupted the task, and is free for more work
+        after = pool.run(pow, 3, 2)
+    finally:
+        pool.shutdown()
+
+    assert waited < 2
+    assert after == 9
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_saturated():
+    pool = WorkerPool(1, 0, 30)
+    try:
+        pool.run(pow, 1, 1)
+        busy = threading.Thread(target=pool.run, args=(time.sleep, 1))
+        busy.start()
+        time.sleep(0.1)
+        with pytest.raises(PoolSaturated):
+            pool.run(pow, 2, 2)
+        busy.join()
+        after = pool.run(pow, 2, 2)
+    finally:
+        pool.shutdown()
+
+    stats = pool.stats()
+    assert after == 4
+    assert stats['rejected'] == 1
+    assert stats['completed'] == 3
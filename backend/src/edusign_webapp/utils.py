@@ -30,17 +30,21 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import hashlib
 import io
+import json
 import re
 import uuid
-from base64 import b64decode, b64encode
-from email.encoders import encode_base64
+from base64 import b64decode, b64encode, encodebytes
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from email.mime.base import MIMEBase
+from typing import BinaryIO, Union
 from xml.etree import cElementTree as ET
 from zlib import error as zliberror
 
 from cryptography import x509
-from flask import current_app, g, request, session
+from flask import copy_current_request_context, current_app, g, request, session
 from flask_babel import gettext
 from flask_mailman import EmailMultiAlternatives
 from lxml import etree
@@ -49,7 +53,12 @@ from pygments.formatters import HtmlFormatter
 from pygments.lexers import XmlLexer
 from pyhanko.pdf_utils.reader import PdfFileReader, PdfReadError
 
-from edusign_webapp.mail_backend import ParallelEmailBackend
+from edusign_webapp.forms import get_pdfa_claim, has_pdf_form
+from edusign_webapp.mail_backend import MailSendError, ParallelEmailBackend
+
+# Placeholder preview for XML documents in invitation listings,
+# the actual preview is fetched on demand.
+LAZY_PPRINTED = 'lazy-loaded'
 
 
 class MissingDisplayName(Exception):
@@ -212,6 +221,65 @@ def prepare_document(document: dict) -> dict:
         return {}
 
 
+def run_concurrently(func, items: list, max_workers: int, timeout: float, on_timeout) -> list:
+    """
+    Call `func` on each of the `items` in a bounded pool of threads,
+    each of them running with a copy of the current request context.
+
+    :param func: the function to call on each item.
+    :param items: the items to process.
+    :param max_workers: max number of items processed at the same time.
+    :param timeout: seconds to wait for the result for each item.
+    :param on_timeout: function called with the item to produce a result when `func` times out on it.
+    :return: the results of calling `func` on the items, in the same order.
+    """
+    if len(items) == 0:
+        return []
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))))
+    try:
+        futures = [executor.submit(copy_current_request_context(func), item) for item in items]
+        results = []
+        for item, future in zip(items, futures):
+            try:
+                results.append(future.result(timeout=timeout))
+            except FutureTimeoutError:
+                future.cancel()
+                results.append(on_timeout(item))
+    finally:
+        # Do not wait for the threads still stuck past the timeout
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return results
+
+
+def prepare_documents(documents: list) -> list:
+    """
+    Send documents to the eduSign API to be prepared for signing, concurrently.
+    The level of concurrency and the time to wait for each document
+    are set with the `PREPARE_MAX_WORKERS` and `PREPARE_TIMEOUT` settings.
+
+    :param documents: a list of dicts with metadata and contents of the documents to be prepared.
+    :return: a list with the responses from the API, or with error messages, as returned by `prepare_document`,
+             in the same order as the documents.
+    """
+
+    def on_timeout(document):
+        current_app.logger.error(f"Timeout preparing document {document['name']} for user {session['eppn']}")
+        return {
+            'error': True,
+            'message': gettext('There was an error. Please try again, or contact the site administrator.'),
+        }
+
+    return run_concurrently(
+        prepare_document,
+        documents,
+        current_app.config['PREPARE_MAX_WORKERS'],
+        current_app.config['PREPARE_TIMEOUT'],
+        on_timeout,
+    )
+
+
 def get_invitations(remove_finished=False):
     """
     Function that will retrieve from the db all invitations concerning the user in the current session.
@@ -223,6 +291,11 @@ def get_invitations(remove_finished=False):
     * poll, a boolean that indicates whether the front side app should continue
       polling the backend (this is, only when there are users pending to sign
       any of the invitations).
+
+    Only metadata is read to build the listing; the contents of the documents
+    (and the previews of XML documents) are fetched on demand by the front side app
+    through the `get-partially-signed` view. The only exception are finished
+    documents with `skipfinal` set, which are handed over to the client in full.
     """
     mail_addresses = session.get('mail_aliases')
     if mail_addresses is None:
@@ -238,9 +311,7 @@ def get_invitations(remove_finished=False):
         'high': gettext('High'),
     }
     for doc in invited:
-        key = uuid.UUID(str(doc['key']))
-        content = current_app.extensions['doc_store'].get_document_content(key)
-        doc['pprinted'] = pretty_print_any(content, doc['type'])
+        doc['pprinted'] = listing_pprint(doc['type'])
         loa = doc['loa']
         doc['loa'] = f"{loa},{display_levels[loa]}"
         required_level = levels[loa]
@@ -253,9 +324,7 @@ def get_invitations(remove_finished=False):
     newowned, skipped = [], []
     current_app.logger.debug(f"Start checking {len(owned)} owned docs")
     for doc in owned:
-        key = uuid.UUID(str(doc['key']))
-        content = current_app.extensions['doc_store'].get_document_content(key)
-        doc['pprinted'] = pretty_print_any(content, doc['type'])
+        doc['pprinted'] = listing_pprint(doc['type'])
         doc['loa'] = f"{doc['loa']},{display_levels[doc['loa']]}"
         current_app.logger.debug(f"Checking {doc['name']}, with {len(doc['pending'])} pending")
         if len(doc['pending']) > 0:
@@ -263,8 +332,12 @@ def get_invitations(remove_finished=False):
 
         if doc['skipfinal'] and len(doc['pending']) == 0:
             current_app.logger.debug(f"Skipping {doc['name']}")
-            doc['blob'] = current_app.extensions['doc_store'].get_document_content(doc['key'])
-            doc['signed_content'] = current_app.extensions['doc_store'].get_document_content(doc['key'])
+            content = current_app.extensions['doc_store'].get_document_content(doc['key'])
+            # blob and signed_content are the same, so encode them just once
+            b64content = b64encode(content).decode('ascii')
+            doc['blob'] = b64content
+            doc['signed_content'] = b64content
+            doc['pprinted'] = pretty_print_any(content, doc['type'])
             if remove_finished:
                 current_app.extensions['doc_store'].remove_document(doc['key'])
             skipped.append(doc)
@@ -282,27 +355,22 @@ def get_invitations(remove_finished=False):
     }
 
 
-def get_previous_signatures(document: dict) -> str:
+def get_previous_signatures(content: bytes, name: str) -> str:
     """
-    This function receives a document as a dict containing the metadata and the content,
-    and analyses the content to determine whether it contains any signatures made before
-    it was lodaded to eduSign.
+    This function receives the contents of a PDF document,
+    and analyses them to determine whether they contain any signatures made before
+    the document was lodaded to eduSign.
     This will only detect some kinds of PDF signatures, among which are those made by
     the eduSign service.
-    :param document: document to inspect for signatures
-    :type document: dict
+    :param content: raw contents of the document to inspect for signatures
+    :param name: name of the document
     :return: a string with info on the previous signatures, or empty when there where none.
     """
-    content = document['blob']
-    if "," in content:
-        content = content.split(",")[1]
-
-    bytes = b64decode(content, validate=True)
-    pdf = io.BytesIO(bytes)
+    pdf = io.BytesIO(content)
     try:
         reader = PdfFileReader(pdf)
     except (PdfReadError, zliberror) as e:
-        current_app.logger.info(f"Error reading previous signatures for {document['name']}: {e}")
+        current_app.logger.info(f"Error reading previous signatures for {name}: {e}")
         return "pdf read error"
     sigs = []
     try:
@@ -314,20 +382,93 @@ def get_previous_signatures(document: dict) -> str:
         return ""
 
 
-def get_previous_signatures_xml(document: dict) -> str:
+def analyze_pdf(content: bytes, name: str) -> dict:
     """
-    This function receives an XML document as a dict containing the metadata and the content,
-    and analyses the content to determine whether it contains any signatures made before
-    it was lodaded to eduSign.
-    :param document: document to inspect for signatures
-    :type document: dict
-    :return: a string with info on the previous signatures, or empty when there where none.
+    Analyse the raw contents of a PDF document, parsing it just once,
+    to extract all the information needed about it when it is loaded to eduSign.
+
+    :param content: raw contents of the document
+    :param name: name of the document
+    :return: a dict with keys:
+             + prev_signatures: info on the previous signatures, as returned by `get_previous_signatures`
+             + has_form: whether the document contains a form
+             + pages: the number of pages in the document
+             + pdfa: the PDF/A version claimed by the document, as returned by `get_pdfa_claim`
+    """
+    analysis = {'prev_signatures': "", 'has_form': False, 'pages': 0, 'pdfa': ""}
+    try:
+        reader = PdfFileReader(io.BytesIO(content))
+        root = reader.root
+    except (PdfReadError, zliberror) as e:
+        current_app.logger.info(f"Error reading previous signatures for {name}: {e}")
+        analysis['prev_signatures'] = "pdf read error"
+        # PyMuPDF is more lenient than pyHanko with malformed documents
+        try:
+            analysis['has_form'] = bool(has_pdf_form(content))
+        except Exception as e:
+            current_app.logger.error(f'Problem analysing document {name}: {e}')
+        return analysis
+
+    try:
+        analysis['prev_signatures'] = "|".join(
+            [sig.signer_cert.subject.human_friendly for sig in reader.embedded_regular_signatures]
+        )
+    except Exception as e:
+        current_app.logger.error(f'Problem reading previous signatures: {e}')
+
+    try:
+        if '/AcroForm' in root and '/Fields' in root['/AcroForm']:
+            analysis['has_form'] = len(root['/AcroForm']['/Fields']) > 0
+        analysis['pages'] = int(root['/Pages']['/Count'])
+        if '/Metadata' in root:
+            analysis['pdfa'] = get_pdfa_claim(root['/Metadata'].data)
+    except Exception as e:
+        current_app.logger.error(f'Problem analysing document {name}: {e}')
+
+    return analysis
+
+
+def ingest_pdf(document: dict) -> tuple:
     """
-    content = document['blob']
-    if "," in content:
-        content = content.split(",")[1]
-    content = b64decode(content)
+    Send a PDF document to the eduSign API to be prepared for signing, and, while waiting for the API,
+    decode and analyse its contents.
+    The time to wait for the API is set with the `PREPARE_TIMEOUT` setting.
+
+    :param document: a dict with metadata and base64 encoded contents of the document.
+    :return: a tuple with the response from the API (or error information), as returned by `prepare_document`,
+             the raw contents of the document, and the analysis of the document, as returned by `analyze_pdf`.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        future = executor.submit(copy_current_request_context(prepare_document), document)
 
+        content = b64decode_blob(document['blob'])
+        analysis = analyze_pdf(content, document['name'])
+
+        try:
+            prepare_data = future.result(timeout=current_app.config['PREPARE_TIMEOUT'])
+        except FutureTimeoutError:
+            future.cancel()
+            current_app.logger.error(f"Timeout preparing document {document['name']} for user {session['eppn']}")
+            prepare_data = {
+                'error': True,
+                'message': gettext('There was an error. Please try again, or contact the site administrator.'),
+            }
+    finally:
+        # Do not wait for the thread if stuck past the timeout
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return prepare_data, content, analysis
+
+
+def get_previous_signatures_xml(content: bytes) -> str:
+    """
+    This function receives the contents of an XML document,
+    and analyses them to determine whether they contain any signatures made before
+    the document was lodaded to eduSign.
+    :param content: raw contents of the document to inspect for signatures
+    :return: a string with info on the previous signatures, or empty when there where none.
+    """
     signature_search = ".//{http://www.w3.org/2000/09/xmldsig#}Signature"
     signatures = etree.fromstring(content).findall(signature_search)
 
@@ -386,13 +527,72 @@ def fix_recipients(recipients):
     return recipients
 
 
+def b64decode_blob(blob: str) -> bytes:
+    """
+    Decode the base64 encoded contents of a document, as sent from the front side app,
+    possibly in the form of a data URL.
+
+    :param blob: base64 encoded contents, or data URL
+    :return: the raw contents
+    """
+    if ',' in blob:
+        blob = blob.split(',')[1]
+
+    return b64decode(blob)
+
+
+def b64encode_stream(stream: BinaryIO, chunk_size: int) -> str:
+    """
+    base64 encode the contents of a binary file like object,
+    reading and encoding it in chunks, so that the raw contents are never held in memory as a whole.
+
+    :param stream: file like object to encode
+    :param chunk_size: approximate size in bytes of the chunks to read from the stream
+    :return: the base64 encoded contents of the stream
+    """
+    # chunks must have a length multiple of 3 for their encodings to concatenate without padding
+    chunk_size = max(3, chunk_size - chunk_size % 3)
+    parts = []
+    rest = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        cut = len(chunk) - len(chunk) % 3
+        parts.append(b64encode(chunk[:cut]).decode('ascii'))
+        rest = chunk[cut:]
+
+    if rest:
+        parts.append(b64encode(rest).decode('ascii'))
+
+    return ''.join(parts)
+
+
+class EncodedAttachment(object):
+    """
+    The contents of a PDF to attach to email messages, base64 encoded once,
+    so that all the messages it is attached to share the encoded payload.
+    """
+
+    def __init__(self, content: bytes = b'', payload: str = ''):
+        """
+        :param content: the raw contents of the PDF
+        :param payload: the already encoded contents of the PDF, if there are no raw contents
+        """
+        self.payload = encodebytes(content).decode('ascii') if content else payload
+
+    def __bool__(self):
+        return bool(self.payload)
+
+
 def compose_message(
     recipients: list,
     subject: str,
     body_txt: str,
     body_html: str,
     attachment_name: str = '',
-    attachment: str = '',
+    attachment: Union[bytes, EncodedAttachment] = b'',
 ):
     """
     Compose a mail message,
@@ -403,7 +603,8 @@ def compose_message(
     :param body_txt: plain text body
     :param body_html: html body
     :param attachment_name: the file name of the PDF to attach
-    :param attachment: the contents of the PDF to attach to the message
+    :param attachment: the contents of the PDF to attach to the message,
+                       either raw or as an `EncodedAttachment` shared by several messages
     """
     recipients = fix_recipients(recipients)
     current_app.logger.debug(f"message to send: {recipients} -- {subject}")
@@ -412,19 +613,76 @@ def compose_message(
 
     if attachment and attachment_name:
         mail_file = MIMEBase('application', 'pdf')
-        mail_file.set_payload(attachment)
+        if not isinstance(attachment, EncodedAttachment):
+            attachment = EncodedAttachment(attachment)
+        mail_file.set_payload(attachment.payload)
+        mail_file['Content-Transfer-Encoding'] = 'base64'
         mail_file.add_header('Content-Disposition', 'attachment', filename=attachment_name)
-        encode_base64(mail_file)
         msg.attach(mail_file)
 
     return msg
 
 
+def serialize_message(args: tuple, kwargs: dict) -> str:
+    """
+    Serialize the arguments for `compose_message` as JSON, to keep them in the outbox.
+
+    :param args: positional arguments for `compose_message`
+    :param kwargs: keyword arguments for `compose_message`
+    :return: the JSON serialized message
+    """
+    data = dict(zip(('recipients', 'subject', 'body_txt', 'body_html'), args))
+    data.update(kwargs)
+    attachment = data.get('attachment', b'')
+    if not isinstance(attachment, EncodedAttachment):
+        attachment = EncodedAttachment(attachment)
+    data['attachment'] = attachment.payload
+    return json.dumps(data)
+
+
+def deserialize_message(message: str) -> dict:
+    """
+    Deserialize a message kept in the outbox.
+
+    :param message: the JSON serialized message
+    :return: keyword arguments for `compose_message`
+    """
+    data = json.loads(message)
+    data['attachment'] = EncodedAttachment(payload=data['attachment'])
+    return data
+
+
+def use_outbox() -> bool:
+    """
+    Whether email should be queued in the outbox, to be sent by the outbox worker,
+    rather than sent while serving the request.
+    """
+    return current_app.config['MAIL_OUTBOX'] and current_app.config['ENVIRONMENT'] != 'e2e'
+
+
+def enqueue_mail_bulk(msgs_data: list):
+    """
+    Queue a number of mail messages in the outbox.
+
+    :param msgs_data: a list of arguments for `compose_message`.
+    """
+    if not msgs_data:
+        return
+
+    messages = [serialize_message(args, kwargs) for args, kwargs in msgs_data]
+    current_app.extensions['doc_store'].enqueue_emails(messages)
+    current_app.logger.debug(f"Queued {len(messages)} emails in the outbox")
+
+
 def sendmail(*args, **kwargs):
     """
-    Compose a mail message and send it.
+    Compose a mail message and send it, or queue it in the outbox.
     The arguments are the same as those for `compose_message`.
     """
+    if use_outbox():
+        enqueue_mail_bulk([(args, kwargs)])
+        return
+
     msg = compose_message(*args, **kwargs)
 
     current_app.logger.debug(f"Email to be sent:\n\n{msg.message().as_string()}\n\n")
@@ -441,10 +699,16 @@ def sendmail(*args, **kwargs):
 
 def sendmail_bulk(msgs_data: list):
     """
-    Compose a number of mail messages and send it.
+    Compose a number of mail messages and send it, or queue them in the outbox.
 
     :param msgs: a list of arguments for `compose_message`.
+    :return: With the SMTP backend, a `BatchReport` with the outcome of sending the messages.
+    :raises MailSendError: if none of the messages was sent, or the SMTP server could not be reached.
     """
+    if use_outbox():
+        enqueue_mail_bulk(msgs_data)
+        return None
+
     msgs = []
 
     for args, kwargs in msgs_data:
@@ -471,10 +735,16 @@ def sendmail_bulk(msgs_data: list):
 
         if dummy:
             conn.send_messages(msgs)
+            report = None
         else:
-            conn.send_messages_in_parallel(msgs)
+            report = conn.send_messages_in_parallel(msgs)
         conn.close()
 
+        if report is not None and report.failed and (report.sent == 0 or report.unreachable):
+            raise MailSendError(report)
+
+        return report
+
 
 def get_authn_context(docs: list) -> list:
     """
@@ -516,14 +786,10 @@ def pretty_print_xml(content):
     """
     pretty print XML doc as HTML
 
-    :param content: XML doc base64 encoded
+    :param content: raw XML doc
     """
-    if "," in content:
-        content = content.split(",")[1]
-
-    xmlstr_pre = b64decode(content)
     parser = etree.XMLParser(remove_blank_text=True)
-    root = etree.fromstring(xmlstr_pre, parser)
+    root = etree.fromstring(content, parser)
     etree.indent(root)
     xmlstr = etree.tounicode(root, pretty_print=True)
     xml = highlight(
@@ -536,15 +802,44 @@ def pretty_print_xml(content):
     return html
 
 
-def pretty_print_any(content, doctype):
+def listing_pprint(doctype):
+    """
+    Value for the `pprinted` key of documents in invitation listings,
+    which do not carry the contents of the documents.
+    For XML documents, the actual preview is retrieved on demand.
+
+    :param doctype: the content type of the document
+    """
+    if doctype == 'application/pdf':
+        return 'not-needed-for-pdf'
+
+    return LAZY_PPRINTED
+
+
+def pretty_print_any(content, doctype, key=None) -> str:
     """
     pretty print XML doc as HTML only if the content is XML
 
-    :param content: XML doc base64 encoded
+    If the key of a document in the doc store is given, the preview is cached
+    beside the metadata of the document, keyed by a digest of its contents,
+    so that it is rendered only once per version of the document.
+
+    :param content: raw XML doc
+    :param doctype: the content type of the document
+    :param key: the key of the document in the doc store, if it is stored there
+    :return: the base64 encoded HTML preview
     """
     if doctype == 'application/pdf':
-        pprinted = 'not-needed-for-pdf'
-    else:
-        pprinted = pretty_print_xml(content)
+        return 'not-needed-for-pdf'
+
+    if key is None:
+        return pretty_print_xml(content).decode('ascii')
+
+    doc_store = current_app.extensions['doc_store']
+    digest = hashlib.sha256(content).hexdigest()
+    pprinted = doc_store.get_document_preview(key, digest)
+    if pprinted is None:
+        pprinted = pretty_print_xml(content).decode('ascii')
+        doc_store.add_document_preview(key, digest, pprinted)
 
     return pprinted
@@ -30,25 +30,38 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
-import asyncio
 import binascii
 import json
 import os
 import uuid
-from base64 import b64decode
+from base64 import b64decode, b64encode
 from collections import defaultdict
 from typing import Any, Dict, List, Tuple, Union
 
 import importlib
 import yaml
-from flask import Blueprint, abort, current_app, g, make_response, redirect, render_template, request, session, url_for
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    g,
+    make_response,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    session,
+    url_for,
+)
 from flask_babel import force_locale, get_locale, gettext
 from werkzeug.wrappers.response import Response
 
 from edusign_webapp.api import Routing
-from edusign_webapp.doc_store import DocStore
-from edusign_webapp.forms import has_pdf_form, update_pdf_form
+from edusign_webapp.forms import update_pdf_form
 from edusign_webapp.marshal import Marshal, UnMarshal, UnMarshalNoCSRF
+from edusign_webapp.metrics import document_metrics, format_metric
+from edusign_webapp.migrate import MigrationError, get_migration_source, migrate_documents, verify_migration
+from edusign_webapp.purge import purge_documents
 from edusign_webapp.schemata import (
     BlobSchema,
     ConfigSchema,
@@ -71,19 +84,22 @@ from edusign_webapp.schemata import (
     ToSignSchema,
 )
 from edusign_webapp.utils import (
+    EncodedAttachment,
     MissingDisplayName,
     NonWhitelisted,
     add_attributes_to_session,
+    b64decode_blob,
     get_invitations,
-    get_previous_signatures,
     get_previous_signatures_xml,
+    ingest_pdf,
     is_whitelisted,
-    prepare_document,
+    prepare_documents,
     pretty_print_any,
     pretty_print_xml,
     sendmail,
     sendmail_bulk,
 )
+from edusign_webapp.workers import PoolSaturated, PoolTimeout
 
 admin_edusign_views = Blueprint('edusign_admin', __name__, url_prefix='/admin', template_folder='templates')
 
@@ -105,18 +121,21 @@ def cleanup():
     :return: the number of documents removed
     """
     keys = current_app.extensions['doc_store'].get_old_documents(current_app.config['MAX_DOCUMENT_AGE'])
-    current_app.logger.info(f'Purging old documents form db with keys: {keys}')
-    total = len(keys)
-    removed = 0
-    for key in keys:
-        try:
-            current_app.extensions['doc_store'].remove_document(key, force=True)
-            removed += 1
-        except Exception as e:
-            current_app.logger.error(f'Problem removing old document {key}: {e}')
-            continue
+    current_app.logger.info('Purging old documents from db')
+    total, removed = purge_documents(
+        current_app._get_current_object(),
+        keys,
+        current_app.config['CLEANUP_BATCH_SIZE'],
+        current_app.config['CLEANUP_CONCURRENCY'],
+    )
+
+    try:
+        downloads = current_app.extensions['doc_store'].remove_expired_downloads()
+    except Exception as e:
+        current_app.logger.error(f'Problem removing expired downloads: {e}')
+        downloads = 0
 
-    response = make_response(f"Removed {removed} documents out of {total} scheduled")
+    response = make_response(f"Removed {removed} documents out of {total} scheduled, and {downloads} expired downloads")
     response.mimetype = "text/plain"
     return response
 
@@ -127,6 +146,9 @@ def migrate_to_redis_and_s3():
     Migrate the invitations contents from SQLite & the local fs
     to redis and s3.
 
+    The migration is resumed from the checkpoint left by a previous interrupted migration, if any.
+    For large dbs, it is better to use the `edusign-migrate` command, which is not bound by request timeouts.
+
     :return: the number of documents migrated
     """
     assert "S3Storage" in current_app.config['STORAGE_CLASS_PATH']
@@ -135,72 +157,103 @@ def migrate_to_redis_and_s3():
     assert 'LOCAL_STORAGE_BASE_DIR' in current_app.config
     assert 'SQLITE_MD_DB_PATH' in current_app.config
 
-    from edusign_webapp.document.metadata.sqlite import SqliteMD
-    from edusign_webapp.document.storage.local import LocalStorage
-
-    sqlite_md = SqliteMD(current_app)
-    local_storage = LocalStorage(current_app.config, current_app.logger)
-
-    old_doc_store = DocStore.custom(current_app, local_storage, sqlite_md)
+    app = current_app._get_current_object()
+    source = get_migration_source(app)
+    batch_size = current_app.config['MIGRATION_BATCH_SIZE']
+    concurrency = current_app.config['MIGRATION_CONCURRENCY']
 
     current_app.logger.info("STARTING MIGRATION TO REDIS AND S3")
 
-    keys = old_doc_store.get_old_documents(0)
-    current_app.logger.info(f"Going to migrate {len(keys)} documents")
-
-    migrated_docs = 0
-    migrated_invites = 0
-    for doc_key in keys:
-        current_app.logger.info(f"Migrating document with key {doc_key}")
-        old_document = old_doc_store.get_full_document(doc_key)
-        if not old_document:
-            current_app.logger.info(f"    Document with key {doc_key} not found, skipping")
-            continue
-
-        content = old_doc_store.get_document_content(doc_key)
-        old_invites = old_doc_store.get_full_invites(doc_key)
-        if len(old_invites) == 0:
-            current_app.logger.info(f"    Document with key {doc_key} has no invitations, skipping")
-            continue
+    checkpoint_path = current_app.config['MIGRATION_CHECKPOINT_PATH']
 
-        doc_id = current_app.extensions['doc_store'].add_document_raw(old_document, content)
-        migrated_docs += 1
-        current_app.logger.info(f"    Document with key {doc_key} added to db and storage")
+    try:
+        checkpoint = migrate_documents(app, source.metadata, source.storage, checkpoint_path, batch_size, concurrency)
+    except MigrationError as e:
+        current_app.logger.error(f"Problem migrating documents: {e}")
+        return f'ERROR, {e}, try again to resume the migration'
 
-        current_app.logger.info(f"Going to migrate {len(old_invites)} invites for document with key {doc_key}")
-        for invite in old_invites:
-            invite['doc_id'] = doc_id
-            current_app.extensions['doc_store'].add_invite_raw(invite)
-            migrated_invites += 1
+    report = verify_migration(app, source.metadata, source.storage, batch_size, concurrency)
+    current_app.logger.info(f"Verified migration: {report}")
 
-    return f'OK, migrated {migrated_docs} documents and {migrated_invites} invitations'
+    return (
+        f"OK, migrated {checkpoint['documents']} documents and {checkpoint['invites']} invitations, "
+        f"{report['missing']} missing and {report['mismatched']} mismatched"
+    )
 
 
 @edusign_views.route('/metrics', methods=['GET'])
 def metrics():
     """
-    Clean up the stored documents being signed,
+    Report metrics about the stored documents, the connections to the signing API, and the email outbox,
+    in the Prometheus text exposition format.
+    The document metrics are computed from aggregates kept by the metadata backend,
+    so the cost of a scrape does not grow with the number of stored documents.
 
-    :return: the number of documents removed
+    :return: the metrics
     """
-    keys = current_app.extensions['doc_store'].get_old_documents(0)
-    report = f"Number of documents: {len(keys)}\n"
-    weight = 0
-    for key in keys:
-        weight += current_app.extensions['doc_store'].get_document_size(key)
-
-    report += f"Total bytes: {weight}\n"
+    doc_store = current_app.extensions['doc_store']
+    age_days = current_app.config['METRICS_AGE_DAYS'] + [current_app.config['MAX_DOCUMENT_AGE']]
+    report = document_metrics(doc_store.get_document_stats(), age_days)
+
+    http_stats = sorted(current_app.extensions['api_client'].http_sessions.stats().items())
+    report += format_metric(
+        'edusign_api_requests_total',
+        'Requests sent to the signing API.',
+        'counter',
+        [({'base_url': base_url}, stats['requests']) for base_url, stats in http_stats],
+    )
+    report += format_metric(
+        'edusign_api_connections_total',
+        'Connections opened to the signing API.',
+        'counter',
+        [({'base_url': base_url}, stats['connections']) for base_url, stats in http_stats],
+    )
 
-    old_keys = current_app.extensions['doc_store'].get_old_documents(current_app.config['MAX_DOCUMENT_AGE'])
-    report += f"Number of documents to purge: {len(old_keys)}\n"
-    weight = 0
-    for key in old_keys:
-        weight += current_app.extensions['doc_store'].get_document_size(key)
+    outbox = doc_store.get_outbox_stats()
+    report += format_metric(
+        'edusign_outbox_pending', 'Emails pending in the outbox.', 'gauge', [({}, outbox['pending'])]
+    )
+    report += format_metric(
+        'edusign_outbox_dead', 'Emails dead lettered in the outbox.', 'gauge', [({}, outbox['dead'])]
+    )
+    report += format_metric(
+        'edusign_outbox_enqueued_total', 'Emails queued in the outbox.', 'counter', [({}, outbox['enqueued'])]
+    )
+    report += format_metric(
+        'edusign_outbox_sent_total', 'Emails sent from the outbox.', 'counter', [({}, outbox['sent'])]
+    )
+    report += format_metric(
+        'edusign_outbox_retried_total', 'Emails retried from the outbox.', 'counter', [({}, outbox['retried'])]
+    )
 
-    report += f"Total bytes to purge: {weight}\n"
+    workers = current_app.extensions['pdf_workers'].stats()
+    report += format_metric(
+        'edusign_pdf_workers_in_flight',
+        'PDF transformations running or waiting for a worker process.',
+        'gauge',
+        [({}, workers['in_flight'])],
+    )
+    report += format_metric(
+        'edusign_pdf_workers_tasks_total',
+        'PDF transformations handed to the worker processes, by outcome.',
+        'counter',
+        [({'outcome': outcome}, workers[outcome]) for outcome in ('completed', 'failed', 'rejected', 'timeouts')],
+    )
+    report += format_metric(
+        'edusign_pdf_workers_wait_seconds_total',
+        'Time spent by PDF transformations waiting for a worker process.',
+        'counter',
+        [({}, round(workers['wait_seconds'], 6))],
+    )
+    report += format_metric(
+        'edusign_pdf_workers_run_seconds_total',
+        'Time spent by PDF transformations running in a worker process.',
+        'counter',
+        [({}, round(workers['run_seconds'], 6))],
+    )
 
     response = make_response(report)
-    response.mimetype = "text/plain"
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
     return response
 
 
@@ -564,7 +617,7 @@ def add_document(document: dict) -> dict:
     key = str(uuid.uuid4())
 
     if document['type'] == 'application/pdf':
-        prepare_data = prepare_document(document)
+        prepare_data, content, analysis = ingest_pdf(document)
 
         if 'error' in prepare_data and prepare_data['error']:  # XXX update error message, translate
             return prepare_data
@@ -591,15 +644,16 @@ def add_document(document: dict) -> dict:
         doc_ref = prepare_data['updatedPdfDocumentReference']
         sign_req = json.dumps(prepare_data['visiblePdfSignatureRequirement'])
 
-        prev_signatures = get_previous_signatures(document)
-        has_form = has_pdf_form(document['blob'])
+        prev_signatures = analysis['prev_signatures']
+        has_form = analysis['has_form']
         pprinted = 'not-needed-for-pdf'
     else:
         doc_ref = key
         sign_req = 'not-needed-for-non-pdf'
-        prev_signatures = get_previous_signatures_xml(document)
+        content = b64decode_blob(document['blob'])
+        prev_signatures = get_previous_signatures_xml(content)
         has_form = False
-        pprinted = pretty_print_xml(document['blob'])
+        pprinted = pretty_print_xml(content)
         msg = ""
 
     return {
@@ -739,7 +793,7 @@ def _gather_invited_docs(docs: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any
             failed.append(failedDoc)
             continue
 
-        doc['blob'] = stored['document']['blob']
+        doc['blob'] = b64encode(stored['document']['blob']).decode('ascii')
         invited_docs.append(doc)
 
     return failed, invited_docs
@@ -818,7 +872,7 @@ def _ready_docs(
     api_views=[
         {"blueprint": edusign_api_views, "route": '/create-sign-request', "methods": ["POST"]},
     ],
-    authn_request=True
+    authn_request=True,
 )
 def recreate_sign_request(documents: dict) -> dict:
     """
@@ -849,29 +903,16 @@ def recreate_sign_request(documents: dict) -> dict:
 
     current_app.logger.debug(f'Data gotten in recreate view: {documents}')
 
-    async def prepare(doc):
-        return prepare_document(doc)
-
     current_app.logger.info(f"Re-preparing documents for user {session['eppn']}")
-    loop = asyncio.new_event_loop()
-    tasks = [loop.create_task(prepare(doc)) for doc in documents['documents']['local']]
 
     for doc in documents['documents']['owned']:
-        doc['blob'] = current_app.extensions['doc_store'].get_document_content(doc['key'])
-        tasks.append(loop.create_task(prepare(doc)))
+        content = current_app.extensions['doc_store'].get_document_content(doc['key'])
+        doc['blob'] = b64encode(content).decode('ascii') if content is not None else None
 
     failed, invited_docs = _gather_invited_docs(documents['documents']['invited'])
 
-    for doc in invited_docs:
-        doc['blob'] = current_app.extensions['doc_store'].get_document_content(doc['key'])
-        tasks.append(loop.create_task(prepare(doc)))
-
-    if len(tasks) > 0:
-        loop.run_until_complete(asyncio.wait(tasks))
-    loop.close()
-
-    docs_data = [task.result() for task in tasks]
     all_docs = documents['documents']['local'] + documents['documents']['owned'] + invited_docs
+    docs_data = prepare_documents(all_docs)
 
     more_failed, new_docs = _ready_docs(docs_data, all_docs)
     failed += more_failed
@@ -1038,6 +1079,55 @@ def _prepare_signed_by_email(key, owner):
     return (recipients, subject, body_txt, body_html)
 
 
+def _prepare_signed_attachment(signed_doc_name: str, content: bytes) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Prepare the final signed document to be sent by email to all signers.
+    It is base64 encoded once, to be shared by the messages for all languages,
+    or, if it is larger than MAIL_ATTACHMENT_MAX_SIZE, it is kept in the doc store
+    to be downloaded through a link valid for MAIL_DOWNLOAD_LINK_TTL seconds.
+
+    :param signed_doc_name: The file name of the signed document
+    :param content: The raw contents of the signed document
+    :return: The keyword arguments for `compose_message`, and the context for the email templates
+    """
+    if len(content) <= current_app.config['MAIL_ATTACHMENT_MAX_SIZE']:
+        return dict(attachment_name=signed_doc_name, attachment=EncodedAttachment(content)), {}
+
+    ttl = current_app.config['MAIL_DOWNLOAD_LINK_TTL']
+    key = current_app.extensions['doc_store'].add_download(signed_doc_name, content, ttl)
+    context = {
+        'download_link': url_for('edusign.download_signed', key=str(key), _external=True),
+        'download_days': max(1, ttl // 86400),
+    }
+    return {}, context
+
+
+@edusign_views.route('/download/<key>', methods=['GET'])
+@edusign_views2.route('/download/<key>', methods=['GET'])
+def download_signed(key: str) -> Response:
+    """
+    View to download a final signed document too large to be attached to the email sent to all signers,
+    through the time limited link sent instead.
+
+    :param key: The key identifying the download in the doc store
+    :return: The signed document as an attachment
+    """
+    try:
+        download = current_app.extensions['doc_store'].get_download(uuid.UUID(key))
+    except ValueError:
+        abort(404)
+
+    if not download:
+        abort(404)
+
+    return send_file(
+        download['stream'],
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=download['name'],
+    )
+
+
 def _prepare_all_signed_email(doc, mail_aliases):
     """
     Prepare email to send to all users that have signed the document,
@@ -1068,11 +1158,8 @@ def _prepare_all_signed_email(doc, mail_aliases):
             signed_doc_name = f"{prename}-{suffix}.{ext}"
         else:
             signed_doc_name = f"{doc_name}-{suffix}"
-        pdf_bytes = b64decode(doc['doc'].get('signedContent', doc['doc'].get('blob')))
-        email_kwargs = dict(
-            attachment_name=signed_doc_name,
-            attachment=pdf_bytes,
-        )
+        email_kwargs, link_context = _prepare_signed_attachment(signed_doc_name, doc['doc']['signedContent'])
+        mail_context.update(link_context)
     else:
         email_kwargs = {}
 
@@ -1080,7 +1167,10 @@ def _prepare_all_signed_email(doc, mail_aliases):
     for lang in recipients:
         with force_locale(lang):
             subject = gettext('"%(docname)s" is now signed') % {'docname': doc['owner']['docname']}
-            if doc['sendsigned']:
+            if doc['sendsigned'] and 'download_link' in mail_context:
+                body_txt = render_template('signed_all_email_link.txt.jinja2', **mail_context)
+                body_html = render_template('signed_all_email_link.html.jinja2', **mail_context)
+            elif doc['sendsigned']:
                 body_txt = render_template('signed_all_email.txt.jinja2', **mail_context)
                 body_html = render_template('signed_all_email.html.jinja2', **mail_context)
             else:
@@ -1108,7 +1198,8 @@ def _prepare_signed_documents_data(process_data):
 
         # invitation to self
         if 'email' in owner and owner['email'] not in mail_aliases:
-            current_app.extensions['doc_store'].update_document(key, doc['signedContent'], mail_aliases)
+            signed_content = doc['signedContent']
+            current_app.extensions['doc_store'].update_document(key, signed_content, mail_aliases)
             current_app.extensions['doc_store'].unlock_document(key, mail_aliases)
 
             all_invites = current_app.extensions['doc_store'].get_pending_invites(key)
@@ -1122,7 +1213,7 @@ def _prepare_signed_documents_data(process_data):
                     {
                         'id': key,
                         'name': docname,
-                        'signed_content': doc['signedContent'],
+                        'signed_content': signed_content,
                         'validated': False,
                         'type': doc['mimeType'],
                         'pending': pending_invites,
@@ -1286,6 +1377,8 @@ def get_signed_documents(sign_data: dict) -> dict:
     validated = current_app.extensions['api_client'].validate_signatures(to_validate)
 
     docs = _prepare_signed_documents_data(process_data)
+    # The documents still being signed by other invitees remain in the doc store
+    stored = {doc['id'] for doc in docs}
 
     mail_aliases = session.get('mail_aliases', [session['mail']])
     for doc in validated:
@@ -1319,7 +1412,9 @@ def get_signed_documents(sign_data: dict) -> dict:
     doc_names = []
 
     for doc in docs:
-        doc['pprinted'] = pretty_print_any(doc['signed_content'], doc['type'])
+        # Only cache the previews of documents that remain in the doc store
+        key = doc['id'] if doc['id'] in stored else None
+        doc['pprinted'] = pretty_print_any(doc['signed_content'], doc['type'], key=key)
         doc_names.append(doc["name"])
 
     current_app.logger.info(f"Handing over signed documents to {session['eppn']}: {', '.join(doc_names)}")
@@ -1742,8 +1837,12 @@ def get_partially_signed_doc(data: dict) -> dict:
     """
     key = uuid.UUID(data['key'])
     try:
-        doc = current_app.extensions['doc_store'].get_document_content(key)
+        doc = current_app.extensions['doc_store'].get_document_stream(key)
         doctype = current_app.extensions['doc_store'].get_document_type(key)
+        if doc is not None and doctype != 'application/pdf':
+            # the XML preview needs the whole document
+            with doc:
+                doc = doc.read()
 
     except Exception as e:
         current_app.logger.error(f'Problem getting multi sign document: {e}')
@@ -1753,7 +1852,7 @@ def get_partially_signed_doc(data: dict) -> dict:
         current_app.logger.error(f"Problem getting multisigned document with key : {data['key']}")
         return {'error': True, 'message': gettext('Cannot find the document being signed')}
 
-    pprinted = pretty_print_any(doc, doctype)
+    pprinted = pretty_print_any(doc, doctype, key=key)
 
     return {'message': 'Success', 'payload': {'blob': doc, 'pprinted': pprinted}}
 
@@ -1781,12 +1880,8 @@ def _prepare_final_email_skipped(doc, key, sendsigned):
             signed_doc_name = f"{prename}-signed.{ext}"
         else:
             signed_doc_name = doc_name + '-signed'
-        pdf_bytes = b64decode(doc['doc']['signedContent'], validate=True)
-
-        kwargs = dict(
-            attachment_name=signed_doc_name,
-            attachment=pdf_bytes,
-        )
+        kwargs, link_context = _prepare_signed_attachment(signed_doc_name, doc['doc']['signedContent'])
+        mail_context.update(link_context)
     else:
         kwargs = {}
 
@@ -1794,7 +1889,10 @@ def _prepare_final_email_skipped(doc, key, sendsigned):
     for lang in recipients:
         with force_locale(lang):
             subject = gettext('"%(docname)s" is now signed') % {'docname': doc['doc']['name']}
-            if sendsigned:
+            if sendsigned and 'download_link' in mail_context:
+                body_txt = render_template('signed_all_email_link.txt.jinja2', **mail_context)
+                body_html = render_template('signed_all_email_link.html.jinja2', **mail_context)
+            elif sendsigned:
                 body_txt = render_template('signed_all_email.txt.jinja2', **mail_context)
                 body_html = render_template('signed_all_email.html.jinja2', **mail_context)
             else:
@@ -1857,7 +1955,7 @@ def skip_final_signature(data: dict) -> dict:
         [{'key': key, 'owner': 'dummy', 'doc': doc, 'sendsigned': sendsigned}]
     )
     newdoc = validated[0]
-    signed_content = newdoc['doc'].get('signedContent', newdoc['doc']['blob'])
+    signed_content = newdoc['doc']['signedContent']
 
     pprinted = pretty_print_any(signed_content, doctype)
 
@@ -2064,7 +2162,13 @@ def update_form(data):
     pdf = data['document']
     fields = data['form_fields']
     try:
-        updated = update_pdf_form(pdf, fields)
+        updated = current_app.extensions['pdf_workers'].run(update_pdf_form, pdf, fields)
+    except PoolSaturated:
+        current_app.logger.warning("Too many PDF forms being filled in, rejecting request")
+        return {'error': True, 'message': gettext('The service is busy, please try again in a few moments')}
+    except PoolTimeout:
+        current_app.logger.error("Timeout filling in form in PDF")
+        return {'error': True, 'message': gettext('Problem filling in form in PDF, please try again')}
     except Exception as e:
         current_app.logger.error(f"Problem filling in form in PDF: {e}")
         return {'error': True, 'message': gettext('Problem filling in form in PDF, please try again')}
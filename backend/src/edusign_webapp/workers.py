@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2021 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the SUNET nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class PoolSaturated(Exception):
+    """
+    Raised when there are already as many tasks running and waiting in the pool as allowed.
+    """
+
+
+class PoolTimeout(BaseException):
+    """
+    Raised when a task has not finished within the allowed time.
+
+    Like `KeyboardInterrupt`, it does not derive from `Exception`, so that the `except Exception`
+    clauses in the task being interrupted do not swallow it and carry on with a degraded result.
+    """
+
+
+def _on_alarm(signum, frame):
+    raise PoolTimeout()
+
+
+def _timed_call(func: Callable, args: tuple, deadline: float) -> Tuple[Any, float, float]:
+    """
+    Run `func` in a worker process, interrupting it if it is still running at `deadline`,
+    so that a task the caller has given up on does not keep the worker busy.
+
+    :param func: the function to call
+    :param args: the arguments for the function
+    :param deadline: the time by which the function must have returned
+    :return: the result of the function, and the times at which it started and finished
+    """
+    started = time.time()
+    if started >= deadline:
+        raise PoolTimeout()
+    previous = signal.signal(signal.SIGALRM, _on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, deadline - started)
+    try:
+        result = func(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+    return result, started, time.time()
+
+
+# Extra seconds to wait for a worker to report that it has interrupted a task that reached its deadline
+TIMEOUT_GRACE = 1.0
+
+
+class WorkerPool(object):
+    """
+    Bounded pool of worker processes, to run CPU bound transformations of documents
+    (like filling in PDF forms, or converting PDFs to PDF/A) out of the request handling process.
+
+    At most `max_workers` tasks run at the same time, and at most `max_queued` more wait for a free worker;
+    any task beyond that is rejected with `PoolSaturated`, so the caller can ask the user to try again later.
+    A task that does not finish within `timeout` seconds (counting the time waiting for a worker)
+    is cancelled and `PoolTimeout` is raised.
+
+    The worker processes are started on first use, so that each process serving requests
+    (e.g. each forked gunicorn worker) gets its own. With `max_workers` set to 0,
+    tasks are run in the calling thread, with no limits.
+    """
+
+    def __init__(self, max_workers: int, max_queued: int, timeout: float, start_method: str = 'spawn'):
+        """
+        :param max_workers: Number of worker processes
+        :param max_queued: Max number of tasks waiting for a free worker
+        :param timeout: Max number of seconds to wait for the result of a task
+        :param start_method: multiprocessing start method for the worker processes
+        """
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.start_method = start_method
+
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._in_flight = 0
+        self._stats: Dict[str, float] = {
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'wait_seconds': 0.0,
+            'run_seconds': 0.0,
+        }
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None or self._pid != os.getpid():
+            context = multiprocessing.get_context(self.start_method)
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            self._pid = os.getpid()
+            self._in_flight = 0
+        return self._executor
+
+    def _reserve(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queued:
+                self._stats['rejected'] += 1
+                raise PoolSaturated()
+            executor = self._get_executor()
+            self._in_flight += 1
+            return executor
+
+    def _release(self, future: Optional[Future] = None):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _reset(self):
+        with self._lock:
+            self._executor = None
+
+    def _count(self, outcome: str, wait: float = 0.0, run: float = 0.0):
+        with self._lock:
+            self._stats[outcome] += 1
+            self._stats['wait_seconds'] += wait
+            self._stats['run_seconds'] += run
+
+    def run(self, func: Callable, *args: Any) -> Any:
+        """
+        Run `func` with the given arguments in a worker process, and wait for its result.
+        Both `func` and its arguments must be picklable.
+
+        :param func: the function to call, defined at the top level of some module
+        :param args: the arguments for the function
+        :raises PoolSaturated: if there are too many tasks running and waiting
+        :raises PoolTimeout: if the task has not finished in time
+        :return: the result of calling the function
+        """
+        if self.max_workers <= 0:
+            started = time.time()
+            try:
+                result = func(*args)
+            except Exception:
+                self._count('failed', run=time.time() - started)
+                raise
+            self._count('completed', run=time.time() - started)
+            return result
+
+        executor = self._reserve()
+        submitted = time.time()
+        try:
+            future = executor.submit(_timed_call, func, args, submitted + self.timeout)
+        except BrokenProcessPool:
+            self._release()
+            self._reset()
+            self._count('failed')
+            raise
+
+        try:
+            result, started, finished = future.result(timeout=self.timeout + TIMEOUT_GRACE)
+        except (FutureTimeoutError, PoolTimeout):
+            # If still queued the task is dropped, otherwise it is interrupted in the worker at its deadline
+            future.cancel()
+            self._count('timeouts', wait=time.time() - submitted)
+            raise PoolTimeout()
+        except BrokenProcessPool:
+            self._reset()
+            self._count('failed', wait=time.time() - submitted)
+            raise
+        except Exception:
+            self._count('failed', wait=time.time() - submitted)
+            raise
+        finally:
+            if future.done():
+                self._release()
+            else:
+                future.add_done_callback(self._release)
+
+        self._count('completed', wait=max(0.0, started - submitted), run=finished - started)
+        return result
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Metrics on the tasks run in the pool by this process.
+
+        :return: A dict with the number of tasks `in_flight` (running or waiting),
+                 the numbers of tasks `completed`, `failed`, `rejected`, and that reached the timeout (`timeouts`),
+                 and the total seconds the tasks have spent waiting for a worker (`wait_seconds`)
+                 and running (`run_seconds`).
+        """
+        with self._lock:
+            return dict(self._stats, in_flight=self._in_flight)
+
+    def shutdown(self):
+        """
+        Stop the worker processes, cancelling the tasks waiting for them.
+        """
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
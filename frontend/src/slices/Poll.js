@@ -52,7 +52,6 @@ export const poll = createAsyncThunk("main/poll", async (args, thunkAPI) => {
               ownedCopy.declined = newOwned.declined;
               ownedCopy.sendsigned = newOwned.sendsigned;
               ownedCopy.skipfinal = newOwned.skipfinal;
-              ownedCopy.pprinted = newOwned.pprinted;
             }
           });
           if (ownedCopy.pending.length === 0) ownedCopy.state = "loaded";
@@ -90,7 +89,6 @@ export const poll = createAsyncThunk("main/poll", async (args, thunkAPI) => {
             invitedCopy.declined = newInvited.declined;
             invitedCopy.sendsigned = newInvited.sendsigned;
             invitedCopy.skipfinal = newInvited.skipfinal;
-            invitedCopy.pprinted = newInvited.pprinted;
           }
         });
         return invitedCopy;